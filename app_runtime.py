@@ -1,15 +1,35 @@
-from core_setup import *
+import multiprocessing
 
-# Load jobs from file at startup
-load_jobs_from_file()
+# In a frozen merge worker process (PyInstaller EXE) this runs the worker and never returns,
+# so nothing below, the background services included, runs in a worker
+multiprocessing.freeze_support()
 
-# Start the dedicated worker thread immediately after loading jobs
-start_worker_thread()
+from core_setup import *
 
 app = Flask(__name__)
-if not os.path.exists(OUTPUT_FOLDER):
-    os.makedirs(OUTPUT_FOLDER)
-    logging.info(f"📁 تم إنشاء مجلد المخرجات: {OUTPUT_FOLDER}")
+
+def start_background_services():
+    """
+    Loads the saved jobs and printer fleet and starts the print queue worker, retention sweeper
+    and FTP pool keeper. Runs when this module is imported by the main process, whether it is
+    started as a script, by `flask run` or by a WSGI server; merge worker processes import it
+    again (spawn) and must not start their own workers over a stale copy of PRINT_JOBS.
+    """
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+        logging.info(f"📁 تم إنشاء مجلد المخرجات: {OUTPUT_FOLDER}")
+
+    # Load jobs from file at startup
+    load_jobs_from_file()
+    load_printer_fleet()
+
+    # Start the dedicated worker thread immediately after loading jobs
+    start_worker_thread()
+    start_retention_sweeper()
+    start_ftp_pool_keeper()
+
+if multiprocessing.current_process().name == 'MainProcess':
+    start_background_services()
 
 HTML_CONTENT = """
 <!DOCTYPE html>
@@ -212,8 +232,8 @@ HTML_CONTENT = """
                 </h3>
                 <div class="grid md:grid-cols-2 gap-4">
                     <label class="file-input-group block" for="jsonFile">
-                        <span class="flex items-center justify-between text-base font-medium text-gray-700">بيانات الطلاب (.json) <span data-lucide="file-json" class="w-5 h-5 text-gray-500"></span></span>
-                        <input type="file" id="jsonFile" accept=".json" required>
+                        <span class="flex items-center justify-between text-base font-medium text-gray-700">بيانات الطلاب (.json / .ndjson / .csv / .tsv) <span data-lucide="file-json" class="w-5 h-5 text-gray-500"></span></span>
+                        <input type="file" id="jsonFile" accept=".json,.ndjson,.jsonl,.csv,.tsv" required>
                         <p class="text-xs text-gray-500 mt-1" id="jsonFileName">لم يتم اختيار ملف بعد</p>
                     </label>
                     <label class="file-input-group block" for="coverPdfFile">
@@ -274,6 +294,15 @@ HTML_CONTENT = """
                     <input type="number" id="pagesPerPart" value="4" min="1" required
                            class="mt-1 block w-full max-w-xs border border-gray-300 rounded-md p-2 text-center text-sm font-bold focus:ring-[var(--shu-color)] focus:border-[var(--shu-color)]">
                     <p class="text-xs text-gray-500 mt-1">سيتم تقسيم ملف PDF المدمج إلى أجزاء، كل جزء بحجم الصفحات المحدد. كل جزء يمثل مهمة طباعة مستقلة.</p>
+                    <label for="studentsPerPart" class="block text-sm font-medium text-gray-700 mt-4">أو عدد الطلاب لكل جزء (اختياري)</label>
+                    <input type="number" id="studentsPerPart" min="1"
+                           class="mt-1 block w-full max-w-xs border border-gray-300 rounded-md p-2 text-center text-sm font-bold focus:ring-[var(--shu-color)] focus:border-[var(--shu-color)]">
+                    <p class="text-xs text-gray-500 mt-1">عند تحديده، يضم كل جزء ملفات طلاب كاملة (الغلاف مع صفحات الامتحان) فلا يمتد أي جزء بين طالبين.</p>
+                    <label class="flex items-center mt-4 text-sm font-medium text-gray-700">
+                        <input type="checkbox" id="lazyParts" class="ml-2">
+                        تأجيل قص الأجزاء حتى الطباعة (يمكن تغيير التقسيم عند الطباعة دون إعادة الدمج)
+                    </label>
+                    <p class="text-xs text-gray-500 mt-1">مطلوب للإرسال المباشر دون حفظ الأجزاء على القرص بتقسيم الدمج نفسه.</p>
                 </div>
             </div>
             <div class="pt-6 border-t border-gray-200">
@@ -324,6 +353,27 @@ HTML_CONTENT = """
                         <input type="password" id="contFtpPwd" 
                                class="mt-1 block w-full border border-gray-300 rounded-md p-2 text-sm focus:ring-green-600 focus:border-green-600">
                     </div>
+                    <div class="md:col-span-2">
+                        <label class="flex items-center text-sm font-medium text-gray-700">
+                            <input type="checkbox" id="contUseFleet" class="ml-2">
+                            توزيع المهام على أسطول الطابعات المسجلة (حسب الحمل وسرعة كل طابعة)
+                        </label>
+                        <label class="flex items-center mt-2 text-sm font-medium text-gray-700">
+                            <input type="checkbox" id="contStreamParts" class="ml-2">
+                            إرسال الأجزاء مباشرة من الملف المدمج دون حفظها على القرص
+                        </label>
+                        <p class="text-xs text-gray-500 mt-1">يقص في الذاكرة الأجزاء التي لا توجد لها ملفات فقط؛ المهام المدمجة دون تأجيل قص الأجزاء تُرسل من ملفاتها المحفوظة.</p>
+                    </div>
+                </div>
+                <div id="fleetPanel" class="border rounded-md p-3 bg-gray-50 hidden">
+                    <div id="fleetList" class="space-y-1 text-sm mb-3"></div>
+                    <div class="grid md:grid-cols-5 gap-2">
+                        <input type="text" id="fleetPrinterIp" placeholder="IP الطابعة" class="border border-gray-300 rounded-md p-2 text-sm">
+                        <input type="text" id="fleetFtpUser" placeholder="مستخدم FTP" value="anonymous" class="border border-gray-300 rounded-md p-2 text-sm">
+                        <input type="password" id="fleetFtpPwd" placeholder="كلمة المرور" class="border border-gray-300 rounded-md p-2 text-sm">
+                        <input type="number" id="fleetRingNumber" placeholder="الرينج" min="1" class="border border-gray-300 rounded-md p-2 text-sm text-center">
+                        <button type="button" onclick="addFleetPrinter()" class="px-3 py-2 text-sm font-medium rounded-md text-white bg-green-600 hover:bg-green-700 transition">إضافة طابعة</button>
+                    </div>
                 </div>
                 <button type="submit" id="startContinuousButton"
                         class="w-full flex items-center justify-center bg-green-600 text-white font-bold py-3 px-4 rounded-lg shadow-lg hover:bg-green-700 transition duration-300 disabled:opacity-50 disabled:cursor-not-allowed">
@@ -371,6 +421,29 @@ HTML_CONTENT = """
                                class="mt-1 block w-full border border-gray-300 rounded-md p-2 text-sm text-center font-bold focus:ring-[var(--shu-color)] focus:border-[var(--shu-color)]">
                         <p class="text-xs text-gray-500 mt-1">يُستخدم لتمييز ملفات الطباعة باسم المستخدم/موقع الطباعة.</p>
                     </div>
+                    <div>
+                        <label for="printPagesPerPart" class="block text-sm font-medium text-gray-700">عدد الصفحات لكل جزء لهذه الطباعة (اختياري)</label>
+                        <input type="number" id="printPagesPerPart" min="1"
+                               class="mt-1 block w-full border border-gray-300 rounded-md p-2 text-sm text-center font-bold focus:ring-[var(--shu-color)] focus:border-[var(--shu-color)]">
+                        <p class="text-xs text-gray-500 mt-1">اتركه فارغًا لاستخدام التقسيم المحدد عند الدمج.</p>
+                    </div>
+                    <div>
+                        <label class="block text-sm font-medium text-gray-700">إعادة إرسال الأجزاء من / إلى (اختياري)</label>
+                        <div class="grid grid-cols-2 gap-2 mt-1">
+                            <input type="number" id="printFirstPart" min="1" placeholder="من"
+                                   class="block w-full border border-gray-300 rounded-md p-2 text-sm text-center focus:ring-[var(--shu-color)] focus:border-[var(--shu-color)]">
+                            <input type="number" id="printLastPart" min="1" placeholder="إلى"
+                                   class="block w-full border border-gray-300 rounded-md p-2 text-sm text-center focus:ring-[var(--shu-color)] focus:border-[var(--shu-color)]">
+                        </div>
+                        <p class="text-xs text-gray-500 mt-1">اتركه فارغًا لاستئناف الإرسال من أول جزء لم يُرسل بعد.</p>
+                    </div>
+                    <div>
+                        <label class="flex items-center text-sm font-medium text-gray-700">
+                            <input type="checkbox" id="printStreamParts" class="ml-2">
+                            إرسال الأجزاء مباشرة من الملف المدمج دون حفظها على القرص
+                        </label>
+                        <p class="text-xs text-gray-500 mt-1">يقص في الذاكرة الأجزاء التي لا توجد لها ملفات فقط؛ إذا كانت ملفات الأجزاء محفوظة بهذا التقسيم تُرسل من القرص.</p>
+                    </div>
                     <div id="modalStatus" role="alert" class="mt-4 p-3 rounded-lg text-sm text-center hidden font-medium"></div>
                 </div>
                 <div class="flex justify-end space-x-3 mt-6">
@@ -392,6 +465,8 @@ HTML_CONTENT = """
         const API_URL_JOBS = '/api/jobs';
         const API_URL_DOWNLOAD = '/api/download/';
         const API_URL_CONTINUOUS = '/api/continuous_print';
+        const API_URL_ASSETS = '/api/assets';
+        const API_URL_PRINTERS = '/api/printers';
 
         const localStorageKey = 'documerge_ftp_settings';
         const localStorageContKey = 'documerge_ftp_cont_settings';
@@ -420,13 +495,20 @@ HTML_CONTENT = """
             localStorage.setItem(localStorageContKey, JSON.stringify({ contPrinterIp: ip, contFtpUser: user, contRingNumber: ring }));
         }
 
-        function fileToBase64(file) {
-            return new Promise((resolve, reject) => {
-                const reader = new FileReader();
-                reader.onload = () => resolve(reader.result.split(',')[1]);
-                reader.onerror = error => reject(error);
-                reader.readAsDataURL(file);
-            });
+        async function uploadAssetOnce(file) {
+            // Content-addressed upload: files the server already holds are referenced by hash only.
+            // Returns null when hashing is unavailable (non-secure context) so the file is sent inline.
+            if (!window.crypto || !window.crypto.subtle) return null;
+            const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            const hash = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+            const check = await fetch(API_URL_ASSETS + '/' + hash);
+            if (!check.ok) {
+                const body = new FormData();
+                body.append('file', file);
+                const upload = await fetch(API_URL_ASSETS, { method: 'POST', body });
+                if (!upload.ok) return null;
+            }
+            return hash;
         }
 
         function updateStatus(message, type = 'info', targetId = 'statusMessage') {
@@ -512,22 +594,25 @@ HTML_CONTENT = """
                     const statusClass = job.status === 'Printed' ? 'bg-green-100 border-green-500 text-green-800' :
                                          job.status === 'Printing' ? 'bg-blue-100 border-blue-500 text-blue-800' :
                                          job.status === 'Error' ? 'bg-red-100 border-red-500 text-red-800' :
+                                         job.status === 'Merging' ? 'bg-yellow-100 border-yellow-500 text-yellow-800' :
                                          'bg-gray-100 border-gray-500 text-gray-800';
                     
                     const statusIcon = job.status === 'Printed' ? 'check-circle' :
                                        job.status === 'Printing' ? 'loader-2' :
                                        job.status === 'Error' ? 'alert-triangle' :
+                                       job.status === 'Merging' ? 'loader-2' :
                                        'alert-circle';
                     
                     const statusText = job.status === 'Printed' ? 'تمت الطباعة بنجاح' :
                                        job.status === 'Printing' ? 'جاري الإرسال للطابعة...' :
                                        job.status === 'Error' ? `❌ خطأ في الإرسال: ${job.print_details.split(':')[0]}` :
+                                       job.status === 'Merging' ? `جاري الدمج... (${(job.progress || {}).students_stamped || 0}/${(job.progress || {}).students_total ?? '?'} طالب)` :
                                        'جاهز للطباعة';
 
-                    const actionButton = job.status === 'Printing' ? `
+                    const actionButton = job.status === 'Printing' || job.status === 'Merging' ? `
                             <button disabled class="flex items-center justify-center px-4 py-2 text-sm font-medium rounded-md text-white bg-gray-500 cursor-not-allowed">
                                 <div class="spinner mr-2" style="width: 16px; height: 16px; border-top: 2px solid #fff;"></div>
-                                جاري الإرسال
+                                ${job.status === 'Merging' ? 'جاري الدمج' : 'جاري الإرسال'}
                             </button>
                         ` : `
                             <button onclick="handlePrintManualClick('${job.id}')"
@@ -537,6 +622,12 @@ HTML_CONTENT = """
                             </button>
                         `;
 
+                    const transferInfo = job.transfer && job.transfer.throughput ?
+                        `<p class="text-xs text-gray-500 mt-1">سرعة الإرسال: ${Math.round(job.transfer.throughput / 1024)} KB/s (${Math.round(job.transfer.bytes / 1024)} KB في ${job.transfer.seconds.toFixed(1)} ثانية)</p>` : '';
+                    const sentParts = Object.values((job.part_progress || {}).parts || {}).filter(part => part.state === 'sent').length;
+                    const partProgress = job.status !== 'Printed' && sentParts > 0 ?
+                        `<p class="text-xs text-gray-500 mt-1">أُرسل ${sentParts} من ${job.part_count} جزء (سيُستأنف الإرسال من الجزء التالي)</p>` : '';
+
                     const printTime = job.start_time && job.end_time ? 
                         `<p class="text-xs text-gray-500 mt-1">وقت الطباعة: ${new Date(job.start_time).toLocaleTimeString()} - ${new Date(job.end_time).toLocaleTimeString()}</p>` :
                         job.start_time ? `<p class="text-xs text-gray-500 mt-1">بدأ الإرسال: ${new Date(job.start_time).toLocaleTimeString()}</p>` : '';
@@ -555,6 +646,9 @@ HTML_CONTENT = """
                                         عدد الأجزاء للطباعة: ${job.part_count}
                                     </p>
                                     ${printTime}
+                                    ${partProgress}
+                                    ${transferInfo}
+                                    ${(job.artifacts_evicted || []).includes('full') ? `<p class="text-xs text-red-600 mt-1">تم حذف ملفات هذه الوظيفة لتوفير المساحة.</p>` : ''}
                                 </div>
                                 <div class="space-y-2 flex flex-col items-end">
                                     ${actionButton}
@@ -583,6 +677,19 @@ HTML_CONTENT = """
             }
         }
 
+        async function waitForMerge(statusUrl) {
+            while (true) {
+                const response = await fetch(statusUrl);
+                if (!response.ok) throw new Error('فشل في متابعة حالة الدمج');
+                const mergeJob = await response.json();
+                if (mergeJob.status !== 'Merging') return mergeJob;
+
+                const progress = mergeJob.progress || {};
+                updateStatus(`جاري الدمج في الخلفية... الطلاب: ${progress.students_stamped || 0}/${progress.students_total ?? (progress.students_read || 0) + '+'}، الصفحات: ${progress.pages_written || 0}، الأجزاء: ${progress.parts_split || 0}`, 'info');
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+
         function handlePrintManualClick(jobId) {
             openModal(jobId);
         }
@@ -610,8 +717,19 @@ HTML_CONTENT = """
                 ftp_user: ftpUser,
                 ftp_pwd: ftpPwd,
                 ring_number: ringNumber,
-                is_continuous: false // Manual print is not continuous
+                is_continuous: false, // Manual print is not continuous
+                spool_parts: !document.getElementById('printStreamParts').checked
             };
+            const printPagesPerPart = document.getElementById('printPagesPerPart').value.trim();
+            if (printPagesPerPart) {
+                payload.pages_per_part = parseInt(printPagesPerPart);
+            }
+            const printFirstPart = document.getElementById('printFirstPart').value.trim();
+            if (printFirstPart) {
+                payload.first_part = parseInt(printFirstPart);
+                const printLastPart = document.getElementById('printLastPart').value.trim();
+                if (printLastPart) payload.last_part = parseInt(printLastPart);
+            }
 
             updateStatus(`جاري إرسال الوظيفة ID: ${jobId} إلى الطابعة ${printerIp} برقم رينج ${ringNumber}...`, 'info', 'jobsStatus');
             
@@ -624,7 +742,11 @@ HTML_CONTENT = """
                 
                 if (response.ok) {
                     const result = await response.json();
-                    updateStatus(`تم بنجاح! بدأ إرسال مهمة الطباعة في الخلفية. (${result.message})`, 'success', 'jobsStatus');
+                    if (result.warning) {
+                        updateStatus(`بدأ إرسال مهمة الطباعة في الخلفية. (${result.message}) ⚠️ ${result.warning}`, 'warning', 'jobsStatus');
+                    } else {
+                        updateStatus(`تم بنجاح! بدأ إرسال مهمة الطباعة في الخلفية. (${result.message})`, 'success', 'jobsStatus');
+                    }
                     loadPrintJobs(); 
                 } else {
                     const errorJson = await response.json();
@@ -643,22 +765,24 @@ HTML_CONTENT = """
             const ftpUser = document.getElementById('contFtpUser').value.trim();
             const ftpPwd = document.getElementById('contFtpPwd').value;
             const ringNumber = document.getElementById('contRingNumber').value.trim();
+            const useFleet = document.getElementById('contUseFleet').checked;
 
-            if (!printerIp || !ftpUser || !ringNumber) {
+            if (!useFleet && (!printerIp || !ftpUser || !ringNumber)) {
                 updateStatus('يرجى ملء جميع حقول الطباعة المستمرة المطلوبة', 'error', 'jobsStatus');
                 return;
             }
             
             saveContinuousSettings(printerIp, ftpUser, ringNumber);
 
-            const payload = {
+            const payload = useFleet ? { fleet: true, ring_number: ringNumber } : {
                 printer_ip: printerIp,
                 ftp_user: ftpUser,
                 ftp_pwd: ftpPwd,
                 ring_number: ringNumber
             };
+            payload.spool_parts = !document.getElementById('contStreamParts').checked;
 
-            updateStatus(`جاري بدء الطباعة المستمرة لجميع المهام الجاهزة إلى الطابعة ${printerIp}...`, 'info', 'jobsStatus');
+            updateStatus(useFleet ? 'جاري بدء الطباعة المستمرة لجميع المهام الجاهزة على أسطول الطابعات...' : `جاري بدء الطباعة المستمرة لجميع المهام الجاهزة إلى الطابعة ${printerIp}...`, 'info', 'jobsStatus');
             
             try {
                 const response = await fetch(API_URL_CONTINUOUS, {
@@ -669,7 +793,11 @@ HTML_CONTENT = """
                 
                 if (response.ok) {
                     const result = await response.json();
-                    updateStatus(`✅ تم بنجاح! بدأ خط الطباعة المستمر. (${result.message})`, 'success', 'jobsStatus');
+                    if (result.warning) {
+                        updateStatus(`بدأ خط الطباعة المستمر. (${result.message}) ⚠️ ${result.warning}`, 'warning', 'jobsStatus');
+                    } else {
+                        updateStatus(`✅ تم بنجاح! بدأ خط الطباعة المستمر. (${result.message})`, 'success', 'jobsStatus');
+                    }
                     loadPrintJobs(); 
                 } else {
                     const errorJson = await response.json();
@@ -683,6 +811,68 @@ HTML_CONTENT = """
         });
 
 
+        async function loadFleet() {
+            const list = document.getElementById('fleetList');
+            try {
+                const response = await fetch(API_URL_PRINTERS);
+                const printers = await response.json();
+                list.innerHTML = printers.length === 0 ? '<p class="text-gray-500">لا توجد طابعات مسجلة في الأسطول بعد.</p>' : '';
+                printers.forEach(printer => {
+                    // Printer fields are user input: set as text (and the delete handler as a closure), never as HTML
+                    const speed = printer.throughput ? `${Math.round(printer.throughput / 1024)} KB/s` : '-';
+                    const row = document.createElement('div');
+                    row.className = 'flex justify-between items-center';
+                    const label = document.createElement('span');
+                    label.textContent = `${printer.ip} (${printer.ftp_user}) — قيد الإرسال: ${printer.in_flight}، أُرسل: ${printer.jobs_sent}، السرعة: ${speed} `;
+                    if (!printer.available) {
+                        const paused = document.createElement('span');
+                        paused.className = 'text-red-600';
+                        paused.textContent = '(متوقفة مؤقتاً)';
+                        label.appendChild(paused);
+                    }
+                    const removeButton = document.createElement('button');
+                    removeButton.type = 'button';
+                    removeButton.className = 'text-red-600 text-xs';
+                    removeButton.textContent = 'حذف';
+                    removeButton.addEventListener('click', () => removeFleetPrinter(printer.ip));
+                    row.append(label, removeButton);
+                    list.appendChild(row);
+                });
+            } catch (error) {
+                console.error('Fleet Error:', error);
+                list.innerHTML = '<p class="text-red-600">فشل في تحميل أسطول الطابعات.</p>';
+            }
+        }
+
+        async function addFleetPrinter() {
+            const payload = {
+                printer_ip: document.getElementById('fleetPrinterIp').value.trim(),
+                ftp_user: document.getElementById('fleetFtpUser').value.trim(),
+                ftp_pwd: document.getElementById('fleetFtpPwd').value,
+                ring_number: document.getElementById('fleetRingNumber').value.trim()
+            };
+            const response = await fetch(API_URL_PRINTERS, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(payload)
+            });
+            if (!response.ok) {
+                const errorJson = await response.json();
+                updateStatus(`❌ ${errorJson.error || 'فشل تسجيل الطابعة'}`, 'error', 'jobsStatus');
+            }
+            loadFleet();
+        }
+
+        async function removeFleetPrinter(printerIp) {
+            await fetch(API_URL_PRINTERS + '/' + encodeURIComponent(printerIp), { method: 'DELETE' });
+            loadFleet();
+        }
+
+        document.getElementById('contUseFleet').addEventListener('change', (e) => {
+            document.getElementById('fleetPanel').classList.toggle('hidden', !e.target.checked);
+            if (e.target.checked) loadFleet();
+        });
+
         document.querySelectorAll('input[type="file"]').forEach(input => {
             input.addEventListener('change', (e) => {
                 const fileNameElement = document.getElementById(e.target.id + 'Name');
@@ -719,39 +909,50 @@ HTML_CONTENT = """
             try {
                 updateStatus('جاري تحميل وقراءة الملفات...', 'info');
 
-                const [json_data_b64, cover_pdf_b64, exam_pdf_b64, font_ttf_b64] = await Promise.all([
-                    fileToBase64(jsonFile),
-                    fileToBase64(coverPdfFile),
-                    fileToBase64(examPdfFile),
-                    fileToBase64(fontTtfFile)
-                ]);
-
-                const payload = {
-                    json_data_b64,
-                    cover_pdf_b64,
-                    exam_pdf_b64,
-                    font_ttf_b64,
-                    pages_per_part: parseInt(pagesPerPart), // New field
-                    config: {
-                        name_key: document.getElementById('nameKey').value.trim(),
-                        id_key: document.getElementById('idKey').value.trim(),
-                        name_x: document.getElementById('nameX').value.trim(),
-                        name_y: document.getElementById('nameY').value.trim(),
-                        id_x: document.getElementById('idX').value.trim(),
-                        id_y: document.getElementById('idY').value.trim(),
+                // Files are sent as raw binary parts (multipart/form-data) instead of base64 inside JSON
+                const formData = new FormData();
+                formData.append('json_file', jsonFile);
+
+                // Cover, exam and font are reused across sections, so upload each one at most once
+                const assets = { cover_pdf: coverPdfFile, exam_pdf: examPdfFile, font_ttf: fontTtfFile };
+                for (const [key, file] of Object.entries(assets)) {
+                    const hash = await uploadAssetOnce(file);
+                    if (hash) {
+                        formData.append(key + '_hash', hash);
+                    } else {
+                        formData.append(key, file);
                     }
-                };
+                }
+                formData.append('pages_per_part', parseInt(pagesPerPart));
+                const studentsPerPart = document.getElementById('studentsPerPart').value.trim();
+                if (studentsPerPart) {
+                    formData.append('students_per_part', parseInt(studentsPerPart));
+                }
+                formData.append('lazy_parts', document.getElementById('lazyParts').checked);
+                formData.append('config', JSON.stringify({
+                    name_key: document.getElementById('nameKey').value.trim(),
+                    id_key: document.getElementById('idKey').value.trim(),
+                    name_x: document.getElementById('nameX').value.trim(),
+                    name_y: document.getElementById('nameY').value.trim(),
+                    id_x: document.getElementById('idX').value.trim(),
+                    id_y: document.getElementById('idY').value.trim(),
+                }));
 
                 updateStatus('جاري إرسال البيانات إلى خادم المعالجة...', 'info');
 
                 const response = await fetch(API_URL_MERGE, {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
+                    body: formData
                 });
 
                 if (response.ok) {
                     const result = await response.json();
+                    // The merge runs in the background; follow its progress until the job is ready
+                    const mergeJob = await waitForMerge(result.status_url);
+                    if (mergeJob.status !== 'Ready') {
+                        updateStatus(`خطأ في الخادم: ${mergeJob.print_details}`, 'error');
+                        return;
+                    }
                     updateStatus('نجاح! تم الدمج. جاري تحضير ملف PDF للتحميل...', 'success');
                     
                     window.location.href = API_URL_DOWNLOAD + result.job_id;
@@ -815,78 +1016,175 @@ def index():
 def static_files(filename):
     return send_from_directory('static', filename)
 
+def parse_form_int(value):
+    """Converts a form field to int; invalid values are returned unchanged so validation rejects them."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+def parse_form_bool(value) -> bool:
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+MERGE_ASSET_KEYS = ('cover_pdf', 'exam_pdf', 'font_ttf')
+# Spool-less printing only cuts in memory the parts that have no file yet (see prints_from_part_files)
+SPOOLED_ANYWAY_WARNING = "لديها ملفات أجزاء محفوظة بهذا التقسيم فستُرسل من القرص؛ الإرسال المباشر يقص في الذاكرة فقط الأجزاء التي لا توجد لها ملفات (مثل الدمج مع تأجيل قص الأجزاء أو تقسيم مختلف عند الطباعة)."
+
+def attach_roster(merge_request: dict, roster_hash: str, filename: str, roster_format: str):
+    """Points the merge at a stored roster file; the students themselves are parsed lazily by the merge."""
+    merge_request['roster_hash'] = roster_hash
+    merge_request['roster_path'] = asset_path(roster_hash)
+    merge_request['roster_format'] = roster_format or detect_roster_format(merge_request['roster_path'], filename)
+
+def read_json_merge_request() -> dict:
+    """
+    Legacy /api/merge body: the four files base64-encoded inside one JSON document.
+    Any file may instead be referenced by the hash returned from /api/assets (<key>_hash).
+    The roster format is taken from roster_format, json_filename or the file content.
+    """
+    data = request.get_json()
+    merge_request = {
+        "pages_per_part": data['pages_per_part'],
+        "students_per_part": data.get('students_per_part'),
+        "lazy_parts": bool(data.get('lazy_parts', LAZY_PARTS)),
+        "config": data['config'],
+        "merge_workers": data.get('merge_workers', MERGE_WORKERS),
+        "stream_output": data.get('stream_output', STREAM_MERGE_OUTPUT),
+        "wait": bool(data.get('wait', False)),
+        "incremental": bool(data.get('incremental', INCREMENTAL_MERGE)),
+    }
+    for key in MERGE_ASSET_KEYS:
+        if data.get(f"{key}_hash"):
+            merge_request[key] = load_asset(data[f"{key}_hash"])
+        else:
+            merge_request[key] = base64.b64decode(data[f"{key}_b64"])
+    roster_hash = data.get('json_data_hash') or store_asset(base64.b64decode(data['json_data_b64']))
+    attach_roster(merge_request, roster_hash, data.get('json_filename'), data.get('roster_format'))
+    return merge_request
+
+def read_multipart_merge_request() -> dict:
+    """
+    multipart/form-data /api/merge body: the files arrive as raw binary parts, which werkzeug
+    spools to temporary files while parsing, and the options as form fields (config as JSON).
+    This avoids the base64 overhead and the extra in-memory copies of the JSON body.
+    Any file may instead be referenced by the hash returned from /api/assets (<key>_hash).
+    """
+    form = request.form
+    files = request.files
+    merge_request = {
+        "pages_per_part": parse_form_int(form['pages_per_part']),
+        "students_per_part": parse_form_int(form['students_per_part']) if form.get('students_per_part') else None,
+        "lazy_parts": parse_form_bool(form.get('lazy_parts', LAZY_PARTS)),
+        "config": json.loads(form['config']),
+        "merge_workers": parse_form_int(form.get('merge_workers', MERGE_WORKERS)),
+        "stream_output": parse_form_bool(form.get('stream_output', STREAM_MERGE_OUTPUT)),
+        "wait": parse_form_bool(form.get('wait', False)),
+        "incremental": parse_form_bool(form.get('incremental', INCREMENTAL_MERGE)),
+    }
+    for key in MERGE_ASSET_KEYS:
+        if form.get(f"{key}_hash"):
+            merge_request[key] = load_asset(form[f"{key}_hash"])
+        else:
+            merge_request[key] = files[key].read()
+    # The roster (JSON array, NDJSON or CSV) is copied to the asset store block by block, never read whole
+    if form.get('json_data_hash'):
+        attach_roster(merge_request, form['json_data_hash'], None, form.get('roster_format'))
+    else:
+        roster_file = files['json_file']
+        attach_roster(merge_request, store_asset_file(roster_file.stream), roster_file.filename, form.get('roster_format'))
+    return merge_request
+
+@app.route('/api/assets', methods=['POST'])
+def upload_asset():
+    """Stores a cover/exam/font/roster file once and returns its content hash for later merges."""
+    try:
+        # Copied to the asset store block by block while hashing, never held in memory
+        if 'file' in request.files:
+            asset_hash = store_asset_file(request.files['file'].stream)
+        else:
+            asset_hash = store_asset_file(request.stream)
+
+        size = asset_size(asset_hash)
+        if not size:
+            os.remove(asset_path(asset_hash))
+            return jsonify({"error": "لم يتم إرسال أي ملف للتخزين."}), 400
+
+        return jsonify({"hash": asset_hash, "size": size}), 200
+
+    except Exception as e:
+        logging.error("❌ خطأ أثناء تخزين الأصل: %s", e, exc_info=True)
+        return jsonify({"error": f"خطأ في تخزين الملف: {e}"}), 500
+
+@app.route('/api/assets/<asset_hash>', methods=['GET'])
+def get_asset_info(asset_hash):
+    """Lets clients skip re-uploading an asset the server already holds."""
+    size = asset_size(asset_hash)
+    if size is None:
+        return jsonify({"error": "الأصل غير موجود."}), 404
+    return jsonify({"hash": asset_hash, "size": size}), 200
+
 @app.route('/api/merge', methods=['GET', 'POST'])
 def merge_documents():
     if request.method == 'GET':
-        return jsonify({"status": "ready"}), 200
-    
+        return jsonify({"status": "ready", "merge_queue": get_merge_queue_stats()}), 200
+
+    # Admission control: refuse before the uploads are parsed when the merge queue is full
+    if not reserve_merge_slot():
+        retry_after = estimate_merge_retry_after()
+        logging.warning(f"⚠️ تم رفض طلب دمج: قائمة انتظار الدمج ممتلئة ({get_merge_queue_stats()}).")
+        response = jsonify({"error": "الخادم مشغول بعمليات دمج أخرى. يرجى إعادة المحاولة لاحقًا.", "retry_after": retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 503
+
+    slot_submitted = False
     try:
-        data = request.json
+        if request.mimetype == 'multipart/form-data':
+            merge_request = read_multipart_merge_request()
+        else:
+            merge_request = read_json_merge_request()
         
-        json_data_b64 = data['json_data_b64']
-        cover_pdf_b64 = data['cover_pdf_b64']
-        exam_pdf_b64 = data['exam_pdf_b64']
-        font_ttf_b64 = data['font_ttf_b64']
-        pages_per_part = data['pages_per_part']
-        config = data['config']
+        pages_per_part = merge_request['pages_per_part']
+        merge_workers = merge_request['merge_workers']
         
         if not isinstance(pages_per_part, int) or pages_per_part < 1:
              return jsonify({"error": "عدد الصفحات لكل جزء يجب أن يكون رقمًا صحيحًا وموجبًا."}), 400
 
-        json_data_bytes = base64.b64decode(json_data_b64)
-        cover_pdf_bytes = base64.b64decode(cover_pdf_b64)
-        exam_pdf_bytes = base64.b64decode(exam_pdf_b64)
-        font_ttf_bytes = base64.b64decode(font_ttf_b64)
+        students_per_part = merge_request['students_per_part']
+        if students_per_part is not None and (not isinstance(students_per_part, int) or students_per_part < 1):
+             return jsonify({"error": "عدد الطلاب لكل جزء يجب أن يكون رقمًا صحيحًا وموجبًا."}), 400
+
+        if not isinstance(merge_workers, int) or merge_workers < 1:
+             return jsonify({"error": "عدد عمليات الدمج المتوازية يجب أن يكون رقمًا صحيحًا وموجبًا."}), 400
+
+        font_ttf_bytes = merge_request['font_ttf']
+        config = merge_request['config']
+
+        if merge_request['roster_format'] not in ROSTER_FORMATS:
+            return jsonify({"error": f"صيغة ملف بيانات الطلاب غير مدعومة. الصيغ المدعومة: {', '.join(ROSTER_FORMATS)}."}), 400
 
-        students = json.loads(json_data_bytes)
-        if not students:
+        # Only the first record is parsed here; the merge streams the rest of the roster
+        try:
+            has_students = roster_has_students(merge_request['roster_path'], merge_request['roster_format'], config)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            return jsonify({"error": f"ملف بيانات الطلاب غير صالح: {e}"}), 400
+        if not has_students:
             return jsonify({"error": "ملف بيانات الطلاب فارغ أو غير صالح."}), 400
 
+        # Fail fast on an unusable font; the registry keeps it parsed for the background merge
         if not register_custom_font(font_ttf_bytes):
             return jsonify({"error": "فشل في تسجيل الخط العربي. يرجى التأكد من صلاحية ملف TTF."}), 400
-        
-        logging.info(f"بدء دمج {len(students)} طالب مع الغلاف وصفحات الامتحان...")
-        
-        exam_reader = PdfReader(io.BytesIO(exam_pdf_bytes))
-        exam_pages = list(exam_reader.pages)
-        
-        final_pdf_writer = PdfWriter()
-        
-        for student in students:
-            name = student.get(config['name_key'], 'غير متوفر')
-            student_id = student.get(config['id_key'], 'غير متوفر')
-            
-            watermark_pdf = create_watermark(name, student_id, config, font_ttf_bytes)
-            watermark_reader = PdfReader(watermark_pdf)
-            watermark_page = watermark_reader.pages[0]
-            
-            cover_reader = PdfReader(io.BytesIO(cover_pdf_bytes))
-            cover_page = copy.copy(cover_reader.pages[0])
-            cover_page.merge_page(watermark_page)
-            
-            final_pdf_writer.add_page(cover_page)
-            
-            for page in exam_pages:
-                final_pdf_writer.add_page(page)
-
-        final_pdf_stream = io.BytesIO()
-        final_pdf_writer.write(final_pdf_stream)
-        final_pdf_stream.seek(0)
 
-        job_id = datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = f"Merged_Job_{job_id}.pdf"
-        
-        # Pass pages_per_part to the splitting function
-        part_count = split_pdf_ranges(job_id, final_pdf_stream, pages_per_part)
+        # Inline uploads are kept in the asset store too, so later merges can reference them by hash
+        asset_hashes = {key: store_asset(merge_request[key]) for key in MERGE_ASSET_KEYS}
+        asset_hashes['json_data'] = merge_request['roster_hash']
 
         new_job = {
-            "id": job_id,
-            "filename": filename,
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "status": "Ready",
-            "part_count": part_count,
-            "print_details": "لم يتم الإرسال بعد.",
-            "full_path": os.path.join(OUTPUT_FOLDER, f"{job_id}_FULL.pdf"),
+            "status": "Merging", # Turns 'Ready' once the background merge has written all parts
+            "part_count": 0,
+            "pages_per_part": pages_per_part,
+            "students_per_part": students_per_part,
+            "print_details": "في انتظار دور الدمج...",
             "start_time": None, 
             "end_time": None,
             "retry_count": 0, # New field initialization
@@ -894,20 +1192,107 @@ def merge_documents():
             "printer_ip": None,
             "ftp_user": None,
             "ftp_pwd": None,
-            "ring_number": None
+            "ring_number": None,
+            "asset_hashes": asset_hashes, # Keeps the job's assets out of the asset store sweep
+            "progress": {
+                "students_total": None, # Known once the whole roster has been streamed
+                "students_read": 0,
+                "students_stamped": 0,
+                "pages_written": 0,
+                "parts_split": 0,
+                "segments_reused": 0 # Created up front: the merge only updates keys, never adds them while PRINT_JOBS may be serialized
+            }
         }
         
         with QUEUE_LOCK:
+            # The ID is allocated and claimed under the same lock, so concurrent merges never share output files
+            job_id = allocate_job_id()
+            new_job.update({
+                "id": job_id,
+                "filename": f"Merged_Job_{job_id}.pdf",
+                "full_path": os.path.join(job_output_dir(job_id), f"{job_id}_FULL.pdf"),
+            })
             PRINT_JOBS.insert(0, new_job)
             save_jobs_to_file() # Persistence point A: New job insertion
         
-        logging.info(f"✅ تم إنشاء وظيفة جديدة ID: {job_id} بـ {part_count} جزء. (تقسيم: {pages_per_part} صفحة/جزء)")
+        merge_future = submit_merge_job(job_id, merge_request)
+        slot_submitted = True
 
-        return jsonify({"job_id": job_id, "message": "تم الدمج والتحضير بنجاح."}), 200
+        if merge_request['wait']:
+            # Synchronous compatibility mode: block until the background merge has finished
+            merge_future.result()
+            with QUEUE_LOCK:
+                status, details, peak_memory_mb = new_job['status'], new_job['print_details'], new_job.get('peak_memory_mb')
+            if status != 'Ready':
+                return jsonify({"error": f"خطأ في معالجة الملفات: {details}", "job_id": job_id}), 500
+            return jsonify({"job_id": job_id, "message": "تم الدمج والتحضير بنجاح.", "peak_memory_mb": peak_memory_mb, "asset_hashes": asset_hashes}), 200
 
+        return jsonify({
+            "job_id": job_id,
+            "message": "تم استلام طلب الدمج وجاري تنفيذه في الخلفية.",
+            "status_url": f"/api/merge/{job_id}",
+            "asset_hashes": asset_hashes
+        }), 202
+
+    except FileNotFoundError as e:
+        # A referenced asset hash is unknown to the asset store
+        logging.error("❌ أصل غير موجود أثناء معالجة الدمج: %s", e)
+        return jsonify({"error": f"{e} يرجى رفع الملف مجددًا."}), 404
+    except KeyError as e:
+        # A required field or file part (or its <key>_hash) is missing from the request
+        logging.error("❌ حقل مفقود في طلب الدمج: %s", e.args[0])
+        return jsonify({"error": f"الحقل المطلوب مفقود في طلب الدمج: {e.args[0]}"}), 400
     except Exception as e:
         logging.error("❌ خطأ عام أثناء معالجة الدمج: %s", e, exc_info=True)
         return jsonify({"error": f"خطأ في معالجة الملفات: {e}"}), 500
+    finally:
+        if not slot_submitted:
+            release_merge_slot()
+
+@app.route('/api/merge/<job_id>', methods=['GET'])
+def merge_status(job_id):
+    """Progress of a background merge: students stamped, pages written and parts split."""
+    with QUEUE_LOCK:
+        job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
+        if not job_found:
+            return jsonify({"error": "وظيفة الدمج غير موجودة."}), 404
+        return jsonify({
+            "job_id": job_id,
+            "status": job_found['status'],
+            "progress": dict(job_found.get('progress', {})),
+            "part_count": job_found['part_count'],
+            "peak_memory_mb": job_found.get('peak_memory_mb'),
+            "print_details": job_found['print_details']
+        }), 200
+
+def read_print_layout(data: dict):
+    """
+    Optional per-print split (pages_per_part or students_per_part) overriding the merge-time layout.
+    Returns (layout or None, error message or None).
+    """
+    layout = {key: data.get(key) for key in ('pages_per_part', 'students_per_part') if data.get(key) not in (None, '')}
+    if not layout:
+        return None, None
+    for key, value in layout.items():
+        if not isinstance(value, int) or value < 1:
+            return None, f"قيمة {key} يجب أن تكون رقمًا صحيحًا وموجبًا."
+    layout.setdefault('pages_per_part', PAGES_PER_PART)
+    return layout, None
+
+def read_part_range(data: dict):
+    """
+    Optional explicit resend of parts first_part..last_part (1-based; last_part defaults to first_part).
+    Returns ((first, last) or None, error message or None).
+    """
+    first = data.get('first_part')
+    if first in (None, ''):
+        return None, None
+    last = data.get('last_part')
+    if last in (None, ''):
+        last = first
+    if not isinstance(first, int) or not isinstance(last, int) or not 1 <= first <= last:
+        return None, "نطاق الأجزاء غير صالح (first_part و last_part يجب أن يكونا رقمين صحيحين و first_part ≤ last_part)."
+    return (first, last), None
 
 @app.route('/api/jobs', methods=['GET', 'POST'])
 def handle_jobs():
@@ -928,34 +1313,55 @@ def handle_jobs():
             if not all([job_id, printer_ip, ftp_user, ring_number]):
                 return jsonify({"error": "بيانات الطباعة ناقصة (Job ID، IP، المستخدم، أو رقم الرينج). يرجى التأكد من إدخالها."}), 400
 
+            # The split may be changed per print without merging again
+            print_layout, layout_error = read_print_layout(data)
+            if layout_error:
+                return jsonify({"error": layout_error}), 400
+            # By default a print resumes after the parts an interrupted attempt already sent
+            part_range, range_error = read_part_range(data)
+            if range_error:
+                return jsonify({"error": range_error}), 400
+            resume = parse_form_bool(data['resume']) if 'resume' in data else True
+
             with QUEUE_LOCK:
                 job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
             
             if not job_found:
                 return jsonify({"error": "وظيفة الطباعة غير موجودة."}), 404
             
-            if job_found['status'] == 'Printing':
+            if job_found['status'] == 'Printing' or job_in_print_lane(job_id):
                  return jsonify({"error": "هذه الوظيفة قيد الإرسال بالفعل."}), 409
 
+            if job_found['status'] == 'Merging':
+                 return jsonify({"error": "هذه الوظيفة قيد الدمج ولم تصبح جاهزة للطباعة بعد."}), 409
+
+            if part_range and not print_layout and job_found.get('part_count') and part_range[1] > job_found['part_count']:
+                return jsonify({"error": f"نطاق الأجزاء خارج حدود الوظيفة (1-{job_found['part_count']})."}), 400
+
             # Reset retry count for manual/explicit print
             with QUEUE_LOCK:
                 job_found['retry_count'] = 0
                 job_found['status'] = 'Ready'
+                if 'spool_parts' in data:
+                    # False: parts without a file yet are cut in memory while uploading instead of being written
+                    job_found['spool_parts'] = parse_form_bool(data['spool_parts'])
+                layout = print_layout or {}
+                spooled_anyway = not job_found.get('spool_parts', SPOOL_PART_FILES) and \
+                    prints_from_part_files(job_found, layout.get('pages_per_part'), layout.get('students_per_part'))
                 save_jobs_to_file()
             
-            # Start the print job in a new thread
-            thread_name = f"FTP_Print_{job_id}"
-            ftp_thread = threading.Thread(
-                target=print_job_ftp,
-                args=(job_id, printer_ip, ftp_user, ftp_pwd, ring_number, is_continuous),
-                name=thread_name
-            )
-            ftp_thread.start()
+            # Queue the print on the printer's dispatch lane, shared with continuous printing
+            if not submit_print_job(job_id, printer_ip, print_job_ftp,
+                                    job_id, printer_ip, ftp_user, ftp_pwd, ring_number, is_continuous, print_layout, part_range, resume):
+                return jsonify({"error": "هذه الوظيفة قيد الإرسال بالفعل."}), 409
             
-            return jsonify({
+            response = {
                 "message": f"بدأ إرسال مهمة الطباعة ID: {job_id} إلى الطابعة ({printer_ip}) في الخلفية.",
-                "thread_name": thread_name
-            }), 200
+                "lane": get_print_lane_stats().get(printer_ip)
+            }
+            if spooled_anyway:
+                response["warning"] = f"الوظيفة {SPOOLED_ANYWAY_WARNING}"
+            return jsonify(response), 200
 
         except Exception as e:
             logging.error("❌ خطأ في معالجة طلب الطباعة عبر FTP: %s", e, exc_info=True)
@@ -974,11 +1380,23 @@ def start_continuous_print():
         ftp_user = data.get('ftp_user')
         ftp_pwd = data.get('ftp_pwd', '')
         ring_number = data.get('ring_number')
-
-        if not all([printer_ip, ftp_user, ring_number]):
+        # Fleet mode spreads the jobs across the registered printers instead of a single printer_ip
+        use_fleet = parse_form_bool(data.get('fleet'))
+        spool_parts = parse_form_bool(data['spool_parts']) if 'spool_parts' in data else None
+
+        if use_fleet:
+            if not any(printer['enabled'] for printer in get_fleet_status()):
+                return jsonify({"error": "لا توجد طابعات مفعلة في الأسطول. يرجى تسجيل طابعة واحدة على الأقل."}), 400
+        elif not all([printer_ip, ftp_user, ring_number]):
             return jsonify({"error": "بيانات الطباعة المستمرة ناقصة (IP، المستخدم، أو رقم الرينج). يرجى التأكد من إدخالها."}), 400
 
+        print_layout, layout_error = read_print_layout(data)
+        if layout_error:
+            return jsonify({"error": layout_error}), 400
+
         job_ids_to_queue = []
+        spooled_anyway = [] # Spool-less jobs that still print from their part files
+        layout = print_layout or {}
         
         with QUEUE_LOCK:
             # 1. Identify and prepare 'Ready' jobs
@@ -986,10 +1404,23 @@ def start_continuous_print():
                 if job['status'] == 'Ready' and job['id'] not in CONTINUOUS_QUEUE:
                     # Reset retry count and update print settings for the continuous run
                     job['retry_count'] = 0
-                    job['printer_ip'] = printer_ip
-                    job['ftp_user'] = ftp_user
-                    job['ftp_pwd'] = ftp_pwd # Store credentials securely if needed, but here we store as-is
-                    job['ring_number'] = ring_number
+                    job.pop('not_before', None)
+                    job['fleet'] = use_fleet
+                    if use_fleet:
+                        # The printer (and its credentials) is chosen when the worker dispatches the job
+                        job['fleet_ring_number'] = ring_number or None
+                        job['failed_printers'] = []
+                    else:
+                        job['printer_ip'] = printer_ip
+                        job['ftp_user'] = ftp_user
+                        job['ftp_pwd'] = ftp_pwd # Store credentials securely if needed, but here we store as-is
+                        job['ring_number'] = ring_number
+                    job['print_layout'] = print_layout
+                    if spool_parts is not None:
+                        job['spool_parts'] = spool_parts
+                    if not job.get('spool_parts', SPOOL_PART_FILES) and \
+                            prints_from_part_files(job, layout.get('pages_per_part'), layout.get('students_per_part')):
+                        spooled_anyway.append(job['id'])
                     job_ids_to_queue.append(job['id'])
             
             if not job_ids_to_queue:
@@ -1004,15 +1435,72 @@ def start_continuous_print():
             logging.info(f"تمت إضافة {len(job_ids_to_queue)} وظيفة إلى قائمة الانتظار المستمرة: {job_ids_to_queue}")
 
         # The worker thread will detect the non-empty queue and start processing immediately.
-        return jsonify({
+        response = {
             "message": f"بدأ خط الطباعة المستمر. تمت إضافة {len(job_ids_to_queue)} مهمة إلى قائمة الانتظار للطباعة.",
-        }), 200
+        }
+        if spooled_anyway:
+            response["warning"] = f"{len(spooled_anyway)} مهمة {SPOOLED_ANYWAY_WARNING}"
+        return jsonify(response), 200
 
     except Exception as e:
         logging.error("❌ خطأ في معالجة طلب الطباعة المستمرة: %s", e, exc_info=True)
         return jsonify({"error": f"خطأ في بدء عملية الطباعة المستمرة: {e}"}), 500
 
 
+@app.route('/api/retention', methods=['GET', 'POST'])
+def retention_status():
+    """GET: disk usage and bytes reclaimed by the retention sweeper. POST: run a sweep now."""
+    try:
+        if request.method == 'POST':
+            return jsonify(sweep_output_folder()), 200
+        with RETENTION_LOCK:
+            stats = dict(RETENTION_STATS)
+        stats["budget_bytes"] = OUTPUT_DISK_BUDGET_MB * 1024 * 1024
+        return jsonify(stats), 200
+    except Exception as e:
+        logging.error("❌ خطأ في تنظيف مجلد المخرجات: %s", e, exc_info=True)
+        return jsonify({"error": f"خطأ في تنظيف مجلد المخرجات: {e}"}), 500
+
+@app.route('/api/printers', methods=['GET', 'POST'])
+def handle_printers():
+    """GET: fleet printers with their load and throughput. POST: register or update a fleet printer."""
+    if request.method == 'GET':
+        return jsonify(get_fleet_status()), 200
+
+    try:
+        data = request.json
+        printer_ip = (data.get('printer_ip') or '').strip()
+        ftp_user = (data.get('ftp_user') or '').strip()
+        if not printer_ip or not ftp_user:
+            return jsonify({"error": "بيانات الطابعة ناقصة (IP أو المستخدم)."}), 400
+        enabled = parse_form_bool(data['enabled']) if 'enabled' in data else True
+        max_uploads = parse_form_int(data.get('max_uploads'))
+        if max_uploads is not None and (not isinstance(max_uploads, int) or max_uploads < 1):
+            return jsonify({"error": "عدد الإرسالات المتزامنة يجب أن يكون 1 على الأقل."}), 400
+        printer = register_printer(printer_ip, ftp_user, data.get('ftp_pwd', ''), data.get('ring_number') or None, enabled, max_uploads)
+        printer.pop('ftp_pwd', None)
+        return jsonify(printer), 200
+    except Exception as e:
+        logging.error("❌ خطأ في تسجيل الطابعة: %s", e, exc_info=True)
+        return jsonify({"error": f"خطأ في تسجيل الطابعة: {e}"}), 500
+
+@app.route('/api/printers/<printer_ip>', methods=['DELETE'])
+def delete_printer(printer_ip):
+    """Removes a printer from the fleet."""
+    if not remove_printer(printer_ip):
+        return jsonify({"error": "الطابعة غير مسجلة في الأسطول."}), 404
+    return jsonify({"message": f"تم حذف الطابعة {printer_ip} من الأسطول."}), 200
+
+@app.route('/api/print_lanes', methods=['GET'])
+def print_lanes_status():
+    """Jobs waiting or printing in each printer's dispatch lane, and its circuit breaker state."""
+    return jsonify(get_print_lane_stats()), 200
+
+@app.route('/api/ftp_sessions', methods=['GET'])
+def ftp_sessions_status():
+    """Pooled FTP sessions per printer and how often a login was saved by reusing one."""
+    return jsonify(get_ftp_pool_stats()), 200
+
 @app.route('/api/download/<job_id>', methods=['GET'])
 def download_file(job_id):
     with QUEUE_LOCK:
@@ -1020,17 +1508,30 @@ def download_file(job_id):
     
     if not job_found:
         return jsonify({"error": "الملف غير موجود."}), 404
+
+    if job_found['status'] == 'Merging':
+        # In streaming mode the FULL file exists on disk before it is complete
+        return jsonify({"error": "الملف قيد الدمج ولم يكتمل بعد."}), 409
+
+    if 'full' in job_found.get('artifacts_evicted', []):
+        return jsonify({"error": "تم حذف الملف المدمج ضمن سياسة الاحتفاظ بالمساحة."}), 410
+
+    with QUEUE_LOCK:
+        job_found['last_used'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        save_jobs_to_file() # The retention sweeper's LRU order must survive a restart
     
     full_filename = f"{job_id}_FULL.pdf"
-    path = os.path.join(OUTPUT_FOLDER, full_filename)
+    # Jobs merged before per-job directories existed keep their FULL file directly in OUTPUT_FOLDER
+    path = job_found.get('full_path') or os.path.join(OUTPUT_FOLDER, full_filename)
     
     if not os.path.exists(path):
         return jsonify({"error": "ملف الـ PDF المدمج غير موجود على الخادم."}), 404
 
-    response = make_response(send_from_directory(OUTPUT_FOLDER, full_filename, as_attachment=True))
+    response = make_response(send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path), as_attachment=True))
     response.headers['Content-Disposition'] = f'attachment; filename="{quote(full_filename)}"'
     return response
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support() # Required for the merge process pool in the frozen Windows EXE
     logging.info("🚀 تم بدء تشغيل خادم DocuMerge.")
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
\ No newline at end of file
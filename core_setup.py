@@ -1,12 +1,23 @@
 import io
 import json
 import base64
+import codecs
+import csv
+import hashlib
 import logging
-import copy
 import os
+import queue
+import random
+import re
+import shutil
 import time
 import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import quote
 
 from flask import Flask, request, jsonify, make_response, send_from_directory
@@ -15,22 +26,79 @@ from reportlab.lib.pagesizes import A4
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject
 
 import arabic_reshaper
 from bidi.algorithm import get_display
-from ftplib import FTP, all_errors as FTP_ALL_ERRORS
+from ftplib import FTP, error_perm, error_temp, all_errors as FTP_ALL_ERRORS
+
+try:
+    import resource # POSIX only; used to report peak memory of streaming merges
+except ImportError:
+    resource = None
 
 # --- Configuration Constants ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(threadName)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-FONT_REGISTERED = False
-REGISTERED_FONT_NAME = "CustomArabic"
+REGISTERED_FONT_NAME = "CustomArabic" # Prefix; each distinct TTF is registered as CustomArabic-<sha256 prefix>
+MAX_REGISTERED_FONTS = 8 # Distinct fonts kept registered before unused ones are evicted (LRU)
+ARABIC_SHAPING_CACHE_SIZE = 8192 # Shaped strings memoized by process_arabic_text (LRU)
+COVER_XOBJECT_NAME = "/DocuMergeCover" # Shared form XObject holding the cover page content
 
 OUTPUT_FOLDER = "output_jobs"
+ASSET_FOLDER = "asset_store" # Content-addressed uploads (cover, exam, font, roster) named by SHA-256
+PARSED_ASSET_CACHE_SIZE = 8 # Parsed PdfReader objects kept for hot assets (LRU)
+ASSET_COPY_BLOCK_SIZE = 64 * 1024 # Bytes copied (and hashed) per read when storing an uploaded file
+SEGMENT_MANIFEST_FILE = "segments.json" # Per-job record of each student's objects in the FULL file, for incremental re-merges
+INCREMENTAL_MERGE = True # Default for splicing unchanged students from the previous merge when a roster is merged again
+ROSTER_FORMATS = ('json', 'ndjson', 'csv', 'tsv') # Accepted student roster formats (tsv = tab-separated CSV)
+ROSTER_READ_SIZE = 64 * 1024 # Bytes read per step while parsing a roster incrementally
 PAGES_PER_PART = 4 # Default value, now configurable
+LAZY_PARTS = False # Default for deferring part files until a job is actually printed
+SPOOL_PART_FILES = True # Default for printing from part files; False cuts each part in memory while it is uploaded
+MERGE_WORKERS = 1 # Default merge worker processes (1 = serial merge on the request thread)
+STREAM_MERGE_OUTPUT = False # Default for streaming the merged PDF straight to disk
+MERGE_BATCH_SIZE = 200 # Students stamped per chunk (and flushed per chunk in streaming mode)
+MERGE_EXECUTOR_WORKERS = 2 # Background merges that may run at the same time
+MERGE_QUEUE_LIMIT = 4 # Admitted merges that may wait for a free merge worker; further requests get 503
+MERGE_RETRY_AFTER_DEFAULT = 30 # Retry-After (seconds) for refused merges before any merge duration is known
+STREAM_CATALOG_OBJ = 1 # Reserved object numbers in streamed PDF output
+STREAM_PAGES_OBJ = 2
 JOBS_DATA_FILE = "jobs_data.json"
+OUTPUT_DISK_BUDGET_MB = 20 * 1024 # Disk budget for OUTPUT_FOLDER; the sweeper evicts LRU artifacts above it
+PRINTED_PARTS_RETENTION_DAYS = 2 # Part files of 'Printed' jobs are dropped after this many days (FULL is kept)
+FINISHED_JOB_RETENTION_DAYS = 30 # FULL and parts of 'Printed'/'Error' jobs unused for this long are dropped
+ORPHAN_FILE_GRACE_SECONDS = 3600 # Files of no known job are removed once they are this old
+ASSET_RETENTION_DAYS = 7 # Stored assets no retained job references are dropped after this many idle days
+SEGMENT_RETENTION_DAYS = 14 # Segment manifests of jobs unused for this long are dropped (FULL and parts are kept)
+LEGACY_SEGMENT_FOLDER = "segment_cache" # Overlay cache of earlier versions, no longer read; removed by the sweeper
+RETENTION_SWEEP_INTERVAL = 600 # Seconds between background retention sweeps
 
 MAX_RETRY = 3 # New: Maximum number of print retries
+FTP_CONNECT_TIMEOUT = 10 # Seconds for connecting to a printer and for each FTP command
+FTP_PORT = 21 # Control port of the printers' FTP hot folders
+FTP_MAX_SESSIONS_PER_PRINTER = 2 # Open FTP sessions (busy or idle) allowed per printer IP
+FTP_SESSION_WAIT_TIMEOUT = 120 # Seconds a print waits for a free session slot before failing
+FTP_SESSION_IDLE_TIMEOUT = 300 # Idle pooled sessions unused for this long are logged out
+FTP_KEEPALIVE_INTERVAL = 30 # Seconds between NOOPs on idle pooled sessions
+PRINTER_FLEET_FILE = "printer_fleet.json" # Registered printers that continuous fleet mode spreads jobs across
+FLEET_DEFAULT_THROUGHPUT = 1024 * 1024 # Bytes/second assumed for a printer before any transfer to it is observed
+FLEET_THROUGHPUT_SMOOTHING = 0.3 # Weight of the latest transfer in a printer's throughput estimate
+RETRY_BACKOFF_BASE = 5 # Seconds before the first retry of a failed continuous job; doubles per retry
+RETRY_BACKOFF_MAX = 300 # Upper bound of the retry delay (before jitter)
+BREAKER_FAILURE_THRESHOLD = 3 # Consecutive failed prints that open a printer's circuit breaker
+BREAKER_OPEN_SECONDS = 60 # How long an opened breaker parks the printer's jobs; doubles per repeated trip
+BREAKER_MAX_OPEN_SECONDS = 900 # Upper bound of the parking time
+FTP_UPLOAD_BLOCK_SIZE = 256 * 1024 # Bytes read from disk and written to the data connection per step
+FTP_UPLOAD_READ_AHEAD = 4 # Blocks read ahead of the socket while the previous ones are being sent
+FLOW_INITIAL_WINDOW = 8 # Parts allowed to wait in a printer's hot folder before more are sent
+FLOW_MIN_WINDOW = 1
+FLOW_MAX_WINDOW = 32
+FLOW_ACCEPT_LATENCY_TARGET = 2.0 # Seconds for a printer to accept a STOR; slower acceptance halves the window
+FLOW_POLL_INTERVAL = 2.0 # Seconds between hot folder listings while waiting for spool room
+FLOW_MAX_WAIT = 600 # Seconds a part may wait for spool room before the print fails
+FLOW_REJECT_RETRIES = 3 # Times a part refused with a 4xx reply (spool full) is sent again after waiting
+PRINTER_LANE_WORKERS = 1 # Concurrent uploads per printer (fleet printers may set their own max_uploads)
 
 # --- Global Data Structures and Locks ---
 PRINT_JOBS = [] # Master list of all jobs
@@ -38,6 +106,31 @@ CONTINUOUS_QUEUE = [] # Queue of job IDs for continuous printing (Producer-Consu
 QUEUE_LOCK = threading.Lock()
 WORKER_THREAD = None # Reference to the persistent worker thread
 WORKER_STOP_EVENT = threading.Event() # Event to signal the worker to stop
+RETENTION_THREAD = None # Reference to the background retention sweeper
+RETENTION_STATS = {"sweeps": 0, "last_sweep": None, "usage_bytes": 0, "asset_usage_bytes": 0, "segment_usage_bytes": 0, "last_reclaimed_bytes": 0, "reclaimed_bytes_total": 0, "files_removed_total": 0}
+RETENTION_LOCK = threading.Lock() # One sweep at a time
+FONT_REGISTRY = OrderedDict() # sha256(TTF bytes) -> {'name', 'in_use'}, least recently used first
+FONT_REGISTRY_LOCK = threading.Lock()
+PARSED_ASSET_CACHE = OrderedDict() # sha256(PDF bytes) -> {'reader', 'lock'}, least recently used first
+PARSED_ASSET_LOCK = threading.Lock()
+MERGE_EXECUTOR = ThreadPoolExecutor(max_workers=MERGE_EXECUTOR_WORKERS, thread_name_prefix="MergeWorker")
+MERGE_ADMISSION = {"admitted": 0} # Merges running or waiting on MERGE_EXECUTOR
+MERGE_ADMISSION_LOCK = threading.Lock()
+MERGE_DURATIONS = deque(maxlen=20) # Seconds taken by recent merges, for Retry-After estimates
+FTP_POOL = {} # (printer_ip, ftp_user) -> idle sessions, most recently used last
+FTP_POOL_OPEN = {} # printer_ip -> sessions open (checked out or idle)
+FTP_POOL_CONDITION = threading.Condition() # Guards FTP_POOL/FTP_POOL_OPEN; notified when a session slot frees up
+FTP_POOL_STATS = {"logins": 0, "reuses": 0, "health_failures": 0, "discarded": 0, "idle_closed": 0}
+FTP_POOL_THREAD = None # Reference to the background keepalive thread
+PRINTER_FLEET = {} # printer_ip -> settings and observed load/throughput of one fleet printer
+PRINTER_FLEET_LOCK = threading.Lock()
+PRINTER_LANES = {} # printer_ip -> {'executor': ThreadPoolExecutor running that printer's uploads, 'threads', 'workers' (upload limit), 'active'}
+PRINTER_LANE_JOBS = {} # job_id -> printer_ip of jobs waiting or printing in a lane
+PRINTER_LANE_CONDITION = threading.Condition() # Guards the lanes; notified when a lane's upload slot frees up
+PRINTER_BREAKERS = {} # printer_ip -> circuit breaker state ('closed', 'open' or 'half_open') and failure counts
+PRINTER_BREAKER_LOCK = threading.Lock()
+PRINTER_FLOW = {} # printer_ip -> spool flow control state (window, estimated hot folder depth, acceptance latency)
+PRINTER_FLOW_LOCK = threading.Lock()
 
 # --- Persistence Functions ---
 
@@ -56,7 +149,6 @@ def save_jobs_to_file():
 
 def load_jobs_from_file():
     """Loads the PRINT_JOBS list from a JSON file in a thread-safe manner."""
-    global PRINT_JOBS
     if not os.path.exists(JOBS_DATA_FILE):
         logging.info(f"ℹ️ ملف {JOBS_DATA_FILE} غير موجود. بدء بقائمة وظائف فارغة.")
         return
@@ -73,64 +165,130 @@ def load_jobs_from_file():
                         if job['status'] == 'Printing':
                             job['status'] = 'Ready'
                             logging.warning(f"⚠️ تم إعادة تعيين حالة الوظيفة {job['id']} من 'Printing' إلى 'Ready' بعد تعطل الخادم.")
+                        # A merge interrupted by a restart cannot be resumed; it has to be submitted again
+                        elif job['status'] == 'Merging':
+                            job['status'] = 'Error'
+                            job['print_details'] = "فشل الدمج: توقف الخادم قبل اكتمال الدمج."
+                            logging.warning(f"⚠️ الوظيفة {job['id']} كانت قيد الدمج عند توقف الخادم. تم تعيينها إلى 'Error'.")
 
-                    PRINT_JOBS = data
+                    # Update in place: app_runtime holds a reference to this same list via its star import
+                    PRINT_JOBS[:] = data
                     logging.info(f"✅ تم تحميل {len(PRINT_JOBS)} وظيفة طباعة من {JOBS_DATA_FILE}.")
                 else:
                     logging.error(f"❌ محتوى {JOBS_DATA_FILE} غير صالح (ليس قائمة). بدء بقائمة فارغة.")
-                    PRINT_JOBS = []
+                    PRINT_JOBS[:] = []
         except json.JSONDecodeError as e:
             logging.error(f"❌ فشل تحليل JSON في {JOBS_DATA_FILE}: {e}. بدء بقائمة فارغة.", exc_info=True)
-            PRINT_JOBS = []
+            PRINT_JOBS[:] = []
         except Exception as e:
             logging.error(f"❌ خطأ غير متوقع أثناء تحميل {JOBS_DATA_FILE}: {e}. بدء بقائمة فارغة.", exc_info=True)
-            PRINT_JOBS = []
+            PRINT_JOBS[:] = []
+
+def save_printer_fleet():
+    """Saves PRINTER_FLEET to PRINTER_FLEET_FILE. Expected to be called while holding PRINTER_FLEET_LOCK."""
+    try:
+        temp_path = PRINTER_FLEET_FILE + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(PRINTER_FLEET.values()), f, ensure_ascii=False, indent=4)
+        os.replace(temp_path, PRINTER_FLEET_FILE)
+    except Exception as e:
+        logging.error(f"❌ فشل حفظ أسطول الطابعات إلى {PRINTER_FLEET_FILE}: {e}", exc_info=True)
+
+def load_printer_fleet():
+    """Loads the registered fleet printers; in-flight counters start from zero after a restart."""
+    if not os.path.exists(PRINTER_FLEET_FILE):
+        return
+    with PRINTER_FLEET_LOCK:
+        try:
+            with open(PRINTER_FLEET_FILE, 'r', encoding='utf-8') as f:
+                for printer in json.load(f):
+                    printer.update({"in_flight": 0, "queued_bytes": 0})
+                    PRINTER_FLEET[printer['ip']] = printer
+            logging.info(f"✅ تم تحميل {len(PRINTER_FLEET)} طابعة من أسطول الطابعات.")
+        except Exception as e:
+            logging.error(f"❌ فشل تحميل أسطول الطابعات من {PRINTER_FLEET_FILE}: {e}", exc_info=True)
 
 # --- Persistent Worker Thread Implementation (New Architecture) ---
 
+def dispatch_continuous_job(job_id: str) -> bool:
+    """
+    Hands one continuous job to the dispatch lane of its printer (the fleet printer picked for it
+    in fleet mode). Returns False when the job has to stay queued: its retry delay has not passed,
+    it is still in a lane from an earlier attempt, or its printer (every fleet printer) is parked
+    by a circuit breaker.
+    """
+    # Retrieve the full job data
+    job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
+    
+    if not job_found:
+        logging.error(f"❌ العامل المستمر: لم يتم العثور على بيانات الوظيفة ID: {job_id} في القائمة الرئيسية. تخطي.")
+        return True
+
+    # A failed attempt requeues its job just before its lane slot is freed
+    if job_in_print_lane(job_id) or job_found.get('not_before', 0) > time.time():
+        return False
+
+    # Check if the job is already being printed or was printed meanwhile (Concurrency Guard)
+    if job_found['status'] != 'Ready':
+        logging.warning(f"⚠️ العامل المستمر: الوظيفة ID: {job_id} في حالة '{job_found['status']}' وليست 'Ready'. تخطي.")
+        return True
+
+    if job_found.get('fleet'):
+        # Fleet mode: the printer is picked per job by load and throughput, skipping ones that failed it
+        job_bytes = job_transfer_bytes(job_found)
+        printer = select_fleet_printer(job_bytes, job_found.get('failed_printers', []))
+        if printer is None:
+            return False
+        with QUEUE_LOCK:
+            job_found['printer_ip'] = printer['ip']
+            job_found['ftp_user'] = printer['ftp_user']
+            job_found['ring_number'] = job_found.get('fleet_ring_number') or printer['ring_number']
+        logging.info(f"🔄 العامل المستمر: إرسال مهمة الطباعة ID: {job_id} إلى طابعة الأسطول {printer['ip']}.")
+        if not submit_print_job(job_id, printer['ip'], dispatch_fleet_job,
+                                job_id, printer, job_found['ring_number'], job_found.get('print_layout'), job_bytes):
+            release_fleet_printer(printer['ip'], job_bytes, None)
+            return False
+        return True
+
+    if not breaker_available(job_found.get('printer_ip')):
+        return False
+    logging.info(f"🔄 العامل المستمر: إرسال مهمة الطباعة ID: {job_id} إلى مسار الطابعة {job_found.get('printer_ip')}.")
+    return submit_print_job(job_id, job_found.get('printer_ip'), run_continuous_print,
+                            job_id, job_found.get('printer_ip'),
+                            (job_id,
+                             job_found.get('printer_ip'),
+                             job_found.get('ftp_user'),
+                             job_found.get('ftp_pwd', ''),
+                             job_found.get('ring_number'),
+                             True, # is_continuous flag remains True for worker-initiated jobs
+                             job_found.get('print_layout')))
+
 def print_queue_worker():
     """
     Dedicated persistent worker thread for continuous printing (Consumer).
-    It ensures continuous operation and manages job retries and flow control.
+    Every poll it moves the queued jobs into their printers' dispatch lanes, which bound how
+    many uploads run per printer; jobs that cannot be dispatched yet (waiting for a retry or
+    parked behind a printer's breaker) stay queued in order without holding up the others.
     """
-    global CONTINUOUS_QUEUE
+    waiting_count = 0
     while not WORKER_STOP_EVENT.is_set():
-        job_id = None
-        
         with QUEUE_LOCK:
-            if CONTINUOUS_QUEUE:
-                # Pop the next job ID from the front of the queue
-                job_id = CONTINUOUS_QUEUE.pop(0)
-            
-        if job_id:
-            logging.info(f"🔄 العامل المستمر: سحب مهمة الطباعة ID: {job_id} من قائمة الانتظار.")
-            
-            # Retrieve the full job data
-            job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
-            
-            if not job_found:
-                logging.error(f"❌ العامل المستمر: لم يتم العثور على بيانات الوظيفة ID: {job_id} في القائمة الرئيسية. تخطي.")
-                continue
+            # Take the whole queue; jobs that have to wait are put back in front of newly queued ones
+            pending = CONTINUOUS_QUEUE[:]
+            CONTINUOUS_QUEUE.clear()
 
-            # Check if the job is already being printed (Concurrency Guard)
-            if job_found['status'] == 'Printing':
-                logging.warning(f"⚠️ العامل المستمر: الوظيفة ID: {job_id} تم وضع علامة عليها بالفعل 'Printing'. تخطي (قد تكون قيد التشغيل بالفعل في موضوع آخر).")
-                continue
+        deferred = []
+        for job_id in pending:
+            if not dispatch_continuous_job(job_id):
+                deferred.append(job_id)
 
-            # Start the print job in a new non-recursive thread
-            thread_name = f"FTP_Continuous_Print_{job_id}"
-            ftp_thread = threading.Thread(
-                target=print_job_ftp,
-                args=(job_id, 
-                      job_found.get('printer_ip'),
-                      job_found.get('ftp_user'),
-                      job_found.get('ftp_pwd', ''),
-                      job_found.get('ring_number'),
-                      True # is_continuous flag remains True for worker-initiated jobs
-                      ),
-                name=thread_name
-            )
-            ftp_thread.start()
+        if deferred:
+            with QUEUE_LOCK:
+                CONTINUOUS_QUEUE[:0] = deferred
+        if len(deferred) != waiting_count:
+            waiting_count = len(deferred)
+            if waiting_count:
+                logging.info(f"⏸️ العامل المستمر: {waiting_count} وظيفة بانتظار موعد إعادة المحاولة أو عودة طابعتها.")
         
         # Sleep for a few seconds to avoid tight loop CPU spin
         time.sleep(3)
@@ -148,143 +306,2400 @@ def start_worker_thread():
 
 # --- Utility Functions (Unchanged) ---
 
-def register_custom_font(font_data: bytes) -> bool:
-    global FONT_REGISTERED, REGISTERED_FONT_NAME
-    if FONT_REGISTERED:
-        return True
+def register_custom_font(font_data: bytes, pin: bool = False):
+    """
+    Registers a TTF font with reportlab, keyed by the SHA-256 of its bytes, and returns its
+    registered name (None if the font cannot be parsed). Each distinct font is parsed once per
+    process; several fonts stay registered side by side and the least recently used unpinned
+    ones are evicted beyond MAX_REGISTERED_FONTS. With pin, the font is pinned (see custom_font)
+    under the same lock, so it cannot be evicted before the caller uses it.
+    """
+    font_hash = hashlib.sha256(font_data).hexdigest()
+    with FONT_REGISTRY_LOCK:
+        entry = FONT_REGISTRY.get(font_hash)
+        if entry is not None:
+            FONT_REGISTRY.move_to_end(font_hash)
+            if pin:
+                entry['in_use'] += 1
+            return entry['name']
+
+        font_name = f"{REGISTERED_FONT_NAME}-{font_hash[:12]}"
+        try:
+            font_stream = io.BytesIO(font_data)
+            pdfmetrics.registerFont(TTFont(font_name, font_stream))
+            pdfmetrics.registerFontFamily(font_name, normal=font_name)
+        except Exception as e:
+            logging.error("❌ فشل تسجيل الخط: %s", e, exc_info=True)
+            return None
+
+        FONT_REGISTRY[font_hash] = {'name': font_name, 'in_use': 1 if pin else 0}
+        logging.info(f"✅ تم تسجيل الخط العربي بنجاح باسم {font_name}.")
+        evict_unused_fonts(keep=font_hash)
+        return font_name
+
+def evict_unused_fonts(keep: str = None):
+    """
+    Drops least recently used fonts that no merge is using. The font keep (just registered) is
+    never dropped: when every other font is pinned the registry stays over MAX_REGISTERED_FONTS
+    until a merge finishes. Expects FONT_REGISTRY_LOCK to be held.
+    """
+    for font_hash in list(FONT_REGISTRY):
+        if len(FONT_REGISTRY) <= MAX_REGISTERED_FONTS:
+            break
+        entry = FONT_REGISTRY[font_hash]
+        if entry['in_use'] > 0 or font_hash == keep:
+            continue
+        del FONT_REGISTRY[font_hash]
+        unregister_reportlab_font(entry['name'])
+        logging.info(f"🧹 تم إخراج الخط غير المستخدم {entry['name']} من سجل الخطوط.")
+
+def unregister_reportlab_font(font_name: str):
+    """
+    Frees a font parsed by reportlab. reportlab has no public unregister, so this drops the
+    entries of its private font and typeface registries; if a reportlab release no longer has
+    them, the font simply stays registered.
+    """
+    fonts = getattr(pdfmetrics, '_fonts', None)
+    typefaces = getattr(pdfmetrics, '_typefaces', None)
+    if not isinstance(fonts, dict) or not isinstance(typefaces, dict):
+        logging.warning(f"⚠️ تعذر إلغاء تسجيل الخط {font_name}: سجل خطوط reportlab غير متوفر في هذا الإصدار.")
+        return
+    fonts.pop(font_name, None)
+    typefaces.pop(font_name, None)
+
+@contextmanager
+def custom_font(font_data: bytes):
+    """Registers (or reuses) a font and pins it against eviction for the duration of a merge."""
+    font_name = register_custom_font(font_data, pin=True)
+    if font_name is None:
+        yield None
+        return
+
+    font_hash = hashlib.sha256(font_data).hexdigest()
     try:
-        font_stream = io.BytesIO(font_data)
-        pdfmetrics.registerFont(TTFont(REGISTERED_FONT_NAME, font_stream))
-        pdfmetrics.registerFontFamily(REGISTERED_FONT_NAME, normal=REGISTERED_FONT_NAME)
-        FONT_REGISTERED = True
-        logging.info("✅ تم تسجيل الخط العربي بنجاح.")
-        return True
-    except Exception as e:
-        logging.error("❌ فشل تسجيل الخط: %s", e, exc_info=True)
-        FONT_REGISTERED = False
-        return False
+        yield font_name
+    finally:
+        with FONT_REGISTRY_LOCK:
+            entry = FONT_REGISTRY.get(font_hash)
+            if entry is not None:
+                entry['in_use'] -= 1
+            evict_unused_fonts()
+
+def resolve_font_name(font_data: bytes) -> str:
+    """Returns the registered name for font_data, falling back to a built-in font."""
+    return register_custom_font(font_data) or 'Helvetica-Bold'
+
+@lru_cache(maxsize=ARABIC_SHAPING_CACHE_SIZE)
+def shape_arabic_text(text: str) -> str:
+    """Cached reshaping + bidi reordering of one string; raises on shaping errors (which are not cached)."""
+    return get_display(arabic_reshaper.reshape(text))
 
 def process_arabic_text(text: str) -> str:
     if not text or not text.strip():
         return ''
     try:
-        reshaped_text = arabic_reshaper.reshape(text)
-        bidi_text = get_display(reshaped_text)
-        return bidi_text
+        return shape_arabic_text(text)
     except Exception as e:
         logging.error("خطأ في معالجة النص العربي '%s': %s", text[:20], e)
         return text
 
-def create_watermark(name: str, student_id: str, config: dict, font_data: bytes) -> io.BytesIO:
-    font_available = register_custom_font(font_data)
-    font_name = REGISTERED_FONT_NAME if font_available else 'Helvetica-Bold'
+def process_arabic_texts(texts: list) -> list:
+    """
+    Batch form of process_arabic_text for a whole roster column. Each distinct string is shaped
+    once (and served from the LRU cache across merges); failures fall back to the raw text and
+    are reported in a single log line for the batch.
+    """
+    texts = [text if text is None or isinstance(text, str) else str(text) for text in texts]
+    shaped = {}
+    failures = []
+    for text in texts:
+        if text in shaped:
+            continue
+        if not text or not text.strip():
+            shaped[text] = ''
+            continue
+        try:
+            shaped[text] = shape_arabic_text(text)
+        except Exception as e:
+            shaped[text] = text
+            failures.append((text[:20], e))
+
+    if failures:
+        logging.error("خطأ في معالجة %d نص عربي (أول الأمثلة: %s)", len(failures), failures[:3])
+    return [shaped[text] for text in texts]
+
+def get_arabic_shaping_stats() -> dict:
+    """Hit/miss counters of the Arabic shaping cache."""
+    info = shape_arabic_text.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+
+def resolve_student_stamp(student: dict, config: dict) -> tuple:
+    """Returns the (name, student_id) pair stamped on a student's cover page."""
+    name = student.get(config['name_key'], 'غير متوفر')
+    student_id = student.get(config['id_key'], 'غير متوفر')
+    return name, student_id
+
+def create_watermark_batch(stamps: list, config: dict, font_name: str) -> PdfReader:
+    """
+    Renders every (name, student_id) stamp as one page of a single overlay document.
+    The font is embedded once and the overlay is parsed once for the whole batch,
+    instead of one canvas + PdfReader round-trip per student.
+    """
     font_size = 12
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=A4)
-    
-    processed_name = process_arabic_text(name)
-    processed_id = str(student_id)
 
     name_x = float(config.get('name_x', 375))
     name_y = float(config.get('name_y', 452.5))
     id_x = float(config.get('id_x', 400))
     id_y = float(config.get('id_y', 422.5))
 
-    can.setFont(font_name, font_size)
-    can.setFillColorRGB(0, 0, 0)
-    can.drawRightString(name_x, name_y, processed_name)
+    # The whole name column is shaped in one call before drawing starts
+    shaped_names = process_arabic_texts([name for name, _ in stamps])
+
+    for (_, student_id), shaped_name in zip(stamps, shaped_names):
+        can.setFont(font_name, font_size)
+        can.setFillColorRGB(0, 0, 0)
+        can.drawRightString(name_x, name_y, shaped_name)
+
+        can.setFont(font_name, font_size)
+        can.drawString(id_x, id_y, str(student_id))
+        can.showPage()
 
-    can.setFont(font_name, font_size)
-    can.drawString(id_x, id_y, processed_id) 
-    
     can.save()
     packet.seek(0)
-    return packet
+    return PdfReader(packet)
+
+def build_cover_template(writer: PdfWriter, cover_page) -> dict:
+    """
+    Wraps the cover page content in a form XObject stored once in the writer.
+    Every stamped cover then draws that shared XObject followed by its own
+    overlay stream, so the cover content is never re-parsed or re-merged per student.
+    """
+    cover_contents = cover_page.get_contents()
+    cover_xobject = DecodedStreamObject()
+    cover_xobject.set_data(cover_contents.get_data() if cover_contents is not None else b"")
+    cover_xobject.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): cover_page.mediabox,
+        NameObject("/Resources"): cover_page.get("/Resources", DictionaryObject()).clone(writer),
+    })
+    cover_xobject = cover_xobject.flate_encode()
+
+    draw_cover = DecodedStreamObject()
+    draw_cover.set_data(f"q {COVER_XOBJECT_NAME} Do Q\n".encode("ascii"))
+
+    return {
+        "page": cover_page,
+        "xobject": writer._add_object(cover_xobject),
+        "draw_cover": writer._add_object(draw_cover),
+    }
+
+def append_student_packets(writer: PdfWriter, stamps: list, cover_template: dict, exam_pages: list, config: dict, font_name: str) -> int:
+    """
+    Appends one packet (stamped cover + exam pages) per stamp to the writer.
+    Overlays for the whole batch are rendered in one pass; returns the number of pages added.
+    The cover_template objects are referenced rather than cloned, so the template may live in
+    a longer-lived writer when the pages are streamed out chunk by chunk.
+    """
+    if not stamps:
+        return 0
+
+    overlay_reader = create_watermark_batch(stamps, config, font_name)
+
+    # All overlay pages share one font dictionary, so a single resources object serves the batch.
+    stamped_resources = overlay_reader.pages[0].get("/Resources", DictionaryObject()).clone(writer)
+    stamped_resources[NameObject("/XObject")] = DictionaryObject({
+        NameObject(COVER_XOBJECT_NAME): cover_template["xobject"]
+    })
+    stamped_resources_ref = writer._add_object(stamped_resources)
+
+    pages_added = 0
+    for overlay_page in overlay_reader.pages:
+        cover_page = writer.add_page(cover_template["page"], excluded_keys=["/Contents", "/Resources"])
+        cover_page[NameObject("/Contents")] = ArrayObject([
+            cover_template["draw_cover"],
+            overlay_page.raw_get("/Contents").clone(writer),
+        ])
+        cover_page[NameObject("/Resources")] = stamped_resources_ref
+        pages_added += 1
+
+        for page in exam_pages:
+            writer.add_page(page)
+            pages_added += 1
+
+    return pages_added
+
+# --- Content-Addressed Asset Store ---
+
+def is_asset_hash(value) -> bool:
+    return isinstance(value, str) and re.fullmatch(r"[0-9a-f]{64}", value) is not None
 
-def split_pdf_ranges(job_id: str, pdf_data: io.BytesIO, pages_per_part: int) -> int:
+def touch_asset(path: str):
+    """Marks a stored asset as used now; the retention sweeper drops assets idle for ASSET_RETENTION_DAYS."""
     try:
-        reader = PdfReader(pdf_data)
-        total_pages = len(reader.pages)
-        part_count = 0
-        
-        full_filename = f"{job_id}_FULL.pdf"
-        # Ensure OUTPUT_FOLDER exists
-        if not os.path.exists(OUTPUT_FOLDER):
-            os.makedirs(OUTPUT_FOLDER)
-        
-        with open(os.path.join(OUTPUT_FOLDER, full_filename), "wb") as f:
-            pdf_data.seek(0)
-            f.write(pdf_data.read())
-
-        for i in range(0, total_pages, pages_per_part):
-            writer = PdfWriter()
-            end_page = min(i + pages_per_part, total_pages)
-            for page_num in range(i, end_page):
-                writer.add_page(reader.pages[page_num])
-            
-            part_count += 1
-            part_filename = f"{job_id}_P{part_count:03}.pdf"
-            with open(os.path.join(OUTPUT_FOLDER, part_filename), "wb") as f:
-                writer.write(f)
+        os.utime(path)
+    except FileNotFoundError:
+        pass # Swept in the meantime; the caller fails on open
+
+def store_asset(data: bytes) -> str:
+    """Stores an uploaded asset under ASSET_FOLDER/<sha256> (once) and returns its hash."""
+    asset_hash = hashlib.sha256(data).hexdigest()
+    path = os.path.join(ASSET_FOLDER, asset_hash)
+    if os.path.exists(path):
+        touch_asset(path)
+    else:
+        os.makedirs(ASSET_FOLDER, exist_ok=True)
+        # Use a temporary file for atomic write
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        logging.info(f"📦 تم تخزين أصل جديد {asset_hash[:12]} ({len(data)} بايت).")
+    return asset_hash
+
+def store_asset_file(source) -> str:
+    """
+    Streaming counterpart of store_asset for uploaded files (e.g. a large roster): copies the
+    file object block by block while hashing it, so the upload is never held in memory.
+    """
+    os.makedirs(ASSET_FOLDER, exist_ok=True)
+    digest = hashlib.sha256()
+    temp_path = os.path.join(ASSET_FOLDER, f"upload.{threading.get_ident()}.tmp")
+    size = 0
+    with open(temp_path, "wb") as f:
+        for block in iter(lambda: source.read(ASSET_COPY_BLOCK_SIZE), b""):
+            digest.update(block)
+            f.write(block)
+            size += len(block)
+    asset_hash = digest.hexdigest()
+    path = os.path.join(ASSET_FOLDER, asset_hash)
+    if os.path.exists(path):
+        os.remove(temp_path)
+        touch_asset(path)
+    else:
+        os.replace(temp_path, path)
+        logging.info(f"📦 تم تخزين أصل جديد {asset_hash[:12]} ({size} بايت).")
+    return asset_hash
+
+def asset_path(asset_hash: str) -> str:
+    """Path of a stored asset. Raises FileNotFoundError for unknown or malformed hashes."""
+    if not is_asset_hash(asset_hash):
+        raise FileNotFoundError(f"معرّف الأصل غير صالح: {asset_hash}")
+    path = os.path.join(ASSET_FOLDER, asset_hash)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"الأصل {asset_hash} غير موجود في مخزن الأصول.")
+    touch_asset(path)
+    return path
+
+def asset_size(asset_hash: str):
+    """
+    Returns the stored size of an asset, or None if it is not in the store. A found asset counts
+    as used: a client that skips its upload after this check will reference it in a merge next.
+    """
+    if not is_asset_hash(asset_hash):
+        return None
+    path = os.path.join(ASSET_FOLDER, asset_hash)
+    if not os.path.exists(path):
+        return None
+    touch_asset(path)
+    return os.path.getsize(path)
+
+def load_asset(asset_hash: str) -> bytes:
+    """Reads a stored asset by hash. Raises FileNotFoundError for unknown or malformed hashes."""
+    with open(asset_path(asset_hash), "rb") as f:
+        return f.read()
+
+@contextmanager
+def checkout_pdf_reader(pdf_bytes: bytes):
+    """
+    Yields a parsed PdfReader for pdf_bytes for the exclusive use of one merge.
+    Readers of hot assets are kept in an LRU cache keyed by content hash, so repeat merges
+    reuse the already-parsed objects. A reader is never shared by two merges at once (the
+    streaming writer temporarily renumbers its references); if the cached one is busy, a
+    private reader is parsed instead.
+    """
+    asset_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    with PARSED_ASSET_LOCK:
+        entry = PARSED_ASSET_CACHE.get(asset_hash)
+        if entry is None:
+            entry = {"reader": PdfReader(io.BytesIO(pdf_bytes)), "lock": threading.Lock()}
+            PARSED_ASSET_CACHE[asset_hash] = entry
+        PARSED_ASSET_CACHE.move_to_end(asset_hash)
+        while len(PARSED_ASSET_CACHE) > PARSED_ASSET_CACHE_SIZE:
+            PARSED_ASSET_CACHE.popitem(last=False)
+
+    if entry["lock"].acquire(blocking=False):
+        try:
+            yield entry["reader"]
+        finally:
+            entry["lock"].release()
+    else:
+        yield PdfReader(io.BytesIO(pdf_bytes))
+
+# --- Student Roster Ingestion ---
+
+def detect_roster_format(path: str, filename: str = None) -> str:
+    """
+    Picks the roster format from the uploaded file name, or else from the first
+    non-blank byte of the file: '[' is a JSON array, '{' is NDJSON, anything else is CSV
+    (TSV when its header line has tabs but no commas).
+    """
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension in ('.ndjson', '.jsonl'):
+        return 'ndjson'
+    if extension == '.csv':
+        return 'csv'
+    if extension == '.tsv':
+        return 'tsv'
+    if extension == '.json':
+        return 'json'
+
+    with open(path, "rb") as f:
+        head = f.read(ROSTER_READ_SIZE).lstrip(codecs.BOM_UTF8 + b" \t\r\n")
+    if head.startswith(b"["):
+        return 'json'
+    if head.startswith(b"{"):
+        return 'ndjson'
+    header_line = head.split(b"\n", 1)[0]
+    if b"\t" in header_line and b"," not in header_line:
+        return 'tsv'
+    return 'csv'
+
+def iter_json_array_records(text_stream):
+    """
+    Incrementally decodes a JSON array of objects, yielding one record at a time.
+    Only the unparsed tail of the file is buffered, never the whole array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    at_eof = False
+    started = False
+
+    while True:
+        # Skip whitespace and the commas separating records
+        while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == ',')):
+            position += 1
+        if position == len(buffer):
+            if at_eof:
+                raise ValueError("ملف بيانات الطلاب غير مكتمل: لم يتم إغلاق مصفوفة JSON.")
+            buffer = text_stream.read(ROSTER_READ_SIZE)
+            position = 0
+            at_eof = not buffer
+            continue
+
+        if not started:
+            if buffer[position] != '[':
+                raise ValueError("ملف بيانات الطلاب بصيغة JSON يجب أن يكون مصفوفة.")
+            started = True
+            position += 1
+            continue
+
+        if buffer[position] == ']':
+            return
+
+        try:
+            record, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if at_eof:
+                raise
+            # The record continues past the buffered text: keep the tail and read more
+            chunk = text_stream.read(ROSTER_READ_SIZE)
+            at_eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield record
+
+def iter_ndjson_records(text_stream):
+    """Yields one record per non-blank line of a newline-delimited JSON roster."""
+    for line in text_stream:
+        if line.strip():
+            yield json.loads(line)
+
+def iter_csv_records(text_stream, fields: tuple, delimiter: str = ','):
+    """
+    Yields the requested columns of each CSV row. Rows are read with csv.reader and only
+    the columns named in fields are kept, so unused columns are never collected into dicts.
+    """
+    reader = csv.reader(text_stream, delimiter=delimiter)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [(field, header.index(field)) for field in fields if field in header]
+    for row in reader:
+        if row:
+            yield {field: row[index] for field, index in columns if index < len(row)}
+
+def iter_roster_students(path: str, roster_format: str, config: dict):
+    """
+    Streams the students of a roster file, lazily and in file order. Each record is reduced
+    to the name_key/id_key fields the covers are stamped with.
+    """
+    fields = (config['name_key'], config['id_key'])
+    with open(path, "r", encoding="utf-8-sig", newline="") as text_stream:
+        if roster_format == 'csv':
+            records = iter_csv_records(text_stream, fields)
+        elif roster_format == 'tsv':
+            records = iter_csv_records(text_stream, fields, delimiter='\t')
+        elif roster_format == 'ndjson':
+            records = iter_ndjson_records(text_stream)
+        else:
+            records = iter_json_array_records(text_stream)
+
+        for record in records:
+            if not isinstance(record, dict):
+                raise ValueError("كل سجل في ملف بيانات الطلاب يجب أن يكون كائنًا.")
+            yield {field: record[field] for field in fields if field in record}
+
+def roster_has_students(path: str, roster_format: str, config: dict) -> bool:
+    """Parses only as far as the first student, to reject empty rosters before merging."""
+    return next(iter_roster_students(path, roster_format, config), None) is not None
+
+def iter_stamp_chunks(stamps, chunk_size: int):
+    """Groups any iterable of stamps into lists of at most chunk_size, consuming it lazily."""
+    stamps = iter(stamps)
+    while True:
+        chunk = list(islice(stamps, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+# --- Merge Pipeline (Serial and Process-Pool) ---
+
+MERGE_WORKER_STATE = {} # Per-process assets installed by init_merge_worker in pool workers
+
+def init_merge_worker(cover_pdf_bytes: bytes, font_data: bytes, config: dict):
+    """Pool initializer: parses the shared assets once per worker process instead of once per chunk."""
+    MERGE_WORKER_STATE['cover_page'] = PdfReader(io.BytesIO(cover_pdf_bytes)).pages[0]
+    MERGE_WORKER_STATE['font_name'] = resolve_font_name(font_data)
+    MERGE_WORKER_STATE['config'] = config
+
+def merge_students_chunk(stamps: list) -> bytes:
+    """
+    Pool task: stamps the covers of one chunk of students and returns them as PDF bytes.
+    Exam pages are interleaved by the parent so their objects are stored only once.
+    """
+    writer = PdfWriter()
+    cover_template = build_cover_template(writer, MERGE_WORKER_STATE['cover_page'])
+    append_student_packets(writer, stamps, cover_template, [],
+                           MERGE_WORKER_STATE['config'], MERGE_WORKER_STATE['font_name'])
+    chunk_stream = io.BytesIO()
+    writer.write(chunk_stream)
+    return chunk_stream.getvalue()
+
+def iter_stamped_cover_chunks(stamps, cover_template: dict, cover_pdf_bytes: bytes, font_data: bytes, config: dict, workers: int = 1, chunk_size: int = MERGE_BATCH_SIZE):
+    """
+    Yields the stamped cover pages chunk by chunk, in student order (one cover per student).
+    stamps may be any iterable (e.g. a roster still being parsed); it is consumed one chunk
+    at a time. Serial chunks are stamped into a fresh PdfWriter whose covers reference the
+    shared cover_template objects; parallel chunks are stamped in a process pool, with at
+    most two chunks per worker in flight so memory stays bounded.
+    """
+    chunks = iter_stamp_chunks(stamps, chunk_size)
+
+    if workers <= 1:
+        font_name = resolve_font_name(font_data)
+        for chunk in chunks:
+            chunk_writer = PdfWriter()
+            append_student_packets(chunk_writer, chunk, cover_template, [], config, font_name)
+            yield chunk_writer.pages
+        return
+
+    logging.info(f"⚙️ دمج متوازي على {workers} عملية (حتى {chunk_size} طالب لكل جزء).")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_merge_worker,
+                             initargs=(cover_pdf_bytes, font_data, config)) as executor:
+        in_flight = deque()
+        chunks_left = True
+        while chunks_left or in_flight:
+            while chunks_left and len(in_flight) < workers * 2:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    chunks_left = False
+                    break
+                in_flight.append(executor.submit(merge_students_chunk, chunk))
+            if not in_flight:
+                break
+            # Futures are consumed in submission order, preserving the student order
+            chunk_bytes = in_flight.popleft().result()
+            yield PdfReader(io.BytesIO(chunk_bytes)).pages
+
+def report_progress(progress: dict, key: str, amount: int = 1):
+    """Advances a progress counter of a merge job (no-op when the caller does not track progress)."""
+    if progress is not None:
+        progress[key] = progress.get(key, 0) + amount
+
+def interleave_exam_pages(cover_pages: list, exam_pages: list) -> list:
+    """Expands stamped covers into full student packets: each cover followed by the exam pages."""
+    packet_pages = []
+    for cover_page in cover_pages:
+        packet_pages.append(cover_page)
+        packet_pages.extend(exam_pages)
+    return packet_pages
+
+def build_merged_writer(stamps, cover_pdf_bytes: bytes, exam_pdf_bytes: bytes, font_data: bytes, config: dict, workers: int = 1, exam_reader: PdfReader = None, progress: dict = None) -> PdfWriter:
+    """
+    Builds the merged document for all stamps (any iterable) in memory. With workers > 1 the covers are
+    stamped in contiguous chunks in a process pool and concatenated in the original student
+    order, so the page order is identical to the serial path. An already-parsed exam_reader
+    (see checkout_pdf_reader) is used instead of parsing exam_pdf_bytes again.
+    """
+    final_pdf_writer = PdfWriter()
+    cover_page = PdfReader(io.BytesIO(cover_pdf_bytes)).pages[0]
+    if exam_reader is None:
+        exam_reader = PdfReader(io.BytesIO(exam_pdf_bytes))
+    exam_pages = list(exam_reader.pages)
+    cover_template = build_cover_template(final_pdf_writer, cover_page)
+
+    if workers <= 1:
+        font_name = resolve_font_name(font_data)
+        for chunk in iter_stamp_chunks(stamps, MERGE_BATCH_SIZE):
+            append_student_packets(final_pdf_writer, chunk, cover_template, exam_pages, config, font_name)
+            report_progress(progress, 'students_stamped', len(chunk))
+        return final_pdf_writer
+
+    for cover_pages in iter_stamped_cover_chunks(stamps, cover_template, cover_pdf_bytes, font_data, config, workers):
+        for page in interleave_exam_pages(cover_pages, exam_pages):
+            final_pdf_writer.add_page(page)
+        report_progress(progress, 'students_stamped', len(cover_pages))
+
+    return final_pdf_writer
+
+def stream_merged_document(full_path: str, stamps, cover_pdf_bytes: bytes, exam_pdf_bytes: bytes, font_data: bytes, config: dict, workers: int = 1, exam_reader: PdfReader = None, progress: dict = None, part_layout: dict = None) -> dict:
+    """
+    Streaming counterpart of build_merged_writer: every chunk of MERGE_BATCH_SIZE students is
+    flushed to full_path as soon as it is assembled, so memory stays bounded by the batch size
+    rather than the roster size. The exam reader and the cover template are shared sources:
+    their content streams, fonts and images are written once and referenced by every packet.
+    With a part_layout ({'job_id', 'pages_per_part', 'students_per_part'}) the print parts are
+    cut from the same chunks as they are written. Returns the page count, the part manifest and
+    the peak RSS sampled during the run.
+    """
+    if exam_reader is None:
+        exam_reader = PdfReader(io.BytesIO(exam_pdf_bytes))
+    exam_pages = list(exam_reader.pages)
+    template_writer = PdfWriter()
+    cover_template = build_cover_template(template_writer, PdfReader(io.BytesIO(cover_pdf_bytes)).pages[0])
+
+    stream_state = open_streaming_pdf(full_path, shared_sources=(exam_reader, template_writer))
+    part_state = None
+    if part_layout is not None:
+        part_state = open_part_writer(part_layout['job_id'], os.path.dirname(full_path), part_layout['pages_per_part'],
+                                      part_layout.get('students_per_part'), (exam_reader, template_writer))
+    memory_samples = [get_memory_usage_mb()]
+    try:
+        for cover_pages in iter_stamped_cover_chunks(stamps, cover_template, cover_pdf_bytes, font_data, config, workers, MERGE_BATCH_SIZE):
+            packet_pages = interleave_exam_pages(cover_pages, exam_pages)
+            stream_pdf_pages(stream_state, packet_pages)
+            report_progress(progress, 'students_stamped', len(cover_pages))
+            report_progress(progress, 'pages_written', len(packet_pages))
+            if part_state is not None:
+                emit_part_packets(part_state, split_student_packets(packet_pages, 1 + len(exam_pages)), progress)
+            memory_samples.append(get_memory_usage_mb())
+    finally:
+        close_streaming_pdf(stream_state)
+
+    memory_samples = [sample for sample in memory_samples if sample is not None]
+    return {
+        "page_count": len(stream_state["page_refs"]),
+        "parts": close_part_writer(part_state, progress) if part_state is not None else [],
+        "peak_memory_mb": max(memory_samples) if memory_samples else None,
+    }
+
+# --- Streaming PDF Output ---
+
+def get_memory_usage_mb():
+    """Returns the current resident memory of this process in MB, or None where it cannot be read."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # Fallback (macOS/BSD): process high-water mark, reported in bytes on macOS
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024), 1)
+    return None
+
+def open_streaming_pdf(path, shared_sources: tuple = (), track_objects: bool = False, first_obj: int = STREAM_PAGES_OBJ + 1) -> dict:
+    """
+    Opens a PDF file for incremental writing. Objects 1 and 2 are reserved for the catalog and page tree.
+    Objects of the shared_sources (readers/writers that outlive the stream) are written at most once
+    and every later reference to them reuses the same output object.
+    path may also be a writable binary file object (e.g. io.BytesIO), which is left open on close.
+    With track_objects, the length of every object and the objects it references are recorded
+    (stream_state['objects']), so objects can later be copied byte for byte (copy_pdf_objects).
+    New objects are numbered from first_obj, above the numbers of objects copied from another file.
+    """
+    owns_file = isinstance(path, str)
+    f = open(path, "wb") if owns_file else path
+    f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    return {
+        "path": path if owns_file else None,
+        "file": f,
+        "owns_file": owns_file,
+        "offsets": {},
+        "next_obj": first_obj,
+        "page_refs": [],
+        "shared_sources": {id(source): source for source in shared_sources},
+        "shared_mapping": {}, # (id(shared source), source idnum) -> output object number
+        "objects": {} if track_objects else None, # object number -> [offset, length, referenced object numbers]
+    }
+
+def stream_pdf_pages(stream_state: dict, pages: list) -> int:
+    """
+    Appends pages, and every object reachable from them, to an open streaming PDF.
+    References are renumbered into the output numbering only while the objects are written
+    and restored afterwards, so the source document is left untouched and can be released.
+    Pages of shared sources get a fresh page object per occurrence, but everything below
+    them (contents, resources) is shared. Returns the number of objects written.
+    """
+    local_mapping = {} # (id(source pdf), source idnum) -> output object number, for this call only
+    pending = [] # (output object number, object) in write order
+    renumbered = [] # (IndirectObject, original idnum, original generation)
+    seen_refs = set()
+
+    def allocate(obj) -> int:
+        number = stream_state["next_obj"]
+        stream_state["next_obj"] += 1
+        pending.append((number, obj))
+        return number
+
+    def output_number(ref) -> int:
+        key = (id(ref.pdf), ref.idnum)
+        mapping = stream_state["shared_mapping"] if key[0] in stream_state["shared_sources"] else local_mapping
+        if key not in mapping:
+            target = ref.get_object()
+            if isinstance(target, DictionaryObject) and target.get("/Type") == "/Pages":
+                # Page tree nodes of the source collapse into the single output page tree
+                mapping[key] = STREAM_PAGES_OBJ
+            elif isinstance(target, DictionaryObject) and target.get("/Type") == "/Catalog":
+                mapping[key] = STREAM_CATALOG_OBJ
+            else:
+                mapping[key] = allocate(target)
+        return mapping[key]
+
+    for page in pages:
+        if id(page.indirect_reference.pdf) in stream_state["shared_sources"]:
+            # A page object may appear only once in the page tree, so repeated pages are re-emitted
+            stream_state["page_refs"].append(allocate(page))
+        else:
+            stream_state["page_refs"].append(output_number(page.indirect_reference))
+
+    references = {} # output object number -> output numbers it references (with track_objects)
+    index = 0
+    while index < len(pending):
+        number, obj = pending[index]
+        refs = references[number] = []
+        stack = [obj]
+        index += 1
+        while stack:
+            container = stack.pop()
+            values = container.values() if isinstance(container, dict) else container
+            for value in values:
+                if isinstance(value, IndirectObject):
+                    if id(value) not in seen_refs:
+                        seen_refs.add(id(value))
+                        new_number = output_number(value)
+                        renumbered.append((value, value.idnum, value.generation))
+                        value.idnum, value.generation = new_number, 0
+                    refs.append(value.idnum)
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+
+    f = stream_state["file"]
+    objects = stream_state["objects"]
+    try:
+        for number, obj in pending:
+            offset = stream_state["offsets"][number] = f.tell()
+            f.write(f"{number} 0 obj\n".encode("ascii"))
+            obj.write_to_stream(f)
+            f.write(b"\nendobj\n")
+            if objects is not None:
+                objects[number] = [offset, f.tell() - offset, sorted(set(references[number]))]
+    finally:
+        for ref, idnum, generation in renumbered:
+            ref.idnum, ref.generation = idnum, generation
+
+    return len(pending)
+
+def close_streaming_pdf(stream_state: dict):
+    """Writes the page tree, catalog, cross-reference table and trailer, then closes the file (if it opened it)."""
+    f = stream_state["file"]
+    offsets = stream_state["offsets"]
+    page_refs = stream_state["page_refs"]
+
+    offsets[STREAM_PAGES_OBJ] = f.tell()
+    f.write(f"{STREAM_PAGES_OBJ} 0 obj\n<< /Type /Pages /Count {len(page_refs)} /Kids [".encode("ascii"))
+    for number in page_refs:
+        f.write(f" {number} 0 R".encode("ascii"))
+    f.write(b" ] >>\nendobj\n")
+
+    offsets[STREAM_CATALOG_OBJ] = f.tell()
+    f.write(f"{STREAM_CATALOG_OBJ} 0 obj\n<< /Type /Catalog /Pages {STREAM_PAGES_OBJ} 0 R >>\nendobj\n".encode("ascii"))
+
+    # One xref subsection per run of consecutive object numbers: files with copied objects
+    # (copy_pdf_objects) keep their source numbering and may skip numbers
+    xref_offset = f.tell()
+    numbers = sorted(offsets)
+    f.write(b"xref\n0 1\n0000000000 65535 f \n")
+    run_start = 0
+    for position in range(1, len(numbers) + 1):
+        if position == len(numbers) or numbers[position] != numbers[position - 1] + 1:
+            f.write(f"{numbers[run_start]} {position - run_start}\n".encode("ascii"))
+            for number in numbers[run_start:position]:
+                f.write(f"{offsets[number]:010} 00000 n \n".encode("ascii"))
+            run_start = position
+    size = numbers[-1] + 1
+    f.write(f"trailer\n<< /Size {size} /Root {STREAM_CATALOG_OBJ} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+    if stream_state["owns_file"]:
+        f.close()
+
+def pdf_object_closure(objects: dict, roots, present=()) -> list:
+    """
+    Object numbers reachable from roots in a tracked object table (see open_streaming_pdf),
+    in ascending order. The catalog and page tree are left out (every file writes its own), and
+    so is anything in present, together with what it references (it was copied with it).
+    """
+    reached = set()
+    stack = list(roots)
+    while stack:
+        number = stack.pop()
+        if number in reached or number in present or number in (STREAM_CATALOG_OBJ, STREAM_PAGES_OBJ):
+            continue
+        reached.add(number)
+        stack.extend(objects[number][2])
+    return sorted(reached)
+
+def copy_pdf_objects(stream_state: dict, source_file, source_objects: dict, numbers: list):
+    """
+    Copies objects byte for byte, keeping their numbers, from a file written with track_objects
+    into an open streaming PDF. Nothing is parsed or serialized again, so this is far cheaper
+    than stream_pdf_pages for objects that are already in PDF form.
+    """
+    f = stream_state["file"]
+    objects = stream_state["objects"]
+    for number in numbers:
+        source_offset, length, refs = source_objects[number]
+        source_file.seek(source_offset)
+        offset = stream_state["offsets"][number] = f.tell()
+        f.write(source_file.read(length))
+        if objects is not None:
+            objects[number] = [offset, length, refs]
+
+# --- Print Part Output ---
+
+def open_part_writer(job_id: str, output_dir: str, pages_per_part: int, students_per_part: int = None, shared_sources: tuple = ()) -> dict:
+    """
+    Cuts {job_id}_P###.pdf print parts into output_dir (the job's directory) while the merge assembles its
+    pages, so the merged document is never parsed a second time. With students_per_part, every
+    part holds that many whole student packets (a staple never spans two students); otherwise
+    parts are cut every pages_per_part pages. shared_sources are passed to each part's
+    streaming writer. The written parts are recorded in part_state['parts'] (the part manifest).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    return {
+        "job_id": job_id,
+        "output_dir": output_dir,
+        "pages_per_part": pages_per_part,
+        "students_per_part": students_per_part,
+        "shared_sources": shared_sources,
+        "pending_pages": [],
+        "pending_students": 0,
+        "pages_written": 0,
+        "parts": [],
+    }
+
+def part_file_name(job_id: str, number: int) -> str:
+    """File name of a job's part number (1-based)."""
+    return f"{job_id}_P{number:03}.pdf"
+
+def write_part_file(part_state: dict, pages: list, progress: dict = None):
+    """
+    Writes one part with the streaming writer (the pages' objects are copied, not re-parsed)
+    and appends its manifest entry: file name, page range in the merged document, size and SHA-256.
+    """
+    part_filename = part_file_name(part_state['job_id'], len(part_state['parts']) + 1)
+    part_path = os.path.join(part_state["output_dir"], part_filename)
+    stream_state = open_streaming_pdf(part_path, part_state["shared_sources"])
+    try:
+        stream_pdf_pages(stream_state, pages)
+    finally:
+        close_streaming_pdf(stream_state)
+
+    with open(part_path, "rb") as f:
+        checksum = hashlib.file_digest(f, "sha256").hexdigest()
+    start = part_state["pages_written"]
+    part_state["pages_written"] += len(pages)
+    part_state["parts"].append({
+        "file": part_filename,
+        "pages": [start, part_state["pages_written"]],
+        "size": os.path.getsize(part_path),
+        "sha256": checksum,
+    })
+    report_progress(progress, 'parts_split')
+
+def emit_part_packets(part_state: dict, packets: list, progress: dict = None):
+    """Feeds student packets (each a list of pages, in order) and writes every part they complete."""
+    pending = part_state["pending_pages"]
+    for packet in packets:
+        pending.extend(packet)
+        part_state["pending_students"] += 1
+        if part_state["students_per_part"]:
+            if part_state["pending_students"] == part_state["students_per_part"]:
+                write_part_file(part_state, pending, progress)
+                pending.clear()
+                part_state["pending_students"] = 0
+        else:
+            while len(pending) >= part_state["pages_per_part"]:
+                write_part_file(part_state, pending[:part_state["pages_per_part"]], progress)
+                del pending[:part_state["pages_per_part"]]
+
+def close_part_writer(part_state: dict, progress: dict = None) -> list:
+    """Writes the last, shorter part if pages are left over and returns the part manifest."""
+    if part_state["pending_pages"]:
+        write_part_file(part_state, part_state["pending_pages"], progress)
+        part_state["pending_pages"] = []
+    logging.info(f"✅ تم تقسيم المهمة {part_state['job_id']} إلى {len(part_state['parts'])} جزء.")
+    return part_state["parts"]
+
+def split_student_packets(pages: list, packet_size: int) -> list:
+    """Groups consecutive merged pages into per-student packets of packet_size pages."""
+    return [pages[i:i + packet_size] for i in range(0, len(pages), packet_size)]
+
+def compute_part_ranges(page_count: int, packet_pages: int, pages_per_part: int, students_per_part: int = None) -> list:
+    """
+    Page-range manifest of a job: [start, end) of every part, cut exactly as the part writer
+    cuts them (whole packets with students_per_part, otherwise every pages_per_part pages).
+    """
+    step = students_per_part * packet_pages if students_per_part else pages_per_part
+    return [[start, min(start + step, page_count)] for start in range(0, page_count, step)]
+
+def job_output_dir(job_id: str) -> str:
+    """Every job keeps its FULL file and parts in its own OUTPUT_FOLDER/<job_id>/ directory."""
+    return os.path.join(OUTPUT_FOLDER, job_id)
+
+def job_part_path(job: dict, part: dict) -> str:
+    """Path of a manifest entry; parts live next to the job's FULL file (flat OUTPUT_FOLDER for older jobs)."""
+    return os.path.join(os.path.dirname(job['full_path']), part['file'])
+
+def legacy_part_manifest(job: dict) -> list:
+    """
+    Builds the manifest of a job merged before manifests were recorded, from its flat
+    {job_id}_P###.pdf files. Runs once per such job; the result is stored on the job.
+    """
+    prefix = f"{job['id']}_P"
+    part_files = sorted((f for f in os.listdir(OUTPUT_FOLDER) if f.startswith(prefix) and f[len(prefix):-4].isdigit()),
+                        key=lambda f: int(f[len(prefix):-4]))
+    parts = []
+    for filename in part_files:
+        with open(os.path.join(OUTPUT_FOLDER, filename), "rb") as f:
+            checksum = hashlib.file_digest(f, "sha256").hexdigest()
+        parts.append({"file": filename, "pages": None, "size": os.path.getsize(os.path.join(OUTPUT_FOLDER, filename)), "sha256": checksum})
+    return parts
+
+def materialize_job_parts(job_id: str, pages_per_part: int = None, students_per_part: int = None) -> list:
+    """
+    Returns the paths of the part files to print for a job, in order, cutting them from the
+    merged document first if needed. Parts are cut on demand when the job was merged lazily or
+    is printed with a different layout than the one already on disk; matching parts are reused.
+    pages_per_part/students_per_part default to the layout chosen at merge time.
+    Only the files named in the job's part manifest are touched; OUTPUT_FOLDER is never listed.
+    """
+    with QUEUE_LOCK:
+        job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
+        if not job_found:
+            raise FileNotFoundError(f"لم يتم العثور على الوظيفة {job_id}.")
+        job = dict(job_found)
+
+    if 'page_count' not in job:
+        # Jobs merged before the page manifest existed can only print the parts already on disk
+        if 'parts' not in job:
+            job['parts'] = legacy_part_manifest(job)
+            with QUEUE_LOCK:
+                job_found['parts'] = job['parts']
+                save_jobs_to_file()
+        if not job['parts']:
+            raise FileNotFoundError(f"لم يتم العثور على ملفات جزئية للوظيفة {job_id}.")
+        return [job_part_path(job, part) for part in job['parts']]
+
+    if pages_per_part is None and students_per_part is None:
+        pages_per_part, students_per_part = job['pages_per_part'], job.get('students_per_part')
+    layout = {"pages_per_part": pages_per_part, "students_per_part": students_per_part}
+
+    if job.get('materialized_layout') == layout and job.get('parts'):
+        return [job_part_path(job, part) for part in job['parts']]
+
+    full_path = job['full_path']
+    if 'full' in job.get('artifacts_evicted', []):
+        raise FileNotFoundError(f"تم حذف ملفات الوظيفة {job_id} ضمن سياسة الاحتفاظ بالمساحة. يرجى إعادة الدمج.")
+    if not os.path.exists(full_path):
+        raise FileNotFoundError(f"ملف الـ PDF المدمج للوظيفة {job_id} غير موجود.")
+
+    # Parts cut for another layout are removed first, so no stale part is ever printed
+    for part in job.get('parts', []):
+        stale_path = job_part_path(job, part)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    part_ranges = compute_part_ranges(job['page_count'], job['packet_pages'], pages_per_part, students_per_part)
+    with open(full_path, "rb") as source_file:
+        reader = PdfReader(source_file)
+        part_state = open_part_writer(job_id, os.path.dirname(full_path), pages_per_part, students_per_part)
+        for start, end in part_ranges:
+            write_part_file(part_state, [reader.pages[index] for index in range(start, end)])
+    parts = part_state["parts"]
+    logging.info(f"✂️ تم قص {len(parts)} جزء للوظيفة {job_id} عند الطباعة ({layout}).")
+
+    with QUEUE_LOCK:
+        job_found['parts'] = parts
+        job_found['part_count'] = len(parts)
+        job_found['materialized_layout'] = layout
+        if 'parts' in job_found.get('artifacts_evicted', []):
+            job_found['artifacts_evicted'].remove('parts')
+        save_jobs_to_file()
+    return [job_part_path(job, part) for part in parts]
+
+def prints_from_part_files(job: dict, pages_per_part: int = None, students_per_part: int = None) -> bool:
+    """
+    True when a print in this layout (default: the merge layout) sends part files even if it is
+    spool-less: the job was merged before page manifests existed, or its part files in this layout
+    are already on disk (merged without lazy_parts, or cut by an earlier print). Spool-less printing
+    only cuts in memory the parts that have no file yet.
+    """
+    if 'page_count' not in job:
+        return True
+    if pages_per_part is None and students_per_part is None:
+        pages_per_part, students_per_part = job['pages_per_part'], job.get('students_per_part')
+    layout = {"pages_per_part": pages_per_part, "students_per_part": students_per_part}
+    return job.get('materialized_layout') == layout and bool(job.get('parts'))
+
+def plan_streamed_parts(job_id: str, pages_per_part: int = None, students_per_part: int = None):
+    """
+    Spool-less printing: the parts a print sends without writing them as files first. Returns
+    (layout, {part path: [start, end)}) with the paths the part files would have, so part
+    progress and resume work exactly as for part files; each part is cut from the merged
+    document in memory while it is uploaded (render_part_bytes). Returns None when the job has
+    to print from part files (see prints_from_part_files).
+    """
+    with QUEUE_LOCK:
+        job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
+        if not job_found:
+            raise FileNotFoundError(f"لم يتم العثور على الوظيفة {job_id}.")
+        job = dict(job_found)
+
+    if prints_from_part_files(job, pages_per_part, students_per_part):
+        return None
+    if pages_per_part is None and students_per_part is None:
+        pages_per_part, students_per_part = job['pages_per_part'], job.get('students_per_part')
+    layout = {"pages_per_part": pages_per_part, "students_per_part": students_per_part}
+
+    full_path = job['full_path']
+    if 'full' in job.get('artifacts_evicted', []):
+        raise FileNotFoundError(f"تم حذف ملفات الوظيفة {job_id} ضمن سياسة الاحتفاظ بالمساحة. يرجى إعادة الدمج.")
+    if not os.path.exists(full_path):
+        raise FileNotFoundError(f"ملف الـ PDF المدمج للوظيفة {job_id} غير موجود.")
+
+    part_ranges = compute_part_ranges(job['page_count'], job['packet_pages'], pages_per_part, students_per_part)
+    if job.get('part_count') != len(part_ranges):
+        # The job card counts the parts of the layout being printed, as for parts cut at print time
+        with QUEUE_LOCK:
+            job_found['part_count'] = len(part_ranges)
+            save_jobs_to_file()
+    output_dir = os.path.dirname(full_path)
+    return layout, {os.path.join(output_dir, part_file_name(job_id, number)): part_pages
+                    for number, part_pages in enumerate(part_ranges, 1)}
+
+def render_part_bytes(reader: PdfReader, part_pages: list) -> bytes:
+    """Cuts pages [start, end) of the merged document into an in-memory part PDF."""
+    buffer = io.BytesIO()
+    stream_state = open_streaming_pdf(buffer)
+    try:
+        stream_pdf_pages(stream_state, [reader.pages[index] for index in range(*part_pages)])
+    finally:
+        close_streaming_pdf(stream_state)
+    return buffer.getvalue()
 
-        logging.info(f"✅ تم تقسيم المهمة {job_id} إلى {part_count} جزء.")
-        return part_count
+# --- Incremental Re-Merge (Student Segment Splicing) ---
+
+def segment_signature(cover_pdf_bytes: bytes, exam_pdf_bytes: bytes, font_data: bytes, config: dict) -> str:
+    """
+    What every student segment of a merge depends on besides the student: cover, exam, font and
+    stamp layout. Only merges with the same signature can splice each other's segments.
+    """
+    layout = [float(config.get(key, default)) for key, default in
+              (('name_x', 375), ('name_y', 452.5), ('id_x', 400), ('id_y', 422.5))]
+    key_fields = [hashlib.sha256(data).hexdigest() for data in (cover_pdf_bytes, exam_pdf_bytes, font_data)] + [layout]
+    return hashlib.sha256(json.dumps(key_fields).encode("utf-8")).hexdigest()
+
+def student_segment_key(stamp: tuple) -> str:
+    """A student's segment key: the stamped name and id (the rest is covered by the segment signature)."""
+    name, student_id = stamp
+    return hashlib.sha256(json.dumps([str(name), str(student_id)], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def segment_manifest_path(job: dict) -> str:
+    return os.path.join(os.path.dirname(job['full_path']), SEGMENT_MANIFEST_FILE)
+
+def find_segment_base(signature: str):
+    """
+    The most recent merged job with the same segment signature whose FULL file and segment
+    manifest are still on disk, loaded for splicing; None if there is none. The job is marked
+    as used so the retention sweeper keeps it longest.
+    """
+    with QUEUE_LOCK:
+        candidates = [job for job in PRINT_JOBS if job.get('segment_signature') == signature
+                      and job['status'] not in ('Merging', 'Error') and 'full' not in job.get('artifacts_evicted', [])]
+    for job in candidates:
+        manifest_path = segment_manifest_path(job)
+        if not (os.path.exists(job['full_path']) and os.path.exists(manifest_path)):
+            continue
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"⚠️ تعذر قراءة مقاطع الوظيفة {job['id']}: {e}")
+            continue
+        with QUEUE_LOCK:
+            job['last_used'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "job_id": job['id'],
+            "full_path": job['full_path'],
+            "next_obj": manifest['next_obj'],
+            "objects": {int(number): entry for number, entry in manifest['objects'].items()},
+            "shared": manifest['shared'],
+            "students": {key: pages for key, pages in manifest['students']},
+        }
+    return None
+
+def splice_merged_document(full_path: str, stamps, cover_pdf_bytes: bytes, font_data: bytes, config: dict, workers: int = 1, exam_reader: PdfReader = None, progress: dict = None, base: dict = None) -> dict:
+    """
+    Incremental counterpart of stream_merged_document. The FULL file is streamed chunk by chunk
+    with every object tracked, and a segment manifest (each student's key and page objects, each
+    object's offset, length and references) is written next to it. With a base (find_segment_base),
+    students already in the base merge are not stamped: their objects are copied byte for byte
+    from the base FULL file, keeping their object numbers, and only new or changed students are
+    stamped (serially, since they are few). Returns the page count, the page object numbers,
+    the object table, the number of spliced students and the peak RSS.
+    """
+    exam_pages = list(exam_reader.pages)
+    packet_pages = 1 + len(exam_pages)
+    template_writer = PdfWriter()
+    cover_template = build_cover_template(template_writer, PdfReader(io.BytesIO(cover_pdf_bytes)).pages[0])
+    font_name = resolve_font_name(font_data)
+
+    shared_sources = (exam_reader, template_writer)
+    stream_state = open_streaming_pdf(full_path, shared_sources, track_objects=True,
+                                      first_obj=base['next_obj'] if base else STREAM_PAGES_OBJ + 1)
+    page_refs = stream_state["page_refs"]
+    students = [] # [segment key, page object numbers] per student, in roster order
+    spliced = 0
+    memory_samples = [get_memory_usage_mb()]
+
+    def stream_packets(cover_pages: list) -> list:
+        """Writes stamped covers with their exam pages; returns the page numbers of each packet."""
+        first = len(page_refs)
+        stream_pdf_pages(stream_state, interleave_exam_pages(cover_pages, exam_pages))
+        packets = split_student_packets(page_refs[first:], packet_pages)
+        del page_refs[first:]
+        return packets
+
+    base_file = open(base['full_path'], 'rb') if base else None
+    try:
+        if base is not None:
+            # The exam and cover template objects keep the base numbers (same signature, same sources),
+            # so spliced and newly stamped students share a single copy of them
+            for index, idnum, number in base['shared']:
+                stream_state["shared_mapping"][(id(shared_sources[index]), idnum)] = number
+            copy_pdf_objects(stream_state, base_file, base['objects'],
+                             pdf_object_closure(base['objects'], [number for _, _, number in base['shared']]))
+
+        if base is None:
+            keys = deque()
+            def keyed(stamps):
+                for stamp in stamps:
+                    keys.append(student_segment_key(stamp))
+                    yield stamp
+            for cover_pages in iter_stamped_cover_chunks(keyed(stamps), cover_template, cover_pdf_bytes, font_data, config, workers, MERGE_BATCH_SIZE):
+                for packet in stream_packets(cover_pages):
+                    page_refs.extend(packet)
+                    students.append([keys.popleft(), packet])
+                report_progress(progress, 'students_stamped', len(cover_pages))
+                report_progress(progress, 'pages_written', len(cover_pages) * packet_pages)
+                memory_samples.append(get_memory_usage_mb())
+        else:
+            spliced_keys = set() # A student listed twice is stamped again: a page object may appear only once
+            for chunk in iter_stamp_chunks(stamps, MERGE_BATCH_SIZE):
+                keys = [student_segment_key(stamp) for stamp in chunk]
+                cached = []
+                for key in keys:
+                    cached.append(key in base['students'] and key not in spliced_keys)
+                    if cached[-1]:
+                        spliced_keys.add(key)
+                new_stamps = [stamp for stamp, hit in zip(chunk, cached) if not hit]
+                new_packets = iter(())
+                if new_stamps:
+                    chunk_writer = PdfWriter()
+                    append_student_packets(chunk_writer, new_stamps, cover_template, [], config, font_name)
+                    new_packets = iter(stream_packets(list(chunk_writer.pages)))
+                for key, hit in zip(keys, cached):
+                    if hit:
+                        packet = base['students'][key]
+                        copy_pdf_objects(stream_state, base_file, base['objects'],
+                                         pdf_object_closure(base['objects'], packet, stream_state["offsets"]))
+                        spliced += 1
+                    else:
+                        packet = next(new_packets)
+                    page_refs.extend(packet)
+                    students.append([key, packet])
+                report_progress(progress, 'students_stamped', len(chunk))
+                report_progress(progress, 'pages_written', len(chunk) * packet_pages)
+                memory_samples.append(get_memory_usage_mb())
+    finally:
+        close_streaming_pdf(stream_state)
+        if base_file is not None:
+            base_file.close()
+
+    manifest_path = os.path.join(os.path.dirname(full_path), SEGMENT_MANIFEST_FILE)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        source_index = {id(source): index for index, source in enumerate(shared_sources)}
+        shared = [[source_index[source_id], idnum, number] for (source_id, idnum), number in stream_state["shared_mapping"].items()]
+        json.dump({"next_obj": stream_state["next_obj"], "shared": shared, "students": students, "objects": stream_state["objects"]}, f)
+    os.replace(temp_path, manifest_path)
+
+    memory_samples = [sample for sample in memory_samples if sample is not None]
+    return {
+        "page_count": len(page_refs),
+        "page_refs": page_refs,
+        "objects": stream_state["objects"],
+        "spliced": spliced,
+        "peak_memory_mb": max(memory_samples) if memory_samples else None,
+    }
+
+def cut_parts_by_copy(job_id: str, full_path: str, objects: dict, page_refs: list, part_ranges: list, progress: dict = None) -> list:
+    """
+    Cuts the print parts of a FULL file written with track_objects by copying, for each part,
+    the objects its pages reach straight from the FULL file (copy_pdf_objects); no page is
+    parsed or serialized again. Returns the part manifest, in the format of write_part_file.
+    """
+    output_dir = os.path.dirname(full_path)
+    parts = []
+    with open(full_path, 'rb') as source_file:
+        for number, (start, end) in enumerate(part_ranges, 1):
+            part_filename = part_file_name(job_id, number)
+            part_path = os.path.join(output_dir, part_filename)
+            part_pages = page_refs[start:end]
+            stream_state = open_streaming_pdf(part_path)
+            try:
+                copy_pdf_objects(stream_state, source_file, objects, pdf_object_closure(objects, part_pages))
+                stream_state["page_refs"].extend(part_pages)
+            finally:
+                close_streaming_pdf(stream_state)
+            with open(part_path, "rb") as f:
+                checksum = hashlib.file_digest(f, "sha256").hexdigest()
+            parts.append({"file": part_filename, "pages": [start, end], "size": os.path.getsize(part_path), "sha256": checksum})
+            report_progress(progress, 'parts_split')
+    logging.info(f"✅ تم تقسيم المهمة {job_id} إلى {len(parts)} جزء.")
+    return parts
+
+# --- Output Retention (Disk Budget Sweeper) ---
+
+def job_last_used(job: dict) -> datetime:
+    """Last time a job's artifacts were produced, printed or downloaded (older records fall back to their timestamps)."""
+    for key in ('last_used', 'end_time', 'timestamp'):
+        if job.get(key):
+            try:
+                return datetime.strptime(job[key], "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                continue
+    return datetime.min
+
+def job_is_active(job: dict) -> bool:
+    """Jobs being merged, printed or waiting in the continuous queue are never swept."""
+    return job['status'] in ('Merging', 'Printing') or job['id'] in CONTINUOUS_QUEUE
+
+def evict_job_artifacts(job: dict, files_by_job: dict, include_full: bool) -> tuple:
+    """
+    Deletes a job's part files (and its FULL file and segment manifest with include_full) and marks
+    the job record. Parts evicted while the FULL file is kept are cut again on the next print.
+    Expected to be called while holding QUEUE_LOCK. Returns (bytes reclaimed, files removed).
+    """
+    full_path = job.get('full_path')
+    kept_with_full = (full_path, segment_manifest_path(job)) if full_path else ()
+    if include_full:
+        job.pop('segment_signature', None)
+    reclaimed = 0
+    removed = 0
+    for path, size in list(files_by_job.get(job['id'], {}).items()):
+        if path in kept_with_full and not include_full:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        del files_by_job[job['id']][path]
+        reclaimed += size
+        removed += 1
+
+    if include_full and os.path.dirname(full_path or "") == job_output_dir(job['id']):
+        try:
+            os.rmdir(job_output_dir(job['id']))
+        except OSError:
+            pass # Not empty or already gone
+
+    evicted = job.setdefault('artifacts_evicted', [])
+    if 'parts' not in evicted:
+        evicted.append('parts')
+    if include_full and 'full' not in evicted:
+        evicted.append('full')
+    job['parts'] = []
+    job['materialized_layout'] = None
+    job['evicted_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return reclaimed, removed
+
+def evict_segment_manifest(job: dict, files_by_job: dict) -> tuple:
+    """
+    Deletes a job's segment manifest, so later merges no longer splice from it; the FULL file and
+    parts are kept. Expected to be called while holding QUEUE_LOCK. Returns (bytes reclaimed, files removed).
+    """
+    job.pop('segment_signature', None)
+    path = segment_manifest_path(job)
+    size = files_by_job.get(job['id'], {}).pop(path, None)
+    if size is None:
+        return 0, 0
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return size, 1
+
+def sweep_output_folder() -> dict:
+    """
+    One retention pass over OUTPUT_FOLDER:
+    1. age policies: parts of 'Printed' jobs after PRINTED_PARTS_RETENTION_DAYS, segment manifests
+       of jobs unused for SEGMENT_RETENTION_DAYS, everything of 'Printed'/'Error' jobs unused for
+       FINISHED_JOB_RETENTION_DAYS, stale orphan files and the LEGACY_SEGMENT_FOLDER;
+    2. disk budget: while above OUTPUT_DISK_BUDGET_MB, least recently used jobs lose their parts
+       first (they can be cut again from FULL), then finished jobs lose their FULL file and
+       segment manifest too (segment manifests count against the budget);
+    3. the asset store: unreferenced assets idle for ASSET_RETENTION_DAYS (sweep_asset_store).
+    'Ready' jobs keep their FULL file, since it has not been printed yet.
+    Only the top level of OUTPUT_FOLDER is listed: a known job's directory is sized from its
+    manifest, while directories and flat files of unknown jobs are orphans. Returns what was reclaimed.
+    """
+    with RETENTION_LOCK:
+        now = datetime.now()
+        files_by_job = {} # job id -> {path: size}
+        orphans = [] # (path, size, file count)
+        if os.path.exists(OUTPUT_FOLDER):
+            with QUEUE_LOCK:
+                manifests = {job['id']: [job.get('full_path')] + [job_part_path(job, part) for part in job.get('parts', [])]
+                             + ([segment_manifest_path(job)] if job.get('full_path') else [])
+                             for job in PRINT_JOBS}
+            with os.scandir(OUTPUT_FOLDER) as entries:
+                for entry in entries:
+                    stat = entry.stat()
+                    if entry.is_dir():
+                        if entry.name in manifests:
+                            job_files = files_by_job.setdefault(entry.name, {})
+                            for path in manifests[entry.name]:
+                                if path and os.path.dirname(path) == entry.path and os.path.exists(path):
+                                    job_files[path] = os.path.getsize(path)
+                        elif now.timestamp() - stat.st_mtime > ORPHAN_FILE_GRACE_SECONDS:
+                            with os.scandir(entry.path) as job_entries:
+                                sizes = [job_entry.stat().st_size for job_entry in job_entries if job_entry.is_file()]
+                            orphans.append((entry.path, sum(sizes), len(sizes)))
+                        continue
+                    # Flat files are left by jobs merged before per-job directories existed
+                    job_id = entry.name.split("_")[0]
+                    if job_id in manifests:
+                        files_by_job.setdefault(job_id, {})[entry.path] = stat.st_size
+                    elif now.timestamp() - stat.st_mtime > ORPHAN_FILE_GRACE_SECONDS:
+                        orphans.append((entry.path, stat.st_size, 1))
+
+        reclaimed = 0
+        removed = 0
+        for path, size, count in orphans:
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                reclaimed += size
+                removed += count
+            except FileNotFoundError:
+                pass
+
+        if os.path.isdir(LEGACY_SEGMENT_FOLDER):
+            with os.scandir(LEGACY_SEGMENT_FOLDER) as legacy_entries:
+                sizes = [legacy_entry.stat().st_size for legacy_entry in legacy_entries if legacy_entry.is_file()]
+            shutil.rmtree(LEGACY_SEGMENT_FOLDER, ignore_errors=True)
+            reclaimed += sum(sizes)
+            removed += len(sizes)
+            logging.info(f"🧹 تم حذف ذاكرة المقاطع القديمة {LEGACY_SEGMENT_FOLDER} ({len(sizes)} ملف).")
+
+        budget_bytes = OUTPUT_DISK_BUDGET_MB * 1024 * 1024
+        with QUEUE_LOCK:
+            candidates = sorted((job for job in PRINT_JOBS if job['id'] in files_by_job), key=job_last_used)
+
+            # 1. Age policies
+            for job in candidates:
+                if job_is_active(job):
+                    continue
+                age_days = (now - job_last_used(job)).total_seconds() / 86400
+                if age_days > SEGMENT_RETENTION_DAYS and job.get('segment_signature'):
+                    freed = evict_segment_manifest(job, files_by_job)
+                    reclaimed += freed[0]
+                    removed += freed[1]
+                if job['status'] in ('Printed', 'Error') and age_days > FINISHED_JOB_RETENTION_DAYS:
+                    freed = evict_job_artifacts(job, files_by_job, include_full=True)
+                elif job['status'] == 'Printed' and age_days > PRINTED_PARTS_RETENTION_DAYS and 'page_count' in job:
+                    freed = evict_job_artifacts(job, files_by_job, include_full=False)
+                else:
+                    continue
+                reclaimed += freed[0]
+                removed += freed[1]
+
+            # 2. Disk budget, least recently used first
+            usage = sum(sum(files.values()) for files in files_by_job.values())
+            for include_full in (False, True):
+                for job in candidates:
+                    if usage <= budget_bytes:
+                        break
+                    if job_is_active(job) or not files_by_job.get(job['id']):
+                        continue
+                    if include_full and job['status'] not in ('Printed', 'Error'):
+                        continue
+                    if not include_full and 'page_count' not in job:
+                        continue # Parts of jobs without a manifest cannot be cut again
+                    freed = evict_job_artifacts(job, files_by_job, include_full)
+                    usage -= freed[0]
+                    reclaimed += freed[0]
+                    removed += freed[1]
+            if removed:
+                save_jobs_to_file()
+            segment_usage = sum(size for files in files_by_job.values() for path, size in files.items()
+                                if os.path.basename(path) == SEGMENT_MANIFEST_FILE)
+
+        asset_reclaimed, asset_removed, asset_usage = sweep_asset_store(now)
+        reclaimed += asset_reclaimed
+        removed += asset_removed
+
+        if usage > budget_bytes:
+            logging.warning(f"⚠️ مجلد المخرجات لا يزال فوق الميزانية ({usage // (1024 * 1024)} MB > {OUTPUT_DISK_BUDGET_MB} MB) بسبب وظائف جاهزة أو قيد التنفيذ.")
+
+        RETENTION_STATS['sweeps'] += 1
+        RETENTION_STATS['last_sweep'] = now.strftime("%Y-%m-%d %H:%M:%S")
+        RETENTION_STATS['usage_bytes'] = usage
+        RETENTION_STATS['asset_usage_bytes'] = asset_usage
+        RETENTION_STATS['segment_usage_bytes'] = segment_usage
+        RETENTION_STATS['last_reclaimed_bytes'] = reclaimed
+        RETENTION_STATS['reclaimed_bytes_total'] += reclaimed
+        RETENTION_STATS['files_removed_total'] += removed
+        if removed:
+            logging.info(f"🧹 تنظيف المخرجات: تم حذف {removed} ملف واسترجاع {reclaimed // 1024} KB (الاستخدام الحالي: {usage // (1024 * 1024)} MB).")
+        return dict(RETENTION_STATS)
+
+def sweep_asset_store(now: datetime) -> tuple:
+    """
+    Drops stored assets (cover, exam, font, roster) that no retained job references and that
+    were not uploaded or used for ASSET_RETENTION_DAYS, plus stale temporary upload files.
+    A job references its assets until its FULL file is evicted. Expected to be called while
+    holding RETENTION_LOCK. Returns (bytes reclaimed, files removed, bytes still stored).
+    """
+    if not os.path.exists(ASSET_FOLDER):
+        return 0, 0, 0
+    with QUEUE_LOCK:
+        referenced = {asset_hash for job in PRINT_JOBS if 'full' not in job.get('artifacts_evicted', [])
+                      for asset_hash in job.get('asset_hashes', {}).values()}
+    reclaimed = 0
+    removed = 0
+    usage = 0
+    with os.scandir(ASSET_FOLDER) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            idle_seconds = now.timestamp() - stat.st_mtime
+            if is_asset_hash(entry.name):
+                stale = entry.name not in referenced and idle_seconds > ASSET_RETENTION_DAYS * 86400
+            else:
+                stale = idle_seconds > ORPHAN_FILE_GRACE_SECONDS # Temporary file of an interrupted upload
+            if not stale:
+                usage += stat.st_size
+                continue
+            try:
+                os.remove(entry.path)
+                reclaimed += stat.st_size
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return reclaimed, removed, usage
+
+def retention_sweeper():
+    """Background retention thread: sweeps OUTPUT_FOLDER every RETENTION_SWEEP_INTERVAL seconds."""
+    while not WORKER_STOP_EVENT.wait(RETENTION_SWEEP_INTERVAL):
+        try:
+            sweep_output_folder()
+        except Exception as e:
+            logging.error(f"❌ فشل تنظيف مجلد المخرجات: {e}", exc_info=True)
+
+def start_retention_sweeper():
+    """Starts the background retention sweeper thread."""
+    global RETENTION_THREAD
+    if RETENTION_THREAD is None or not RETENTION_THREAD.is_alive():
+        RETENTION_THREAD = threading.Thread(target=retention_sweeper, name="RetentionSweeper")
+        RETENTION_THREAD.daemon = True
+        RETENTION_THREAD.start()
+        logging.info("🚀 بدأ تشغيل خيط تنظيف المخرجات (RetentionSweeper).")
+
+# --- Asynchronous Merge Jobs ---
+
+def allocate_job_id() -> str:
+    """
+    Returns a timestamp job ID that no job or output file uses yet; merges submitted within the
+    same second get a -2, -3, ... suffix. Expected to be called while holding QUEUE_LOCK, with the
+    new job inserted into PRINT_JOBS before the lock is released.
+    """
+    base_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    existing_ids = {job['id'] for job in PRINT_JOBS}
+    job_id = base_id
+    sequence = 1
+    while job_id in existing_ids or os.path.exists(job_output_dir(job_id)) or os.path.exists(os.path.join(OUTPUT_FOLDER, f"{job_id}_FULL.pdf")):
+        sequence += 1
+        job_id = f"{base_id}-{sequence}"
+    return job_id
+
+def reserve_merge_slot() -> bool:
+    """
+    Admission control for /api/merge: at most MERGE_EXECUTOR_WORKERS merges run and
+    MERGE_QUEUE_LIMIT wait. Returns False when both are taken, so the request can be refused
+    before its uploads are parsed. A reserved slot is released by release_merge_slot.
+    """
+    with MERGE_ADMISSION_LOCK:
+        if MERGE_ADMISSION["admitted"] >= MERGE_EXECUTOR_WORKERS + MERGE_QUEUE_LIMIT:
+            return False
+        MERGE_ADMISSION["admitted"] += 1
+        return True
+
+def release_merge_slot():
+    with MERGE_ADMISSION_LOCK:
+        MERGE_ADMISSION["admitted"] = max(0, MERGE_ADMISSION["admitted"] - 1)
+
+def estimate_merge_retry_after() -> int:
+    """Seconds until a merge slot is likely to free up, from the durations of recent merges."""
+    with MERGE_ADMISSION_LOCK:
+        admitted = MERGE_ADMISSION["admitted"]
+        durations = list(MERGE_DURATIONS)
+    if not durations:
+        return MERGE_RETRY_AFTER_DEFAULT
+    average = sum(durations) / len(durations)
+    # The queue drains MERGE_EXECUTOR_WORKERS merges at a time
+    waves = max(1, admitted - MERGE_EXECUTOR_WORKERS + 1) / MERGE_EXECUTOR_WORKERS
+    return max(1, int(average * waves + 0.999))
+
+def get_merge_queue_stats() -> dict:
+    with MERGE_ADMISSION_LOCK:
+        admitted = MERGE_ADMISSION["admitted"]
+    return {
+        "admitted": admitted,
+        "running": min(admitted, MERGE_EXECUTOR_WORKERS),
+        "waiting": max(0, admitted - MERGE_EXECUTOR_WORKERS),
+        "workers": MERGE_EXECUTOR_WORKERS,
+        "queue_limit": MERGE_QUEUE_LIMIT,
+    }
+
+def run_merge_job(job_id: str, merge_request: dict):
+    """
+    Background merge on MERGE_EXECUTOR: stamps, writes and splits one job while publishing
+    progress on its PRINT_JOBS record. The job stays 'Merging' until it turns 'Ready',
+    or 'Error' (with the reason in print_details) if the merge fails. The roster is parsed
+    lazily, so the first covers are stamped before the rest of the roster has been read.
+    """
+    with QUEUE_LOCK:
+        job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
+    if not job_found:
+        logging.error(f"❌ لم يتم العثور على وظيفة الدمج ID: {job_id}.")
+        return
+
+    started_at = time.time()
+    with QUEUE_LOCK:
+        job_found['print_details'] = "جاري الدمج..."
+    progress = job_found['progress']
+    config = merge_request['config']
+    cover_pdf_bytes = merge_request['cover_pdf']
+    exam_pdf_bytes = merge_request['exam_pdf']
+    font_ttf_bytes = merge_request['font_ttf']
+    merge_workers = merge_request['merge_workers']
+    pages_per_part = merge_request['pages_per_part']
+    students_per_part = merge_request.get('students_per_part')
+    lazy_parts = merge_request.get('lazy_parts', LAZY_PARTS)
+    # Lazy mode writes only the merged document; parts are cut by materialize_job_parts at print time
+    part_layout = None if lazy_parts else {
+        "job_id": job_id,
+        "pages_per_part": pages_per_part,
+        "students_per_part": students_per_part,
+    }
+
+    try:
+        # The font is registered once per distinct TTF and pinned against eviction while this merge runs;
+        # the exam reader comes from the parsed-asset cache when this exam was merged recently
+        with custom_font(font_ttf_bytes) as font_name, checkout_pdf_reader(exam_pdf_bytes) as exam_reader:
+            if not font_name:
+                raise ValueError("فشل في تسجيل الخط العربي.")
+
+            logging.info(f"بدء دمج الطلاب ({merge_request['roster_format']}) مع الغلاف وصفحات الامتحان... (الوظيفة: {job_id}، عمليات الدمج: {merge_workers}، بث مباشر للقرص: {bool(merge_request['stream_output'])})")
+
+            # All overlays are rendered in one pass per chunk and applied to clones of the single parsed cover page
+            students = iter_roster_students(merge_request['roster_path'], merge_request['roster_format'], config)
+            stamps = (resolve_student_stamp(student, config) for student in counted_students(students, progress))
+            # Every artifact of the job lives in its own directory under OUTPUT_FOLDER
+            full_path = job_found['full_path']
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            parts = []
+            spliced = None
+
+            if merge_request['incremental']:
+                # Incremental mode: students of the last merge with the same cover, exam, font and stamp
+                # layout are copied from its FULL file; only new or changed students are stamped.
+                # The FULL file is always streamed, and parts are cut by copying objects, not pages.
+                base = find_segment_base(segment_signature(cover_pdf_bytes, exam_pdf_bytes, font_ttf_bytes, config))
+                merge_stats = splice_merged_document(full_path, stamps, cover_pdf_bytes, font_ttf_bytes, config, merge_workers, exam_reader, progress, base)
+                peak_memory_mb = merge_stats['peak_memory_mb']
+                page_count = merge_stats['page_count']
+                spliced = merge_stats['spliced']
+                if part_layout is not None:
+                    part_ranges = compute_part_ranges(page_count, 1 + len(exam_reader.pages), pages_per_part, students_per_part)
+                    parts = cut_parts_by_copy(job_id, full_path, merge_stats['objects'], merge_stats['page_refs'], part_ranges, progress)
+                if base is not None:
+                    logging.info(f"♻️ إعادة دمج تزايدية من الوظيفة {base['job_id']}: تم نسخ {spliced} طالب وختم {page_count // (1 + len(exam_reader.pages)) - spliced} طالب جديد.")
+                merge_stats = None # The object table is no longer needed
+            elif merge_request['stream_output']:
+                # Streaming mode: completed chunks are flushed straight to the FULL file on disk
+                # and the print parts are cut from the same chunks
+                merge_stats = stream_merged_document(full_path, stamps, cover_pdf_bytes, exam_pdf_bytes, font_ttf_bytes, config, merge_workers, exam_reader, progress, part_layout)
+                peak_memory_mb = merge_stats['peak_memory_mb']
+                page_count = merge_stats['page_count']
+                parts = merge_stats['parts']
+            else:
+                final_pdf_writer = build_merged_writer(stamps, cover_pdf_bytes, exam_pdf_bytes, font_ttf_bytes, config, merge_workers, exam_reader, progress)
+
+                with open(full_path, "wb") as f:
+                    final_pdf_writer.write(f)
+                report_progress(progress, 'pages_written', len(final_pdf_writer.pages))
+                peak_memory_mb = get_memory_usage_mb()
+                page_count = len(final_pdf_writer.pages)
+
+                if part_layout is not None:
+                    # Parts are cut from the writer's pages directly; the merged file is not parsed again
+                    part_state = open_part_writer(job_id, os.path.dirname(full_path), pages_per_part, students_per_part)
+                    emit_part_packets(part_state, split_student_packets(list(final_pdf_writer.pages), 1 + len(exam_reader.pages)), progress)
+                    parts = close_part_writer(part_state, progress)
+
+            packet_pages = 1 + len(exam_reader.pages)
+        part_ranges = compute_part_ranges(page_count, packet_pages, pages_per_part, students_per_part)
+        part_count = len(part_ranges)
+
+        if part_count == 0:
+            raise ValueError("لم ينتج الدمج أي جزء للطباعة.")
+
+        progress['students_total'] = progress['students_read']
+        if spliced is not None:
+            progress['segments_reused'] = spliced
+        logging.info(f"ℹ️ ذاكرة تشكيل النصوص العربية: {get_arabic_shaping_stats()}")
+
+        with QUEUE_LOCK:
+            job_found['status'] = 'Ready'
+            job_found['last_used'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            job_found['part_count'] = part_count
+            job_found['page_count'] = page_count
+            job_found['packet_pages'] = packet_pages
+            job_found['parts'] = parts
+            job_found['full_size'] = os.path.getsize(full_path)
+            job_found['materialized_layout'] = None if lazy_parts else {"pages_per_part": pages_per_part, "students_per_part": students_per_part}
+            job_found['peak_memory_mb'] = peak_memory_mb
+            if merge_request['incremental']:
+                job_found['segment_signature'] = segment_signature(cover_pdf_bytes, exam_pdf_bytes, font_ttf_bytes, config)
+            job_found['print_details'] = "لم يتم الإرسال بعد."
+            save_jobs_to_file() # Persistence point A2: Merge finished
+        with MERGE_ADMISSION_LOCK:
+            MERGE_DURATIONS.append(time.time() - started_at)
+
+        logging.info(f"✅ تم إنشاء وظيفة جديدة ID: {job_id} بـ {part_count} جزء. (تقسيم: {students_per_part or '-'} طالب/جزء أو {pages_per_part} صفحة/جزء، ذروة الذاكرة: {peak_memory_mb} MB)")
 
     except Exception as e:
-        logging.error("❌ فشل تقسيم ملف PDF: %s", e, exc_info=True)
-        return 0
+        logging.error(f"❌ فشل دمج الوظيفة ID: {job_id}: %s", e, exc_info=True)
+        with QUEUE_LOCK:
+            job_found['status'] = 'Error'
+            job_found['print_details'] = f"فشل الدمج: {e}"
+            save_jobs_to_file()
+
+def counted_students(students, progress: dict):
+    """Passes students through while counting them as read in the job progress."""
+    for student in students:
+        report_progress(progress, 'students_read')
+        yield student
+
+def submit_merge_job(job_id: str, merge_request: dict):
+    """
+    Queues a merge on the background merge executor and returns its Future. The caller must hold
+    a slot from reserve_merge_slot; it is released when the merge finishes.
+    """
+    merge_future = MERGE_EXECUTOR.submit(run_merge_job, job_id, merge_request)
+    merge_future.add_done_callback(lambda _: release_merge_slot())
+    return merge_future
+
+# --- Pooled FTP Sessions ---
+
+def open_ftp_session(printer_ip: str, ftp_user: str, ftp_pwd: str) -> dict:
+    """Connects and logs in to a printer; the caller must already hold a session slot for printer_ip."""
+    ftp = FTP(timeout=FTP_CONNECT_TIMEOUT)
+    try:
+        ftp.connect(printer_ip, FTP_PORT)
+        ftp.login(user=ftp_user, passwd=ftp_pwd)
+    except BaseException:
+        close_ftp_session({"ftp": ftp})
+        raise
+    with FTP_POOL_CONDITION:
+        FTP_POOL_STATS['logins'] += 1
+    logging.info(f"✅ تم الاتصال بنجاح بالطابعة {printer_ip} عبر FTP (جلسة جديدة للمستخدم {ftp_user}).")
+    return {"ftp": ftp, "key": (printer_ip, ftp_user), "passwd": ftp_pwd, "last_used": time.time()}
+
+def close_ftp_session(session: dict):
+    """Logs out of a session, dropping the socket if the printer does not answer QUIT."""
+    try:
+        session["ftp"].quit()
+    except FTP_ALL_ERRORS:
+        session["ftp"].close()
+
+def ftp_session_is_healthy(session: dict) -> bool:
+    """A NOOP round trip; pooled sessions are checked this way before they are reused."""
+    try:
+        session["ftp"].voidcmd("NOOP")
+        return True
+    except FTP_ALL_ERRORS:
+        return False
+
+def release_ftp_slot(printer_ip: str):
+    """Frees one session slot of printer_ip. Expected to be called while holding FTP_POOL_CONDITION."""
+    FTP_POOL_OPEN[printer_ip] -= 1
+    if not FTP_POOL_OPEN[printer_ip]:
+        del FTP_POOL_OPEN[printer_ip]
+    FTP_POOL_CONDITION.notify_all()
+
+def acquire_ftp_session(printer_ip: str, ftp_user: str, ftp_pwd: str):
+    """
+    Returns an idle pooled session for (printer_ip, ftp_user), or None after reserving a slot
+    for a new one. Waits while the printer already has FTP_MAX_SESSIONS_PER_PRINTER sessions
+    open; an idle session of another user on the same printer is logged out to make room.
+    Stale sessions are taken out of the pool under FTP_POOL_CONDITION but logged out after
+    releasing it, so a slow printer never stalls the pool for the other printers.
+    """
+    key = (printer_ip, ftp_user)
+    deadline = time.time() + FTP_SESSION_WAIT_TIMEOUT
+    while True:
+        with FTP_POOL_CONDITION:
+            while True:
+                idle = FTP_POOL.get(key)
+                if idle:
+                    stale = idle.pop()
+                    if stale["passwd"] == ftp_pwd:
+                        return stale
+                    # Credentials changed since this session logged in
+                    FTP_POOL_STATS['discarded'] += 1
+                    break
+                if FTP_POOL_OPEN.get(printer_ip, 0) < FTP_MAX_SESSIONS_PER_PRINTER:
+                    FTP_POOL_OPEN[printer_ip] = FTP_POOL_OPEN.get(printer_ip, 0) + 1
+                    return None
+                other_key = next((other for other, sessions in FTP_POOL.items() if other[0] == printer_ip and sessions), None)
+                if other_key:
+                    stale = FTP_POOL[other_key].pop(0)
+                    FTP_POOL_STATS['idle_closed'] += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"لا توجد جلسة FTP متاحة للطابعة {printer_ip} (الحد الأقصى {FTP_MAX_SESSIONS_PER_PRINTER} جلسة).")
+                FTP_POOL_CONDITION.wait(remaining)
+
+        close_ftp_session(stale)
+        if stale["key"] == key:
+            return None # The new login takes over the discarded session's slot
+        with FTP_POOL_CONDITION:
+            release_ftp_slot(printer_ip)
+
+@contextmanager
+def pooled_ftp_session(printer_ip: str, ftp_user: str, ftp_pwd: str, contact: dict = None):
+    """
+    Yields a logged-in FTP connection to printer_ip for one print job. Back-to-back jobs for the
+    same (printer_ip, ftp_user) reuse one authenticated session: pooled sessions are checked with
+    NOOP before reuse and go back to the pool afterwards. A session whose job raised is logged
+    out instead, since its transfer state is unknown. contact['printer'] is set once a session
+    slot is held, so callers can tell printer failures from a timeout waiting for the local pool.
+    """
+    session = acquire_ftp_session(printer_ip, ftp_user, ftp_pwd)
+    if contact is not None:
+        contact['printer'] = True
+    try:
+        if session is not None and not ftp_session_is_healthy(session):
+            logging.warning(f"⚠️ جلسة FTP المخزنة للطابعة {printer_ip} لم تعد صالحة. جاري فتح جلسة جديدة.")
+            with FTP_POOL_CONDITION:
+                FTP_POOL_STATS['health_failures'] += 1
+            session["ftp"].close()
+            session = None
+        if session is None:
+            session = open_ftp_session(printer_ip, ftp_user, ftp_pwd)
+        else:
+            with FTP_POOL_CONDITION:
+                FTP_POOL_STATS['reuses'] += 1
+            logging.info(f"♻️ إعادة استخدام جلسة FTP مفتوحة مع الطابعة {printer_ip}.")
+    except BaseException:
+        with FTP_POOL_CONDITION:
+            release_ftp_slot(printer_ip)
+        raise
+
+    try:
+        yield session["ftp"]
+    except BaseException:
+        close_ftp_session(session)
+        with FTP_POOL_CONDITION:
+            FTP_POOL_STATS['discarded'] += 1
+            release_ftp_slot(printer_ip)
+        raise
+    session["last_used"] = time.time()
+    with FTP_POOL_CONDITION:
+        FTP_POOL.setdefault(session["key"], []).append(session)
+        FTP_POOL_CONDITION.notify_all()
+
+def ftp_pool_keeper():
+    """
+    Background keepalive thread: every FTP_KEEPALIVE_INTERVAL seconds idle sessions get a NOOP so
+    the printer does not drop them; dead ones and those idle beyond FTP_SESSION_IDLE_TIMEOUT are closed.
+    """
+    while not WORKER_STOP_EVENT.wait(FTP_KEEPALIVE_INTERVAL):
+        # Idle sessions are taken out of the pool while they are checked, so no print can use one mid-NOOP
+        with FTP_POOL_CONDITION:
+            checked = [session for sessions in FTP_POOL.values() for session in sessions]
+            FTP_POOL.clear()
+
+        keep = []
+        for session in checked:
+            if time.time() - session["last_used"] > FTP_SESSION_IDLE_TIMEOUT:
+                close_ftp_session(session)
+                reason = 'idle_closed'
+            elif ftp_session_is_healthy(session):
+                keep.append(session)
+                continue
+            else:
+                session["ftp"].close()
+                reason = 'health_failures'
+            with FTP_POOL_CONDITION:
+                FTP_POOL_STATS[reason] += 1
+                release_ftp_slot(session["key"][0])
+
+        with FTP_POOL_CONDITION:
+            for session in keep:
+                FTP_POOL.setdefault(session["key"], []).insert(0, session)
+            FTP_POOL_CONDITION.notify_all()
+
+def start_ftp_pool_keeper():
+    """Starts the background thread that keeps pooled FTP sessions alive."""
+    global FTP_POOL_THREAD
+    if FTP_POOL_THREAD is None or not FTP_POOL_THREAD.is_alive():
+        FTP_POOL_THREAD = threading.Thread(target=ftp_pool_keeper, name="FtpPoolKeeper")
+        FTP_POOL_THREAD.daemon = True
+        FTP_POOL_THREAD.start()
+        logging.info("🚀 بدأ تشغيل خيط الحفاظ على جلسات FTP (FtpPoolKeeper).")
+
+def get_ftp_pool_stats() -> dict:
+    """Open and idle FTP sessions per printer, with login/reuse counters."""
+    with FTP_POOL_CONDITION:
+        idle = {}
+        for (printer_ip, _), sessions in FTP_POOL.items():
+            idle[printer_ip] = idle.get(printer_ip, 0) + len(sessions)
+        return {
+            "open": dict(FTP_POOL_OPEN),
+            "idle": idle,
+            "max_per_printer": FTP_MAX_SESSIONS_PER_PRINTER,
+            **FTP_POOL_STATS,
+        }
+
+# --- Per-Printer Dispatch Lanes ---
+
+def printer_lane_workers(printer_ip: str) -> int:
+    """Concurrent uploads allowed to one printer: its fleet setting, else PRINTER_LANE_WORKERS."""
+    with PRINTER_FLEET_LOCK:
+        printer = PRINTER_FLEET.get(printer_ip)
+        return (printer or {}).get('max_uploads') or PRINTER_LANE_WORKERS
+
+def job_in_print_lane(job_id: str) -> bool:
+    """True while a job waits in, or is being printed by, a dispatch lane."""
+    with PRINTER_LANE_CONDITION:
+        return job_id in PRINTER_LANE_JOBS
+
+def run_lane_job(job_id: str, printer_ip: str, target, args: tuple):
+    """
+    Runs one print on a lane thread once the lane has a free upload slot, and frees the job's
+    lane slot afterwards. Every thread of the lane counts against the same limit, so threads of
+    an executor replaced after a limit change never add uploads on top of the new limit.
+    """
+    with PRINTER_LANE_CONDITION:
+        lane = PRINTER_LANES[printer_ip]
+        while lane['active'] >= lane['workers']:
+            PRINTER_LANE_CONDITION.wait()
+        lane['active'] += 1
+    try:
+        target(*args)
+    except Exception as e:
+        logging.error(f"❌ خطأ غير متوقع في مسار الطباعة للوظيفة ID: {job_id}: {e}", exc_info=True)
+    finally:
+        with PRINTER_LANE_CONDITION:
+            lane['active'] -= 1
+            PRINTER_LANE_JOBS.pop(job_id, None)
+            PRINTER_LANE_CONDITION.notify_all()
+
+def submit_print_job(job_id: str, printer_ip: str, target, *args) -> bool:
+    """
+    Queues a print on printer_ip's dispatch lane: a ThreadPoolExecutor whose uploads are limited
+    to printer_lane_workers(printer_ip) at a time, so a printer never gets more concurrent uploads
+    and the thread count does not grow with the number of queued jobs. Manual and continuous prints
+    share the lanes. Returns False if the job is already waiting or printing in a lane.
+    """
+    with PRINTER_LANE_CONDITION:
+        if job_id in PRINTER_LANE_JOBS:
+            return False
+        workers = printer_lane_workers(printer_ip)
+        lane = PRINTER_LANES.get(printer_ip)
+        if lane is None:
+            lane = PRINTER_LANES[printer_ip] = {"executor": None, "threads": 0, "workers": workers, "active": 0}
+        elif lane['workers'] != workers:
+            # The printer's upload limit changed: it applies to uploads already queued too (see run_lane_job)
+            lane['workers'] = workers
+            PRINTER_LANE_CONDITION.notify_all()
+        if lane['threads'] < workers:
+            # A raised limit needs more threads; the old executor's queued jobs still wait for a slot
+            if lane['executor'] is not None:
+                lane['executor'].shutdown(wait=False)
+            lane['executor'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"PrintLane_{printer_ip}")
+            lane['threads'] = workers
+        PRINTER_LANE_JOBS[job_id] = printer_ip
+        lane['executor'].submit(run_lane_job, job_id, printer_ip, target, args)
+    return True
+
+def get_print_lane_stats() -> dict:
+    """Jobs waiting or printing per printer lane, with each lane's upload limit, circuit breaker and spool flow control."""
+    with PRINTER_LANE_CONDITION:
+        jobs = {}
+        for printer_ip in PRINTER_LANE_JOBS.values():
+            jobs[printer_ip] = jobs.get(printer_ip, 0) + 1
+        stats = {printer_ip: {"workers": lane['workers'], "active": lane['active'], "jobs": jobs.get(printer_ip, 0)}
+                 for printer_ip, lane in PRINTER_LANES.items()}
+    for printer_ip, breaker in get_breaker_stats().items():
+        stats.setdefault(printer_ip, {"workers": 0, "active": 0, "jobs": 0})["breaker"] = breaker
+    for printer_ip, flow in get_flow_stats().items():
+        stats.setdefault(printer_ip, {"workers": 0, "active": 0, "jobs": 0})["flow"] = flow
+    return stats
+
+# --- Printer Fleet Dispatch ---
+
+def register_printer(printer_ip: str, ftp_user: str, ftp_pwd: str = '', ring_number: str = None, enabled: bool = True, max_uploads: int = None) -> dict:
+    """
+    Adds a printer to the fleet or updates its settings; observed throughput and counters are kept.
+    max_uploads overrides PRINTER_LANE_WORKERS for this printer's dispatch lane.
+    """
+    with PRINTER_FLEET_LOCK:
+        printer = PRINTER_FLEET.setdefault(printer_ip, {
+            "ip": printer_ip,
+            "in_flight": 0,
+            "queued_bytes": 0,
+            "jobs_sent": 0,
+            "bytes_sent": 0,
+            "throughput": None, # Smoothed bytes/second of completed transfers
+            "failures": 0,
+            "last_error": None,
+        })
+        printer.update({"ftp_user": ftp_user, "ftp_pwd": ftp_pwd, "ring_number": ring_number, "enabled": enabled, "max_uploads": max_uploads})
+        save_printer_fleet()
+        logging.info(f"🖨️ تم تسجيل الطابعة {printer_ip} في أسطول الطابعات (مفعلة: {enabled}).")
+        return dict(printer)
+
+def remove_printer(printer_ip: str) -> bool:
+    """Removes a printer from the fleet; jobs already sent to it finish there."""
+    with PRINTER_FLEET_LOCK:
+        if PRINTER_FLEET.pop(printer_ip, None) is None:
+            return False
+        save_printer_fleet()
+    logging.info(f"🗑️ تم حذف الطابعة {printer_ip} من أسطول الطابعات.")
+    return True
+
+def fleet_printer_available(printer: dict) -> bool:
+    """Enabled and not parked by its circuit breaker."""
+    return printer['enabled'] and breaker_available(printer['ip'])
+
+def job_transfer_bytes(job: dict) -> int:
+    """Bytes a print of the job uploads: its manifest parts, else the merged file (lazy jobs not yet cut)."""
+    part_bytes = sum(part.get('size') or 0 for part in job.get('parts') or [])
+    return part_bytes or job.get('full_size') or 0
+
+def select_fleet_printer(job_bytes: int, excluded: list = ()) -> dict:
+    """
+    Picks the fleet printer expected to finish a job of job_bytes soonest: bytes already queued
+    on it plus this job, over its observed throughput. Printers not measured yet are assumed as
+    fast as the fastest one, so every printer gets tried; ties go to the least loaded printer.
+    Printers in excluded (those that already failed this job) are used only when no other printer
+    is available. The chosen printer's load is reserved until release_fleet_printer; returns a
+    copy of its settings, or None.
+    """
+    with PRINTER_FLEET_LOCK:
+        available = [printer for printer in PRINTER_FLEET.values() if fleet_printer_available(printer)]
+        candidates = [printer for printer in available if printer['ip'] not in excluded] or available
+        if not candidates:
+            return None
+        default_throughput = max((p['throughput'] for p in PRINTER_FLEET.values() if p['throughput']), default=FLEET_DEFAULT_THROUGHPUT)
+        printer = min(candidates, key=lambda p: ((p['queued_bytes'] + job_bytes) / (p['throughput'] or default_throughput),
+                                                 p['in_flight'], p['jobs_sent']))
+        printer['in_flight'] += 1
+        printer['queued_bytes'] += job_bytes
+        return dict(printer)
+
+def release_fleet_printer(printer_ip: str, job_bytes: int, result: dict):
+    """
+    Ends a job's reservation on a fleet printer and folds its outcome into the printer's stats
+    (result None: the job was not attempted). Taking a failing printer out of dispatch is left
+    to its circuit breaker.
+    """
+    with PRINTER_FLEET_LOCK:
+        printer = PRINTER_FLEET.get(printer_ip)
+        if printer is None:
+            return # Removed from the fleet while the job was printing
+        printer['in_flight'] = max(0, printer['in_flight'] - 1)
+        printer['queued_bytes'] = max(0, printer['queued_bytes'] - job_bytes)
+        if result is None:
+            pass
+        elif result['ok']:
+            printer['jobs_sent'] += 1
+            printer['bytes_sent'] += result['bytes']
+            if result['seconds'] > 0 and result['bytes']:
+                observed = result['bytes'] / result['seconds']
+                previous = printer['throughput']
+                printer['throughput'] = observed if previous is None else (
+                    FLEET_THROUGHPUT_SMOOTHING * observed + (1 - FLEET_THROUGHPUT_SMOOTHING) * previous)
+        else:
+            printer['failures'] += 1
+            printer['last_error'] = result['error']
+        save_printer_fleet()
+
+def dispatch_fleet_job(job_id: str, printer: dict, ring_number: str, part_layout: dict, job_bytes: int):
+    """Prints a continuous job on the fleet printer it was assigned and releases that printer afterwards."""
+    result = None
+    try:
+        result = run_continuous_print(job_id, printer['ip'], (job_id, printer['ip'], printer['ftp_user'], printer.get('ftp_pwd', ''), ring_number, True, part_layout))
+    finally:
+        release_fleet_printer(printer['ip'], job_bytes, result)
+
+def get_fleet_status() -> list:
+    """Fleet printers with their load and observed throughput (FTP passwords left out)."""
+    with PRINTER_FLEET_LOCK:
+        return [{**{key: value for key, value in printer.items() if key != 'ftp_pwd'},
+                 "available": fleet_printer_available(printer)} for printer in PRINTER_FLEET.values()]
+
+# --- Retry Scheduling and Printer Circuit Breakers ---
+
+def retry_backoff_seconds(retry_count: int) -> float:
+    """Delay before retry number retry_count: exponential from RETRY_BACKOFF_BASE, capped, with jitter."""
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** max(0, retry_count - 1))
+    # Jitter keeps jobs that failed together from retrying against the printer in lockstep
+    return delay * random.uniform(0.5, 1.0)
+
+def get_printer_breaker(printer_ip: str) -> dict:
+    """A printer's breaker record. Expected to be called while holding PRINTER_BREAKER_LOCK."""
+    return PRINTER_BREAKERS.setdefault(printer_ip, {"state": "closed", "failures": 0, "trips": 0, "open_until": 0, "probe_in_flight": False})
+
+def breaker_available(printer_ip: str) -> bool:
+    """True if a print for printer_ip could start now: closed, or past its open time with no probe running."""
+    with PRINTER_BREAKER_LOCK:
+        breaker = get_printer_breaker(printer_ip)
+        if breaker['state'] == 'closed':
+            return True
+        return time.time() >= breaker['open_until'] and not breaker['probe_in_flight']
+
+def breaker_acquire(printer_ip: str):
+    """
+    Asks the breaker whether a continuous print may start on printer_ip. An open breaker refuses
+    until BREAKER_OPEN_SECONDS have passed, then lets exactly one probe print through (half-open).
+    Returns None when refused, 'probe' for that probe print and 'closed' otherwise.
+    """
+    with PRINTER_BREAKER_LOCK:
+        breaker = get_printer_breaker(printer_ip)
+        if breaker['state'] == 'closed':
+            return 'closed'
+        if time.time() < breaker['open_until'] or breaker['probe_in_flight']:
+            return None
+        breaker['state'] = 'half_open'
+        breaker['probe_in_flight'] = True
+        logging.info(f"🔌 قاطع الطابعة {printer_ip} نصف مفتوح: إرسال وظيفة تجريبية.")
+        return 'probe'
+
+def abandon_breaker_probe(printer_ip: str):
+    """Frees the half-open probe of a print that never reached the printer, so another job can probe it."""
+    with PRINTER_BREAKER_LOCK:
+        get_printer_breaker(printer_ip)['probe_in_flight'] = False
+
+def record_breaker_outcome(printer_ip: str, ok: bool, probe: bool = False):
+    """
+    Folds one print attempt into printer_ip's breaker. A success closes it; BREAKER_FAILURE_THRESHOLD
+    consecutive failures (or a failed probe) open it, parking the printer's continuous jobs for a
+    time that doubles with every repeated trip. Only the probe print itself (probe=True) ends the
+    half-open probe; manual prints finishing meanwhile do not let a second probe start.
+    """
+    with PRINTER_BREAKER_LOCK:
+        breaker = get_printer_breaker(printer_ip)
+        if probe:
+            breaker['probe_in_flight'] = False
+        if ok:
+            if breaker['state'] != 'closed':
+                logging.info(f"✅ قاطع الطابعة {printer_ip} مغلق: عادت الطابعة للعمل.")
+            breaker.update({"state": "closed", "failures": 0, "trips": 0, "open_until": 0})
+            return
+        breaker['failures'] += 1
+        if breaker['state'] == 'half_open' or breaker['failures'] >= BREAKER_FAILURE_THRESHOLD:
+            breaker['trips'] += 1
+            open_seconds = min(BREAKER_MAX_OPEN_SECONDS, BREAKER_OPEN_SECONDS * 2 ** (breaker['trips'] - 1))
+            breaker['state'] = 'open'
+            breaker['open_until'] = time.time() + open_seconds
+            logging.warning(f"⛔ تم فتح قاطع الطابعة {printer_ip} لمدة {open_seconds} ثانية بعد {breaker['failures']} أخطاء متتالية. وظائفها متوقفة مؤقتاً.")
+
+def park_continuous_job(job_id: str):
+    """Puts a continuous job whose printer is parked back in the queue without using up a retry."""
+    with QUEUE_LOCK:
+        if job_id not in CONTINUOUS_QUEUE:
+            CONTINUOUS_QUEUE.append(job_id)
+
+def run_continuous_print(job_id: str, printer_ip: str, print_args: tuple):
+    """
+    Lane entry point of a continuous print: the printer's breaker is asked again when the lane
+    reaches the job, so jobs queued behind a printer that just went down are parked, not failed.
+    Returns print_job_ftp's result, or None if the job was parked.
+    """
+    admission = breaker_acquire(printer_ip)
+    if not admission:
+        park_continuous_job(job_id)
+        return None
+    return print_job_ftp(*print_args, breaker_probe=admission == 'probe')
+
+def get_breaker_stats() -> dict:
+    """Breaker state per printer, with the seconds left while open."""
+    with PRINTER_BREAKER_LOCK:
+        now = time.time()
+        return {printer_ip: {"state": breaker['state'], "failures": breaker['failures'], "trips": breaker['trips'],
+                             "retry_in": max(0, round(breaker['open_until'] - now))}
+                for printer_ip, breaker in PRINTER_BREAKERS.items()}
+
+# --- Per-Part Print Progress ---
+
+def plan_part_sends(job: dict, job_files: list, part_range: tuple = None, resume: bool = True, layout: dict = None) -> list:
+    """
+    Picks the part files a print sends, in order, from the job's persisted part_progress:
+    every part not yet 'sent' when resuming, or exactly parts first..last (1-based) with
+    part_range. Progress is reset when the parts were cut with another layout, when resume is
+    off, or when the previous print already sent every part (printing the job again).
+    layout is that of streamed parts; part files use the job's materialized_layout.
+    Expected to be called while holding QUEUE_LOCK.
+    """
+    layout = layout or job.get('materialized_layout')
+    progress = job.get('part_progress')
+    sent = {} if progress is None or progress['layout'] != layout else {
+        filename: state for filename, state in progress['parts'].items() if state['state'] == 'sent'}
+    if part_range is None and (not resume or all(os.path.basename(path) in sent for path in job_files)):
+        progress = None
+    if progress is None or progress['layout'] != layout:
+        progress = {"layout": layout, "parts": {}}
+        job['part_progress'] = progress
+
+    if part_range is not None:
+        first, last = part_range
+        if not 1 <= first <= last <= len(job_files):
+            raise ValueError(f"نطاق الأجزاء {first}-{last} خارج حدود الوظيفة (1-{len(job_files)}).")
+        return job_files[first - 1:last]
+    return [path for path in job_files if progress['parts'].get(os.path.basename(path), {}).get('state') != 'sent']
+
+def record_part_state(job_id: str, filename: str, state: str, error: str = None, transfer: dict = None):
+    """
+    Persists one part's send state ('sent' or 'failed') so retries and restarts resume after it,
+    with the upload stats of a sent part.
+    """
+    with QUEUE_LOCK:
+        job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
+        if not job_found or not job_found.get('part_progress'):
+            return
+        entry = {"state": state, "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        if error:
+            entry["error"] = error
+        if transfer:
+            entry.update(transfer)
+        job_found['part_progress']['parts'][filename] = entry
+        save_jobs_to_file()
+
+# --- Pipelined FTP Upload ---
+
+def put_block(blocks: queue.Queue, item, stop: threading.Event) -> bool:
+    """Queues one read-ahead item, giving up once the upload has stopped. Returns False if it did."""
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def read_ahead_blocks(source, blocks: queue.Queue, stop: threading.Event):
+    """Reader side of upload_part_file: fills blocks with FTP_UPLOAD_BLOCK_SIZE reads, then b'' (or the read error)."""
+    try:
+        while True:
+            block = source.read(FTP_UPLOAD_BLOCK_SIZE)
+            if not put_block(blocks, block, stop) or not block:
+                return
+    except OSError as e:
+        put_block(blocks, e, stop)
+
+def upload_part_file(ftp, ftp_filename: str, local_path) -> dict:
+    """
+    Uploads one part with STOR, like ftp.storbinary but with FTP_UPLOAD_BLOCK_SIZE blocks read
+    ahead on a helper thread (up to FTP_UPLOAD_READ_AHEAD blocks), so disk reads overlap socket
+    writes. local_path may also be the part's bytes (spool-less printing). Returns the bytes sent, the total seconds, and how long the upload waited on the
+    disk (read_wait) versus on the network (send_seconds): a slow disk shows up as read_wait,
+    a slow printer link as send_seconds. accept_seconds is how long the printer took to accept
+    the STOR, which spool flow control watches.
+    """
+    started = time.time()
+    stats = {"bytes": 0, "read_wait": 0.0, "send_seconds": 0.0}
+    with (open(local_path, 'rb') if isinstance(local_path, str) else io.BytesIO(local_path)) as source:
+        ftp.voidcmd('TYPE I')
+        blocks = queue.Queue(maxsize=FTP_UPLOAD_READ_AHEAD)
+        stop = threading.Event()
+        reader = threading.Thread(target=read_ahead_blocks, args=(source, blocks, stop), name="FtpReadAhead", daemon=True)
+        reader.start()
+        try:
+            accepting = time.time()
+            with ftp.transfercmd(f'STOR {ftp_filename}') as conn:
+                stats['accept_seconds'] = round(time.time() - accepting, 4)
+                while True:
+                    waited = time.time()
+                    block = blocks.get()
+                    stats['read_wait'] += time.time() - waited
+                    if isinstance(block, Exception):
+                        raise block
+                    if not block:
+                        break
+                    sending = time.time()
+                    conn.sendall(block)
+                    stats['send_seconds'] += time.time() - sending
+                    stats['bytes'] += len(block)
+            ftp.voidresp()
+        finally:
+            stop.set()
+            reader.join()
+    stats['seconds'] = time.time() - started
+    stats['throughput'] = round(stats['bytes'] / stats['seconds']) if stats['seconds'] > 0 else None
+    stats['read_wait'] = round(stats['read_wait'], 4)
+    stats['send_seconds'] = round(stats['send_seconds'], 4)
+    stats['seconds'] = round(stats['seconds'], 4)
+    return stats
+
+# --- Printer Spool Flow Control ---
+
+def get_printer_flow(printer_ip: str) -> dict:
+    """A printer's flow control record. Expected to be called while holding PRINTER_FLOW_LOCK."""
+    return PRINTER_FLOW.setdefault(printer_ip, {
+        "window": FLOW_INITIAL_WINDOW,
+        "depth": 0, # Our parts believed to be waiting in the hot folder (last listing + parts sent since)
+        "listing": True, # False once the printer refuses to list its hot folder
+        "credit": 0,
+        "accept_latency": None,
+        "waits": 0,
+        "rejections": 0,
+    })
+
+def list_spool_depth(ftp) -> int:
+    """Counts the print parts still waiting in the printer's FTP hot folder; None if it cannot be listed."""
+    try:
+        names = ftp.nlst()
+    except error_perm as e:
+        # Many FTP servers answer 550 for an empty directory
+        return 0 if str(e).startswith('550') else None
+    return sum(1 for name in names if "_STAPLE_R" in name and name.lower().endswith(".pdf"))
+
+def wait_for_spool_room(ftp, printer_ip: str):
+    """
+    Holds the next part back while the printer's hot folder already holds a full window of our
+    parts. The depth estimate is refreshed by listing the folder whenever it reaches the window,
+    and every FLOW_POLL_INTERVAL seconds while waiting. Printers that cannot list their folder
+    are paced by acceptance latency instead: after a slow acceptance the next part waits as long.
+    """
+    deadline = time.time() + FLOW_MAX_WAIT
+    waited = False
+    while True:
+        with PRINTER_FLOW_LOCK:
+            flow = get_printer_flow(printer_ip)
+            if not flow['listing']:
+                pause = flow['accept_latency'] or 0
+                break
+            if flow['depth'] < flow['window']:
+                flow['depth'] += 1
+                return
+
+        depth = list_spool_depth(ftp)
+        with PRINTER_FLOW_LOCK:
+            if depth is None:
+                flow['listing'] = False
+                logging.warning(f"⚠️ الطابعة {printer_ip} لا تسمح بعرض مجلد الطباعة. سيتم ضبط الإرسال حسب زمن قبول الملفات فقط.")
+                continue
+            flow['depth'] = depth
+            if depth < flow['window']:
+                flow['depth'] += 1
+                return
+            if not waited:
+                flow['waits'] += 1
+                waited = True
+                logging.info(f"⏳ مجلد الطباعة في {printer_ip} ممتلئ ({depth}/{flow['window']} ملف). انتظار تفريغه...")
+        if time.time() >= deadline:
+            raise TimeoutError(f"مجلد الطباعة في الطابعة {printer_ip} ممتلئ منذ {FLOW_MAX_WAIT} ثانية.")
+        time.sleep(FLOW_POLL_INTERVAL)
+
+    if pause > FLOW_ACCEPT_LATENCY_TARGET:
+        time.sleep(min(pause, FLOW_MAX_WAIT))
+
+def record_spool_accept(printer_ip: str, accept_seconds: float):
+    """
+    Adapts the printer's window to one accepted part (AIMD): a slow acceptance halves the window;
+    otherwise it grows by one part after a full window of quick acceptances.
+    """
+    with PRINTER_FLOW_LOCK:
+        flow = get_printer_flow(printer_ip)
+        previous = flow['accept_latency']
+        flow['accept_latency'] = accept_seconds if previous is None else round(0.7 * previous + 0.3 * accept_seconds, 4)
+        if accept_seconds > FLOW_ACCEPT_LATENCY_TARGET:
+            flow['window'] = max(FLOW_MIN_WINDOW, flow['window'] // 2)
+            flow['credit'] = 0
+        else:
+            flow['credit'] += 1
+            if flow['credit'] >= flow['window']:
+                flow['window'] = min(FLOW_MAX_WINDOW, flow['window'] + 1)
+                flow['credit'] = 0
+
+def record_spool_reject(printer_ip: str):
+    """A part refused with a 4xx reply (spool full): halve the window and list the folder before sending again."""
+    with PRINTER_FLOW_LOCK:
+        flow = get_printer_flow(printer_ip)
+        flow['rejections'] += 1
+        flow['window'] = max(FLOW_MIN_WINDOW, flow['window'] // 2)
+        flow['depth'] = flow['window']
+        flow['credit'] = 0
+
+def get_flow_stats() -> dict:
+    """Spool flow control state per printer."""
+    with PRINTER_FLOW_LOCK:
+        return {printer_ip: {key: value for key, value in flow.items() if key != 'credit'} for printer_ip, flow in PRINTER_FLOW.items()}
 
 # --- Core Printing Function (Modified) ---
 
-def print_job_ftp(job_id: str, printer_ip: str, ftp_user: str, ftp_pwd: str, ring_number: str, is_continuous: bool = False):
+def print_job_ftp(job_id: str, printer_ip: str, ftp_user: str, ftp_pwd: str, ring_number: str, is_continuous: bool = False, part_layout: dict = None,
+                  part_range: tuple = None, resume: bool = True, breaker_probe: bool = False):
     
     # 1. Retrieve and Validate Job State
     with QUEUE_LOCK:
         job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
         if not job_found:
+            if breaker_probe:
+                abandon_breaker_probe(printer_ip)
             logging.error(f"❌ لم يتم العثور على الوظيفة ID: {job_id} للإرسال.")
             return
 
         # 2. Update Status to Printing
         job_found['status'] = 'Printing'
         job_found['start_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        job_found['last_used'] = job_found['start_time']
+        spool_parts = job_found.get('spool_parts', SPOOL_PART_FILES)
+        full_path = job_found.get('full_path')
         save_jobs_to_file() # Persistence point B: Status change to Printing
         logging.info(f"🔄 بدأ إرسال مهمة الطباعة ID: {job_id} (محاولة: {job_found['retry_count'] + 1}) إلى الطابعة {printer_ip} برقم رينج: {ring_number}")
     
-    ftp = None
     success_count = 0
+    skipped_count = 0
+    ftp_contact = {} # Only failures talking to the printer count against its circuit breaker (see pooled_ftp_session)
+    # Upload totals of this print; read_wait is time spent waiting on the disk, send_seconds on the network
+    transfer = {"bytes": 0, "seconds": 0.0, "read_wait": 0.0, "send_seconds": 0.0, "parts": 0}
     job_successful = False
     
     # FIX: Initialize error_detail here to avoid Pylint E0601 error 
     # when accessing it in the 'finally' block if job_successful is False.
     error_detail = "فشل غير محدد." 
+    full_file = None # Merged document the parts are cut from in spool-less mode
     
     try:
-        # 3. FTP Connection and File Transfer
-        ftp = FTP(printer_ip, timeout=10)
-        ftp.login(user=ftp_user, passwd=ftp_pwd)
-        logging.info(f"✅ تم الاتصال بنجاح بالطابعة {printer_ip} عبر FTP.")
-
-        all_files = os.listdir(OUTPUT_FOLDER)
-        job_files = sorted([f for f in all_files if f.startswith(f"{job_id}_P")])
-        
-        if not job_files:
-            raise FileNotFoundError(f"لم يتم العثور على ملفات جزئية للوظيفة {job_id}.")
+        part_layout = part_layout or {}
+        streamed = None
+        if not spool_parts:
+            # Spool-less: parts not already on disk are cut in memory while uploading, never written
+            streamed = plan_streamed_parts(job_id, part_layout.get('pages_per_part'), part_layout.get('students_per_part'))
+            if not streamed:
+                logging.warning(f"⚠️ الوظيفة ID: {job_id}: لديها ملفات أجزاء محفوظة بهذا التقسيم، لذا ستُرسل من القرص بدل القص في الذاكرة.")
+        if streamed:
+            streamed_layout, streamed_pages = streamed
+            job_files = list(streamed_pages)
+            full_file = open(full_path, 'rb')
+            full_reader = PdfReader(full_file)
+            logging.info(f"📡 الوظيفة ID: {job_id}: سيتم قص الأجزاء في الذاكرة أثناء الإرسال دون كتابتها على القرص.")
+        else:
+            # Parts are cut here on first print (lazy jobs) or when this print asks for another layout,
+            # before connecting so the FTP session is not left idle while cutting
+            streamed_layout, streamed_pages = None, {}
+            job_files = materialize_job_parts(job_id, part_layout.get('pages_per_part'), part_layout.get('students_per_part'))
+        # Parts already sent by an earlier, interrupted attempt are not sent (and stapled) twice
+        with QUEUE_LOCK:
+            send_files = plan_part_sends(job_found, job_files, part_range, resume, streamed_layout)
+        skipped_count = len(job_files) - len(send_files)
+        if skipped_count and part_range is None:
+            logging.info(f"⏭️ استئناف الوظيفة ID: {job_id}: تخطي {skipped_count} جزء تم إرساله سابقاً.")
 
-        for filename in job_files:
-            local_path = os.path.join(OUTPUT_FOLDER, filename)
-            
-            # Konica Minolta Bizhub 287 stapling command:
-            staple_tag = "_STAPLE"
-            ftp_filename = f"{filename[:-4]}{staple_tag}_R{ring_number}.pdf"
-            
-            logging.info(f"   ⬆️ جاري إرسال: {filename} باسم {ftp_filename}...")
-            
-            with open(local_path, 'rb') as f:
-                ftp.storbinary(f'STOR {ftp_filename}', f)
-            
-            success_count += 1
-            logging.info(f"   ✅ تم الإرسال بنجاح.")
+        # 3. FTP Connection and File Transfer (a pooled session, so back-to-back jobs skip the login)
+        with pooled_ftp_session(printer_ip, ftp_user, ftp_pwd, ftp_contact) as ftp:
+            for local_path in send_files:
+                filename = os.path.basename(local_path)
+                
+                # Konica Minolta Bizhub 287 stapling command:
+                staple_tag = "_STAPLE"
+                ftp_filename = f"{filename[:-4]}{staple_tag}_R{ring_number}.pdf"
+                
+                logging.info(f"   ⬆️ جاري إرسال: {filename} باسم {ftp_filename}...")
+                part_source = render_part_bytes(full_reader, streamed_pages[local_path]) if local_path in streamed_pages else local_path
+                
+                # Spool flow control: wait for room in the printer's hot folder; a part refused because
+                # the spool is full is sent again once it drains instead of failing the job
+                for attempt in range(FLOW_REJECT_RETRIES + 1):
+                    try:
+                        wait_for_spool_room(ftp, printer_ip)
+                        part_transfer = upload_part_file(ftp, ftp_filename, part_source)
+                    except error_temp as e:
+                        if attempt == FLOW_REJECT_RETRIES:
+                            record_part_state(job_id, filename, 'failed', str(e))
+                            raise
+                        record_spool_reject(printer_ip)
+                        logging.warning(f"   ⏳ رفضت الطابعة {printer_ip} الملف {filename} مؤقتاً ({e}). إعادة الإرسال بعد تفريغ مجلد الطباعة...")
+                        continue
+                    except Exception as e:
+                        record_part_state(job_id, filename, 'failed', str(e))
+                        raise
+                    break
+                record_spool_accept(printer_ip, part_transfer['accept_seconds'])
+                record_part_state(job_id, filename, 'sent', transfer=part_transfer)
+                for key in ('bytes', 'seconds', 'read_wait', 'send_seconds'):
+                    transfer[key] += part_transfer[key]
+                transfer['parts'] += 1
+                
+                success_count += 1
+                logging.info(f"   ✅ تم الإرسال بنجاح ({part_transfer['bytes'] // 1024} KB في {part_transfer['seconds']:.2f} ثانية).")
         
         job_successful = True # Set flag for successful print
         
@@ -303,38 +2718,56 @@ def print_job_ftp(job_id: str, printer_ip: str, ftp_user: str, ftp_pwd: str, rin
         
     finally:
         # 4. Final Job Status Update and Retry Logic
-        if ftp:
-            try:
-                ftp.quit()
-            except FTP_ALL_ERRORS:
-                pass
+        if full_file:
+            full_file.close()
+        if ftp_contact.get('printer'):
+            record_breaker_outcome(printer_ip, job_successful, breaker_probe)
+        elif breaker_probe:
+            abandon_breaker_probe(printer_ip)
+
+        transfer['throughput'] = round(transfer['bytes'] / transfer['seconds']) if transfer['seconds'] > 0 else None
+        for key in ('seconds', 'read_wait', 'send_seconds'):
+            transfer[key] = round(transfer[key], 4)
 
         with QUEUE_LOCK:
             job_found = next((job for job in PRINT_JOBS if job['id'] == job_id), None)
             if not job_found: # Should not happen, but for safety
                 return 
 
+            job_found['transfer'] = transfer
             if job_successful:
                 # Success Logic
                 job_found['status'] = 'Printed'
                 job_found['end_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 job_found['print_details'] = f"تم الإرسال بنجاح ({success_count} ملف) إلى {printer_ip} بالرينج {ring_number}"
+                if skipped_count and part_range is None:
+                    job_found['print_details'] += f" (تم تخطي {skipped_count} جزء مرسل سابقاً)"
+                job_found.pop('not_before', None)
                 logging.info(f"🎉 تم الانتهاء من إرسال مهمة الطباعة ID: {job_id}.")
             else:
                 # Failure and Retry Logic
                 job_found['end_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 job_found['retry_count'] += 1
                 job_found['print_details'] = error_detail # Usage is safe now
+                if job_found.get('fleet'):
+                    # The next fleet dispatch of this job prefers the other printers
+                    job_found.setdefault('failed_printers', []).append(printer_ip)
                 
                 if is_continuous and job_found['retry_count'] < MAX_RETRY:
-                    # Reinsert at the start of the continuous queue for immediate retry
-                    CONTINUOUS_QUEUE.insert(0, job_id)
+                    # Requeue with a not-before time (exponential backoff with jitter); the worker
+                    # keeps dispatching other jobs until it passes
+                    retry_delay = retry_backoff_seconds(job_found['retry_count'])
+                    job_found['not_before'] = time.time() + retry_delay
+                    if job_id not in CONTINUOUS_QUEUE:
+                        CONTINUOUS_QUEUE.append(job_id)
                     job_found['status'] = 'Ready' # Set back to ready for the next attempt
-                    logging.warning(f"🔄 فشل الطباعة ID: {job_id}. جاري إعادة إدراج الوظيفة في قائمة الانتظار للمحاولة {job_found['retry_count'] + 1}/{MAX_RETRY}.")
+                    logging.warning(f"🔄 فشل الطباعة ID: {job_id}. إعادة المحاولة {job_found['retry_count'] + 1}/{MAX_RETRY} بعد {retry_delay:.0f} ثانية.")
                 else:
                     # Final failure or manual print failure
                     job_found['status'] = 'Error'
                     logging.error(f"❌ فشل الطباعة النهائي ID: {job_id} بعد {job_found['retry_count']} محاولات أو فشل الطباعة اليدوية.")
             
             # 5. Save State
-            save_jobs_to_file() # Persistence point C: Final status/retry update
\ No newline at end of file
+            save_jobs_to_file() # Persistence point C: Final status/retry update
+
+    return {"ok": job_successful, "bytes": transfer['bytes'], "seconds": transfer['seconds'], "error": None if job_successful else error_detail}
\ No newline at end of file
@@ -0,0 +1,237 @@
+"""
+Load and fault benchmark of the print pipeline against simulated printers (printer_simulator.py).
+
+Seeds a batch of ready jobs (a generated merged document cut into parts with the application's own
+part writer, or left uncut with --stream-parts so every part is cut in memory while uploading), starts one simulated Bizhub hot folder per printer on loopback addresses
+127.0.0.1, 127.0.0.2, ..., queues every job through /api/continuous_print and waits for the
+continuous worker to print them. Reports jobs/minute, p50/p99 job latency (queued -> finished),
+retries, spool rejections, FTP logins, parts cut in memory and the peak thread count.
+
+Runs in a fresh temporary directory, so the jobs and output of a real installation are never
+touched. Example (200 jobs over two slow, flaky printers):
+
+    python print_benchmark.py --jobs 200 --printers 2 --accept-latency 0.05 --disconnect-rate 0.02 --fast-retries
+
+Other loopback addresses than 127.0.0.1 are available on Linux; elsewhere use --printers 1.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import threading
+import time
+
+from printer_simulator import add_simulator_arguments, get_simulator_stats, simulator_settings, start_printer_simulator, stop_printer_simulator
+
+BENCHMARK_POLL_INTERVAL = 0.05 # Seconds between job status samples
+BENCHMARK_FTP_USER = "benchmark"
+BENCHMARK_RING_NUMBER = "1"
+
+def percentile(values: list, fraction: float):
+    """Nearest-rank percentile of values (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def build_benchmark_document(page_count: int, page_kb: int) -> bytes:
+    """A merged-document stand-in: page_count uncompressed pages of about page_kb KB of random text each."""
+    from io import BytesIO
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4, pageCompression=0)
+    for page_number in range(page_count):
+        c.setFont("Helvetica", 12)
+        c.drawString(72, 800, f"Benchmark page {page_number + 1}")
+        c.setFont("Helvetica", 2)
+        for line in range(page_kb * 10):
+            c.drawString(20, 780 - (line % 380) * 2, "".join(random.choices(string.ascii_letters, k=100)))
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def seed_benchmark_jobs(core, job_count: int, parts_per_job: int, pages_per_part: int, page_kb: int, lazy: bool = False) -> list:
+    """
+    Adds job_count 'Ready' jobs, each with a FULL file and its parts cut by the application's part
+    writer. lazy jobs keep only the FULL file, like a lazily merged job, so spool-less printing
+    cuts every part in memory instead of sending part files already on disk.
+    """
+    from pypdf import PdfReader
+
+    page_count = parts_per_job * pages_per_part
+    document = build_benchmark_document(page_count, page_kb)
+    job_ids = []
+    for number in range(job_count):
+        job_id = f"bench{number:05}"
+        output_dir = core.job_output_dir(job_id)
+        os.makedirs(output_dir, exist_ok=True)
+        full_path = os.path.join(output_dir, f"{job_id}_FULL.pdf")
+        with open(full_path, "wb") as f:
+            f.write(document)
+        if lazy:
+            parts = []
+            part_count = len(core.compute_part_ranges(page_count, 1, pages_per_part))
+        else:
+            with open(full_path, "rb") as source_file:
+                reader = PdfReader(source_file)
+                part_state = core.open_part_writer(job_id, output_dir, pages_per_part)
+                core.emit_part_packets(part_state, [[page] for page in reader.pages])
+                parts = core.close_part_writer(part_state)
+            part_count = len(parts)
+        job_ids.append(job_id)
+        job = {
+            "id": job_id,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "status": "Ready",
+            "full_path": full_path,
+            "full_size": len(document),
+            "page_count": page_count,
+            "packet_pages": 1,
+            "pages_per_part": pages_per_part,
+            "students_per_part": None,
+            "materialized_layout": None if lazy else {"pages_per_part": pages_per_part, "students_per_part": None},
+            "parts": parts,
+            "part_count": part_count,
+            "print_details": "",
+            "start_time": None,
+            "end_time": None,
+            "retry_count": 0,
+            "printer_ip": None,
+            "ftp_user": None,
+            "ftp_pwd": None,
+            "ring_number": None,
+        }
+        with core.QUEUE_LOCK:
+            core.PRINT_JOBS.append(job)
+    with core.QUEUE_LOCK:
+        core.save_jobs_to_file()
+    return job_ids
+
+def wait_for_jobs(core, job_ids: list, started: float, timeout: float) -> dict:
+    """Samples job states until every job is 'Printed' or 'Error' (or timeout); returns finish times and the peak thread count."""
+    finished = {}
+    peak_threads = threading.active_count()
+    pending = set(job_ids)
+    deadline = started + timeout
+    while pending and time.time() < deadline:
+        with core.QUEUE_LOCK:
+            states = {job['id']: job['status'] for job in core.PRINT_JOBS if job['id'] in pending}
+        now = time.time()
+        for job_id, status in states.items():
+            if status in ('Printed', 'Error'):
+                finished[job_id] = now - started
+                pending.discard(job_id)
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(BENCHMARK_POLL_INTERVAL)
+    return {"finished": finished, "unfinished": sorted(pending), "peak_threads": peak_threads}
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="print_benchmark_")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import core_setup as core
+
+    core.FTP_PORT = args.port
+    core.PRINTER_LANE_WORKERS = args.lane_workers
+    if args.fast_retries:
+        # Seconds instead of minutes, so fault runs finish quickly; the policy itself is unchanged
+        core.RETRY_BACKOFF_BASE = 0.2
+        core.RETRY_BACKOFF_MAX = 2
+        core.BREAKER_OPEN_SECONDS = 1
+        core.BREAKER_MAX_OPEN_SECONDS = 5
+        core.FLOW_POLL_INTERVAL = 0.2
+    if not args.verbose:
+        core.logging.getLogger().setLevel(core.logging.CRITICAL) # The report counts the failures
+    import app_runtime # Loads the (empty) job list and starts the print worker
+
+    # Counts the parts print_job_ftp cuts in memory, to confirm --stream-parts really printed spool-less
+    rendered = {"parts": 0}
+    render_part_bytes = core.render_part_bytes
+    def counted_render_part_bytes(reader, part_pages):
+        rendered["parts"] += 1
+        return render_part_bytes(reader, part_pages)
+    core.render_part_bytes = counted_render_part_bytes
+
+    printers = [start_printer_simulator(f"127.0.0.{index + 1}", args.port, **simulator_settings(args)) for index in range(args.printers)]
+    try:
+        job_ids = seed_benchmark_jobs(core, args.jobs, args.parts, args.pages_per_part, args.page_kb, lazy=args.stream_parts)
+        payload = {"spool_parts": not args.stream_parts}
+        if args.printers > 1:
+            for printer in printers:
+                core.register_printer(printer["host"], BENCHMARK_FTP_USER, ring_number=BENCHMARK_RING_NUMBER, max_uploads=args.lane_workers)
+            payload.update(fleet=True, ring_number=BENCHMARK_RING_NUMBER)
+        else:
+            payload.update(printer_ip=printers[0]["host"], ftp_user=BENCHMARK_FTP_USER, ring_number=BENCHMARK_RING_NUMBER)
+
+        threads_before = threading.active_count()
+        started = time.time()
+        response = app_runtime.app.test_client().post('/api/continuous_print', json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/continuous_print: {response.status_code} {response.get_json()}")
+        waited = wait_for_jobs(core, job_ids, started, args.timeout)
+        elapsed = time.time() - started
+
+        with core.QUEUE_LOCK:
+            jobs = [dict(job) for job in core.PRINT_JOBS if job['id'] in waited['finished'] or job['id'] in waited['unfinished']]
+        latencies = list(waited['finished'].values())
+        printed = sum(1 for job in jobs if job['status'] == 'Printed')
+        return {
+            "jobs": len(job_ids),
+            "printed": printed,
+            "errors": sum(1 for job in jobs if job['status'] == 'Error'),
+            "unfinished": len(waited['unfinished']),
+            "seconds": round(elapsed, 2),
+            "jobs_per_minute": round(printed / elapsed * 60, 1) if elapsed > 0 else None,
+            "latency_p50": round(percentile(latencies, 0.5), 3) if latencies else None,
+            "latency_p99": round(percentile(latencies, 0.99), 3) if latencies else None,
+            "retries": sum(job['retry_count'] for job in jobs),
+            "spool_rejections": sum(flow['rejections'] for flow in core.get_flow_stats().values()),
+            "spool_waits": sum(flow['waits'] for flow in core.get_flow_stats().values()),
+            "parts_in_memory": rendered["parts"],
+            "part_files": sum(len(job['parts']) for job in jobs),
+            "threads_before": threads_before,
+            "peak_threads": waited['peak_threads'],
+            "ftp_pool": core.get_ftp_pool_stats(),
+            "printers": {printer["host"]: get_simulator_stats(printer) for printer in printers},
+        }
+    finally:
+        core.WORKER_STOP_EVENT.set()
+        for printer in printers:
+            stop_printer_simulator(printer)
+        os.chdir(tempfile.gettempdir())
+        if args.keep:
+            print(f"Benchmark directory kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print pipeline benchmark against simulated printers")
+    parser.add_argument("--jobs", type=int, default=200, help="ready jobs queued for continuous printing")
+    parser.add_argument("--parts", type=int, default=4, help="parts per job")
+    parser.add_argument("--pages-per-part", type=int, default=4)
+    parser.add_argument("--page-kb", type=int, default=8, help="approximate size of each page")
+    parser.add_argument("--printers", type=int, default=1, help="simulated printers (more than one prints in fleet mode)")
+    parser.add_argument("--port", type=int, default=2121, help="FTP port of the simulated printers")
+    parser.add_argument("--lane-workers", type=int, default=1, help="concurrent uploads per printer")
+    parser.add_argument("--stream-parts", action="store_true", help="spool-less printing (parts cut in memory)")
+    parser.add_argument("--fast-retries", action="store_true", help="shrink retry backoff and breaker timings to seconds")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for all jobs")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary benchmark directory")
+    parser.add_argument("--verbose", action="store_true", help="keep the application's logging")
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+    report = run_benchmark(args)
+    if args.stream_parts and not report["parts_in_memory"]:
+        print("warning: --stream-parts cut no part in memory; the run printed from part files", file=sys.stderr)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>18}: {value}")
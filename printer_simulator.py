@@ -0,0 +1,266 @@
+"""
+Local stand-in for a Konica Minolta Bizhub FTP hot folder, for exercising print_job_ftp,
+the continuous print worker and /api/continuous_print without a copier on the network.
+
+Only the FTP commands the print path uses are implemented (USER/PASS, TYPE, PASV/EPSV, STOR,
+NLST, NOOP, QUIT and a few harmless extras). Received files are kept in memory (name and size)
+in the printer's hot folder and "printed" (removed) one every print_seconds. Every simulator can
+inject the faults a busy or flaky copier shows:
+
+    accept_latency   seconds before a STOR is answered (150, or 452 when the spool is full)
+    bandwidth        bytes/second accepted on a data connection (0 = unlimited)
+    login_delay      seconds before PASS is answered
+    disconnect_rate  probability that a STOR drops both connections mid-transfer: after a random
+                     number (1..SIMULATOR_DROP_MAX_CHUNKS) of received chunks, or, when the file
+                     ends first, after the last byte but before the 226 reply
+    spool_capacity   files the hot folder holds before STOR is refused with 452 (0 = unlimited)
+    print_seconds    seconds the printer takes per file in the hot folder (0 = prints instantly)
+
+Run standalone:  python printer_simulator.py --host 127.0.0.1 --port 2121 --accept-latency 0.2
+and point the application at it with FTP_PORT = 2121 in core_setup.py.
+"""
+import argparse
+import logging
+import random
+import socket
+import socketserver
+import threading
+import time
+
+SIMULATOR_DEFAULTS = {
+    "accept_latency": 0.0,
+    "bandwidth": 0,
+    "login_delay": 0.0,
+    "disconnect_rate": 0.0,
+    "spool_capacity": 0,
+    "print_seconds": 0.0,
+}
+SIMULATOR_RECEIVE_SIZE = 64 * 1024 # Bytes read from a data connection per step
+SIMULATOR_DROP_MAX_CHUNKS = 64 # A dropped STOR fails after up to this many received chunks (early, mid-file or late)
+SIMULATOR_DATA_TIMEOUT = 30 # Seconds to wait for the client to open a passive data connection
+
+class SimulatedPrinterHandler(socketserver.StreamRequestHandler):
+    """One FTP control connection to a simulated printer."""
+
+    def setup(self):
+        super().setup()
+        self.printer = self.server.printer
+        self.passive = None
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode("utf-8"))
+
+    def handle(self):
+        self.reply("220 Simulated Bizhub hot folder ready")
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+                command = command.upper()
+                if command == "QUIT":
+                    self.reply("221 Goodbye")
+                    return
+                if command == "STOR":
+                    if not self.store(argument):
+                        return # Simulated mid-transfer disconnect: the control connection is dropped too
+                elif command == "NLST":
+                    self.list_hot_folder()
+                elif command in ("PASV", "EPSV"):
+                    self.open_passive(command)
+                elif command == "USER":
+                    self.reply("331 Password required")
+                elif command == "PASS":
+                    time.sleep(self.printer["settings"]["login_delay"])
+                    record_simulator_stat(self.printer, "logins")
+                    self.reply("230 Logged in")
+                elif command == "TYPE":
+                    self.reply("200 Type set")
+                elif command == "NOOP":
+                    self.reply("200 OK")
+                elif command == "PWD":
+                    self.reply('257 "/" is the current directory')
+                elif command == "CWD":
+                    self.reply("250 OK")
+                elif command == "SYST":
+                    self.reply("215 UNIX Type: L8")
+                else:
+                    self.reply(f"502 {command} not implemented")
+        except OSError:
+            return # Client went away
+        finally:
+            self.close_passive()
+
+    def open_passive(self, command: str):
+        self.close_passive()
+        host = self.connection.getsockname()[0]
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((host, 0))
+        self.passive.listen(1)
+        self.passive.settimeout(SIMULATOR_DATA_TIMEOUT)
+        port = self.passive.getsockname()[1]
+        if command == "EPSV":
+            self.reply(f"229 Entering Extended Passive Mode (|||{port}|)")
+        else:
+            self.reply(f"227 Entering Passive Mode ({host.replace('.', ',')},{port >> 8},{port & 0xFF})")
+
+    def close_passive(self):
+        if self.passive is not None:
+            self.passive.close()
+            self.passive = None
+
+    def accept_data(self):
+        if self.passive is None:
+            self.reply("425 Use PASV first")
+            return None
+        try:
+            conn, _ = self.passive.accept()
+        except OSError:
+            self.reply("425 Data connection failed")
+            return None
+        finally:
+            self.close_passive()
+        return conn
+
+    def store(self, filename: str) -> bool:
+        """Receives one file into the hot folder. Returns False when the connection was dropped on purpose."""
+        printer = self.printer
+        settings = printer["settings"]
+        time.sleep(settings["accept_latency"])
+        with printer["lock"]:
+            spool_full = settings["spool_capacity"] and len(printer["hot_folder"]) >= settings["spool_capacity"]
+        if spool_full:
+            self.close_passive()
+            record_simulator_stat(printer, "rejected")
+            self.reply("452 Spool full, try again later")
+            return True
+        self.reply("150 Ok to send data")
+        conn = self.accept_data()
+        if conn is None:
+            return True
+
+        # The drop point counts received chunks, not bytes, so it scales with the transfer; a file
+        # that ends before it is dropped after its last byte, before the transfer is confirmed
+        drop_after = None
+        if random.random() < settings["disconnect_rate"]:
+            drop_after = random.randint(1, SIMULATOR_DROP_MAX_CHUNKS)
+        received = 0
+        chunks = 0
+        started = time.time()
+        with conn:
+            while True:
+                chunk = conn.recv(SIMULATOR_RECEIVE_SIZE)
+                if drop_after is not None and (not chunk or chunks + 1 >= drop_after):
+                    record_simulator_stat(printer, "disconnects")
+                    conn.shutdown(socket.SHUT_RDWR)
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return False
+                if not chunk:
+                    break
+                received += len(chunk)
+                chunks += 1
+                if settings["bandwidth"]:
+                    # Throttle to the bandwidth cap by holding the reads back
+                    ahead = received / settings["bandwidth"] - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        with printer["lock"]:
+            printer["hot_folder"].append((filename, received))
+            printer["stats"]["stored"] += 1
+            printer["stats"]["bytes"] += received
+            printer["stats"]["peak_spool"] = max(printer["stats"]["peak_spool"], len(printer["hot_folder"]))
+            if not settings["print_seconds"]:
+                printer["hot_folder"].clear()
+        self.reply("226 Transfer complete")
+        return True
+
+    def list_hot_folder(self):
+        self.reply("150 Here comes the directory listing")
+        conn = self.accept_data()
+        if conn is None:
+            return
+        with self.printer["lock"]:
+            names = [name for name, _ in self.printer["hot_folder"]]
+        with conn:
+            conn.sendall("".join(f"{name}\r\n" for name in names).encode("utf-8"))
+        self.reply("226 Directory send OK")
+
+class SimulatedPrinterServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def record_simulator_stat(printer: dict, key: str):
+    with printer["lock"]:
+        printer["stats"][key] += 1
+
+def print_hot_folder(printer: dict):
+    """Printer side of the hot folder: removes one file every print_seconds, like a copier working through its spool."""
+    while not printer["stop"].wait(printer["settings"]["print_seconds"] or 0.5):
+        with printer["lock"]:
+            if printer["hot_folder"]:
+                printer["hot_folder"].pop(0)
+                printer["stats"]["printed"] += 1
+
+def start_printer_simulator(host: str = "127.0.0.1", port: int = 2121, **settings) -> dict:
+    """
+    Starts a simulated printer listening on host:port in background threads and returns its
+    state: settings, the in-memory hot folder and counters (logins, stored, bytes, rejected,
+    disconnects, printed, peak_spool). Unknown settings raise TypeError.
+    """
+    unknown = set(settings) - set(SIMULATOR_DEFAULTS)
+    if unknown:
+        raise TypeError(f"Unknown simulator settings: {', '.join(sorted(unknown))}")
+    printer = {
+        "host": host,
+        "port": port,
+        "settings": {**SIMULATOR_DEFAULTS, **settings},
+        "hot_folder": [],
+        "lock": threading.Lock(),
+        "stop": threading.Event(),
+        "stats": {"logins": 0, "stored": 0, "bytes": 0, "rejected": 0, "disconnects": 0, "printed": 0, "peak_spool": 0},
+    }
+    server = SimulatedPrinterServer((host, port), SimulatedPrinterHandler)
+    server.printer = printer
+    printer["server"] = server
+    threading.Thread(target=server.serve_forever, name=f"PrinterSim_{host}", daemon=True).start()
+    threading.Thread(target=print_hot_folder, args=(printer,), name=f"PrinterSimSpool_{host}", daemon=True).start()
+    logging.info(f"🖨️ طابعة محاكاة تعمل على {host}:{port} ({printer['settings']}).")
+    return printer
+
+def stop_printer_simulator(printer: dict):
+    printer["stop"].set()
+    printer["server"].shutdown()
+    printer["server"].server_close()
+
+def get_simulator_stats(printer: dict) -> dict:
+    with printer["lock"]:
+        return dict(printer["stats"], spool=len(printer["hot_folder"]))
+
+def add_simulator_arguments(parser: argparse.ArgumentParser):
+    """Fault-injection options shared by the simulator and the print benchmark."""
+    parser.add_argument("--accept-latency", type=float, default=0.0, help="seconds before each STOR is answered")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/second per data connection (0 = unlimited)")
+    parser.add_argument("--login-delay", type=float, default=0.0, help="seconds before a login is answered")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="probability of dropping a STOR mid-transfer (after a random number of received chunks, or before the 226 reply)")
+    parser.add_argument("--spool-capacity", type=int, default=0, help="files held before STOR gets 452 (0 = unlimited)")
+    parser.add_argument("--print-seconds", type=float, default=0.0, help="seconds the printer spends per file (0 = instant)")
+
+def simulator_settings(args: argparse.Namespace) -> dict:
+    return {key: getattr(args, key) for key in SIMULATOR_DEFAULTS}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(threadName)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description="Simulated Bizhub FTP hot folder")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2121)
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+    printer = start_printer_simulator(args.host, args.port, **simulator_settings(args))
+    try:
+        while True:
+            time.sleep(10)
+            logging.info(f"📊 {get_simulator_stats(printer)}")
+    except KeyboardInterrupt:
+        stop_printer_simulator(printer)